@@ -1,11 +1,595 @@
+import collections
+import contextlib
+import shlex
+import threading
+import uuid
+
+import eventlet
 from oslo.config import cfg
 
 from neutron.agent.linux import ovs_lib
-from neutron.agent.linux import ip_lib
+from neutron.agent.linux import ovsdb_monitor
+from neutron.agent.linux import ovsnetwork_netlink
+from neutron.agent.linux import ovsnetwork_ovsdb
+from neutron.agent.linux import ovsnetwork_reconcile
+from neutron.agent.linux import ovsnetwork_rootwrap
+from neutron.common import exceptions
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
 
+ovs_network_driver_opts = [
+    cfg.BoolOpt('ofport_cache', default=True,
+                help=_('Cache the ofports of ovs network endpoint ports, '
+                       'kept up to date by an ovsdb monitor.')),
+    cfg.IntOpt('ofport_cache_respawn_interval', default=30,
+               help=_('Seconds to wait before respawning the ovsdb monitor '
+                      'feeding the ofport cache.')),
+    cfg.StrOpt('ovsdb_interface', default='vsctl',
+               help=_('How the driver manages bridges and ports: "vsctl" '
+                      'runs ovs-vsctl, "native" talks OVSDB JSON-RPC over '
+                      'ovsdb_connection.')),
+    cfg.StrOpt('veth_interface', default='ip',
+               help=_('How the driver manages veth pairs: "ip" runs the ip '
+                      'command through the root helper, "netlink" uses an '
+                      'rtnetlink socket and needs CAP_NET_ADMIN.')),
+    cfg.StrOpt('link_mode', default='veth',
+               help=_('How endpoint ports are connected to br-int: "veth" '
+                      'uses a kernel veth pair, "patch" a pair of OVS patch '
+                      'ports, which keeps the traffic in one datapath '
+                      'flow.')),
+    cfg.IntOpt('veth_pool_size', default=0,
+               help=_('Number of spare veth pairs kept ready in the veth '
+                      'link_mode. An endpoint then only renames a spare '
+                      'pair, the pool is refilled in the background.')),
+    cfg.StrOpt('bridge_mode', default='dedicated',
+               help=_('"dedicated" gives every ovs network its own bridge. '
+                      '"shared" puts the ovs networks without a controller '
+                      'on shared_bridge, each isolated by a local VLAN tag '
+                      'on its ports, so VLAN tagged traffic cannot cross '
+                      'them. A controller owns a whole bridge, ovs '
+                      'networks with one keep or move to a dedicated '
+                      'bridge.')),
+    cfg.IntOpt('max_tunnel_vlans', default=1024,
+               help=_('Maximum number of the agent\'s local VLANs taken by '
+                      'the tunnel ids of links to other hosts, the rest is '
+                      'left to the tenant networks.')),
+    cfg.StrOpt('shared_bridge', default='br-ovsnet',
+               help=_('Bridge carrying the ovs networks in the shared '
+                      'bridge_mode.')),
+    cfg.StrOpt('root_helper_daemon',
+               help=_('Command starting a long-lived privileged helper '
+                      'which runs the ovs-vsctl, ovs-ofctl and ip commands '
+                      'of the driver, e.g. "sudo python -m '
+                      'neutron.agent.linux.ovsnetwork_rootwrap '
+                      '/etc/neutron/rootwrap.conf". When unset every command '
+                      'goes through root_helper.')),
+]
+cfg.CONF.register_opts(ovs_network_driver_opts, 'OVSNETWORK')
+
+# interface external id locating the ports of a shared ovs network,
+# "<ovs network bridge name>:<VLAN tag>"
+SLICE_EXTERNAL_ID = 'ovs-network-slice'
+
+
+class FlowBatchError(exceptions.NeutronException):
+    message = _("Failed to apply flow batch on bridge %(bridge)s: "
+                "%(failures)s")
+
+
+class SharedBridgeFullError(exceptions.NeutronException):
+    message = _("No VLAN tag left on %(bridge)s for ovs network %(name)s")
+
+
+class TunnelForwardingError(exceptions.NeutronException):
+    message = _("No tunnel port to %(remote_ip)s on br-tun")
+
+
+class TunnelVlanExhaustedError(TunnelForwardingError):
+    message = _("No local VLAN left for tunnel id %(tunnel_id)s, "
+                "%(used)d in use")
+
+
+class OVSFlowBatch(object):
+    """Flow adds/deletes collected for one bridge and applied together.
+
+    Like OVSBridge.defer_apply_off(), every action is pushed with a single
+    ovs-ofctl call reading the flows from stdin, but a failed call is
+    reported to the caller instead of being only logged.
+    """
+
+    # deletes go first so that a flow removed and re-added in the same
+    # batch ends up installed. Stale deletes go last, for replacements
+    # which must not drop traffic: the new flows are in place before the
+    # old ones go, and an add with the match and priority of an existing
+    # flow replaces it atomically.
+    ACTIONS = ('del', 'add', 'stale')
+    COMMANDS = {'del': 'del', 'add': 'add', 'stale': 'del'}
+
+    def __init__(self, bridge, executor):
+        self.bridge = bridge
+        self.executor = executor
+        self.flows = dict((action, []) for action in self.ACTIONS)
+        self.results = {}
+
+    def __len__(self):
+        return sum(len(flows) for flows in self.flows.values())
+
+    def add_flow(self, **kwargs):
+        self.flows['add'].append(ovs_lib._build_flow_expr_str(kwargs, 'add'))
+
+    def delete_flows(self, **kwargs):
+        self.flows['del'].append(ovs_lib._build_flow_expr_str(kwargs, 'del'))
+
+    def delete_stale_flows(self, **kwargs):
+        """Delete flows once the adds of the batch succeeded."""
+        self.flows['stale'].append(
+            ovs_lib._build_flow_expr_str(kwargs, 'del'))
+
+    def apply(self):
+        """Push the batch to the bridge.
+
+        :returns: dict mapping each applied action to its flow count.
+        :raises FlowBatchError: if any ovs-ofctl call failed.
+        """
+        failures = {}
+        for action in self.ACTIONS:
+            flows = self.flows[action]
+            if not flows:
+                continue
+            if action == 'stale' and failures:
+                # keep the old flows rather than leave nothing
+                continue
+            args = ['ovs-ofctl', '%s-flows' % self.COMMANDS[action],
+                    self.bridge.br_name, '-']
+            try:
+                self.executor.execute(args,
+                                      process_input='\n'.join(flows) + '\n')
+                self.results[action] = len(flows)
+            except RuntimeError as e:
+                failures[action] = e
+        self.flows = dict((action, []) for action in self.ACTIONS)
+        if failures:
+            LOG.error(_("Flow batch on bridge %(bridge)s failed: "
+                        "%(failures)s"),
+                      {'bridge': self.bridge.br_name, 'failures': failures})
+            raise FlowBatchError(bridge=self.bridge.br_name,
+                                 failures=failures)
+        LOG.debug(_("Flow batch applied on bridge %(bridge)s: %(results)s"),
+                  {'bridge': self.bridge.br_name, 'results': self.results})
+        return self.results
+
+
+class OFPortCache(object):
+    """Name to ofport cache of the ovs network endpoint interfaces.
+
+    The cache is filled by one bulk query of the Interface table and kept
+    coherent with the row changes streamed by an ovsdb-client monitor.
+    While the monitor is not running, lookups go to OVSDB directly.
+    """
+
+    # olo/olb are the ovs link ports, vlo/vlb the vm link ports
+    PREFIXES = ('olo', 'olb', 'vlo', 'vlb')
+
+    def __init__(self, backend, respawn_interval=None):
+        self.backend = backend
+        self.ofports = {}
+        # monitor rows are keyed by uuid, a modify may not repeat the name
+        self.names = {}
+        self.monitor = ovsdb_monitor.SimpleInterfaceMonitor(
+            root_helper=backend.root_helper,
+            respawn_interval=respawn_interval)
+
+    def start(self):
+        self.monitor.start()
+        self.refresh()
+
+    def stop(self):
+        self.monitor.stop()
+
+    @staticmethod
+    def _to_ofport(value):
+        # unassigned ofports show up as an empty set or -1
+        try:
+            ofport = int(value)
+        except (TypeError, ValueError):
+            return None
+        if ofport > 0:
+            return ofport
+
+    def _update(self, uuid, name, ofport):
+        if not name or not name.startswith(self.PREFIXES):
+            return
+        if uuid:
+            self.names[uuid] = name
+        ofport = self._to_ofport(ofport)
+        if ofport:
+            self.ofports[name] = ofport
+        else:
+            self.ofports.pop(name, None)
+
+    def refresh(self):
+        """Reload the whole cache with a single 'list Interface' query."""
+        output = self.backend.run_vsctl(['--format=json', '--',
+                                         '--columns=_uuid,name,ofport',
+                                         'list', 'Interface'])
+        self.ofports = {}
+        self.names = {}
+        for uuid, name, ofport in jsonutils.loads(output)['data']:
+            # uuids are encoded as ["uuid", "<value>"]
+            self._update(uuid[1], name, ofport)
+        LOG.debug(_("ofport cache loaded with %d ports"), len(self.ofports))
+
+    def process_updates(self):
+        """Apply the updates received from the monitor since the last call."""
+        for line in self.monitor.iter_stdout():
+            try:
+                update = jsonutils.loads(line)
+            except ValueError:
+                LOG.debug(_("Ignoring ovsdb monitor output: %s"), line)
+                continue
+            headings = update.get('headings', [])
+            for values in update.get('data', []):
+                row = dict(zip(headings, values))
+                uuid = row.get('row')
+                action = row.get('action')
+                if action == 'delete':
+                    name = self.names.pop(uuid, row.get('name'))
+                    self.ofports.pop(name, None)
+                elif action in ('initial', 'insert', 'new'):
+                    name = row.get('name') or self.names.get(uuid)
+                    self._update(uuid, name, row.get('ofport'))
+
+    def get(self, name):
+        if self.monitor.is_active:
+            self.process_updates()
+            ofport = self.ofports.get(name)
+            if ofport:
+                return ofport
+        ofport = self._to_ofport(self.backend.query_ofport(name))
+        if ofport:
+            self._update(None, name, ofport)
+        return ofport
+
+    def pop(self, name):
+        self.ofports.pop(name, None)
+
+
+class VsctlOVSDBBackend(object):
+    """OVSDB access of the ovs network driver through ovs-vsctl.
+
+    Provides the same methods as ovsnetwork_ovsdb.NativeOVSDBBackend.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.root_helper = executor.root_helper
+        self.ofport_cache = None
+        if cfg.CONF.OVSNETWORK.ofport_cache:
+            self.ofport_cache = OFPortCache(
+                self, cfg.CONF.OVSNETWORK.ofport_cache_respawn_interval)
+
+    def start(self):
+        if self.ofport_cache:
+            self.ofport_cache.start()
+
+    def stop(self):
+        if self.ofport_cache:
+            self.ofport_cache.stop()
+
+    def run_vsctl(self, args):
+        full_args = ['ovs-vsctl', '--timeout=%d' % cfg.CONF.ovs_vsctl_timeout]
+        return self.executor.execute(full_args + args)
+
+    def bridge_exists(self, name):
+        try:
+            self.run_vsctl(['br-exists', name])
+        except RuntimeError:
+            return False
+        return True
+
+    def add_bridge(self, name, controllers=None):
+        args = ['--', '--may-exist', 'add-br', name]
+        if controllers:
+            args += ['--', 'set-controller', name] + list(controllers)
+        self.run_vsctl(args)
+
+    def del_bridge(self, name):
+        self.run_vsctl(['--', '--if-exists', 'del-br', name])
+
+    def get_controller(self, bridge):
+        output = self.run_vsctl(['--', 'get-controller', bridge])
+        return output.strip().split('\n') if output.strip() else []
+
+    def set_controller(self, bridge, targets):
+        self.run_vsctl(['--', 'set-controller', bridge] + list(targets))
+
+    def del_controller(self, bridge):
+        self.run_vsctl(['--', 'del-controller', bridge])
+
+    def add_ports(self, ports):
+        """Add ports in one transaction.
+
+        :param ports: (bridge, port, external_ids, peer, tag) tuples, a
+                      port with a peer is a patch port to it, one with a
+                      tag an access port of that VLAN.
+        """
+        args = []
+        for bridge, port, external_ids, peer, tag in ports:
+            args += ['--', '--may-exist', 'add-port', bridge, port]
+            if tag:
+                args += ['--', 'set', 'Port', port, 'tag=%s' % tag]
+            settings = ['external_ids:%s=%s' % item
+                        for item in sorted((external_ids or {}).items())]
+            if peer:
+                settings += ['type=patch', 'options:peer=%s' % peer]
+            if settings:
+                args += ['--', 'set', 'Interface', port] + settings
+        self.run_vsctl(args)
+
+    def del_ports(self, ports):
+        """Delete (bridge, port) pairs in one transaction."""
+        args = []
+        for bridge, port in ports:
+            args += ['--', '--if-exists', 'del-port', bridge, port]
+            if self.ofport_cache:
+                self.ofport_cache.pop(port)
+        self.run_vsctl(args)
+
+    def query_ofport(self, name):
+        try:
+            return self.run_vsctl(['get', 'Interface', name,
+                                   'ofport']).strip()
+        except RuntimeError:
+            return None
+
+    def get_ofport(self, name):
+        if self.ofport_cache:
+            return self.ofport_cache.get(name)
+        return self.query_ofport(name)
+
+    def snapshot(self):
+        """Read bridges, ports and interfaces with one ovs-vsctl call."""
+        output = self.run_vsctl(
+            ['--format=json',
+             '--', '--columns=name,ports,controller', 'list', 'Bridge',
+             '--', '--columns=_uuid,name', 'list', 'Port',
+             '--', '--columns=_uuid,target', 'list', 'Controller',
+             '--', '--columns=name,type,ofport,external_ids', 'list',
+             'Interface'])
+        tables = []
+        for table in ovsnetwork_ovsdb.JsonStreamParser().feed(output):
+            tables.append([dict(zip(table['headings'],
+                                    map(ovsnetwork_ovsdb.from_json, row)))
+                           for row in table['data']])
+        bridges, ports, controllers, interfaces = tables
+        return ovsnetwork_ovsdb.make_snapshot(
+            bridges,
+            dict((row['_uuid'], row) for row in ports),
+            dict((row['_uuid'], row) for row in controllers),
+            interfaces)
+
+
+class IPVethManager(object):
+    """veth pair management through the ip command.
+
+    Every call is sent to the executor as one batch. Provides the same
+    methods as ovsnetwork_netlink.NetlinkVethManager.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def _run(self, commands, check_exit_code=True):
+        self.executor.execute_many([(['ip', 'link'] + cmd, None)
+                                    for cmd in commands],
+                                   check_exit_code=check_exit_code)
+
+    def add_veth_pairs(self, pairs, up=True):
+        commands = [['add', name, 'type', 'veth', 'peer', 'name', peer]
+                    for name, peer in pairs]
+        if up:
+            commands += [['set', name, 'up']
+                         for pair in pairs for name in pair]
+        self._run(commands)
+
+    def delete_links(self, names):
+        names = [name for name in names if ovsnetwork_netlink.link_exists(name)]
+        # deleting a veth end deletes its peer, so deleting the peer later
+        # in the batch fails: run them all and check what is left
+        self._run([['delete', name] for name in names], check_exit_code=False)
+        left = [name for name in names if ovsnetwork_netlink.link_exists(name)]
+        if left:
+            raise RuntimeError(_("Failed to delete links %s") % ', '.join(left))
+
+    def set_links_up(self, names, up=True):
+        state = 'up' if up else 'down'
+        self._run([['set', name, state] for name in names])
+
+    def rename_links(self, renames, up=True):
+        commands = []
+        for old, new in renames:
+            commands += [['set', old, 'down'], ['set', old, 'name', new]]
+            if up:
+                commands.append(['set', new, 'up'])
+        self._run(commands)
+
+
+class VethPool(object):
+    """A pool of spare veth pairs, renamed into endpoint ports on demand.
+
+    Spare pairs are named PREFIX + 'a'/'b' + a random suffix and stay down,
+    which a rename requires anyway. Pairs left over by a previous run of
+    the agent are reused.
+    """
+
+    PREFIX = 'ovp'
+
+    def __init__(self, veth, size):
+        self.veth = veth
+        self.size = size
+        self.free = collections.deque()
+        self.refilling = False
+
+    def start(self):
+        names = set(ovsnetwork_netlink.list_links(self.PREFIX))
+        orphans = []
+        for name in names:
+            if name.startswith(self.PREFIX + 'a'):
+                peer = self.PREFIX + 'b' + name[len(self.PREFIX) + 1:]
+                if peer in names:
+                    self.free.append((name, peer))
+                    continue
+            elif (self.PREFIX + 'a' + name[len(self.PREFIX) + 1:]) in names:
+                continue
+            orphans.append(name)
+        if orphans:
+            self.veth.delete_links(orphans)
+        self.schedule_refill()
+
+    def _new_pair(self):
+        suffix = uuid.uuid4().hex[:10]
+        return self.PREFIX + 'a' + suffix, self.PREFIX + 'b' + suffix
+
+    def schedule_refill(self):
+        if not self.refilling and len(self.free) < self.size:
+            self.refilling = True
+            eventlet.spawn_n(self._refill)
+
+    def _refill(self):
+        try:
+            pairs = [self._new_pair()
+                     for _i in xrange(self.size - len(self.free))]
+            if pairs:
+                self.veth.add_veth_pairs(pairs, up=False)
+                self.free.extend(pairs)
+        except Exception:
+            LOG.exception(_("Failed to refill the veth pool"))
+        finally:
+            self.refilling = False
+
+    def take(self, name, peer):
+        """Rename a spare pair to (name, peer) and set it up.
+
+        :returns: False when no spare pair could be used.
+        """
+        if not self.free:
+            self.schedule_refill()
+            return False
+        spare = self.free.popleft()
+        self.schedule_refill()
+        try:
+            self.veth.rename_links([(spare[0], name), (spare[1], peer)])
+        except Exception:
+            LOG.exception(_("Failed to rename spare veth pair %s"), spare[0])
+            try:
+                self.veth.delete_links([spare[0]])
+            except Exception:
+                LOG.exception(_("Failed to delete spare veth pair %s"),
+                              spare[0])
+            return False
+        return True
+
+
+class TunnelForwarder(object):
+    """Forward link tunnel ids to peer endpoints on other hosts via br-tun.
+
+    Patch ports do not carry tunnel metadata, so like the agent does for
+    tenant networks, a tunnel id crosses between br-int and br-tun in a
+    local VLAN, taken from the agent's pool for as long as it is used:
+
+        br-int table 1: tun_id=local -> vlan out, patch_tun
+        br-tun table 0: in_port=patch_int, vlan out -> tun_id=local, tunnel
+        br-tun tunnel table: tun_id=peer -> vlan in, patch_int
+        br-int table 0: in_port=patch_tun, vlan in -> tun_id=peer, table 1
+
+    At most max_vlans VLANs are taken, so that tenant networks cannot be
+    starved by links.
+    """
+
+    def __init__(self, tun_br, patch_int_ofport, patch_tun_ofport, tun_table,
+                 get_tunnel_ofport, local_vlans, vlans=None, max_vlans=None):
+        self.tun_br = tun_br
+        self.patch_int_ofport = patch_int_ofport
+        self.patch_tun_ofport = patch_tun_ofport
+        self.tun_table = tun_table
+        self.get_tunnel_ofport = get_tunnel_ofport
+        self.local_vlans = local_vlans
+        # tunnel id -> local vlan
+        self.vlans = vlans or {}
+        self.max_vlans = max_vlans
+
+    def get_vlan(self, tunnel_id):
+        tunnel_id = int(tunnel_id)
+        if tunnel_id not in self.vlans:
+            if (not self.local_vlans or (self.max_vlans is not None and
+                                         len(self.vlans) >= self.max_vlans)):
+                raise TunnelVlanExhaustedError(tunnel_id=tunnel_id,
+                                               used=len(self.vlans))
+            self.vlans[tunnel_id] = self.local_vlans.pop()
+        return self.vlans[tunnel_id]
+
+    def release(self, *tunnel_ids):
+        for tunnel_id in tunnel_ids:
+            vlan = self.vlans.pop(int(tunnel_id), None)
+            if vlan is not None:
+                self.local_vlans.add(vlan)
+
+    def flow_keys(self, tunnel_id, peer_tunnel_id):
+        """Keys of the flows forwarding tunnel_id, as they are now.
+
+        :returns: (br-int keys, br-tun keys), empty if not forwarded.
+        """
+        vlan_out = self.vlans.get(int(tunnel_id))
+        vlan_in = self.vlans.get(int(peer_tunnel_id))
+        if vlan_out is None or vlan_in is None:
+            return set(), set()
+        int_flows, tun_flows = self._flows(0, tunnel_id, peer_tunnel_id,
+                                           vlan_out, vlan_in, None)
+        return set(int_flows), set(tun_flows)
+
+    def flows(self, cookie, tunnel_id, peer_tunnel_id, peer_ip):
+        """The flows connecting a local endpoint to its peer at peer_ip.
+
+        :returns: (br-int entries, br-tun entries), see
+                  ovsnetwork_reconcile.flow_entry().
+        """
+        tun_ofport = self.get_tunnel_ofport(peer_ip)
+        if not tun_ofport:
+            raise TunnelForwardingError(remote_ip=peer_ip)
+        taken = [t for t in (tunnel_id, peer_tunnel_id)
+                 if int(t) not in self.vlans]
+        try:
+            vlan_out = self.get_vlan(tunnel_id)
+            vlan_in = self.get_vlan(peer_tunnel_id)
+        except TunnelVlanExhaustedError:
+            self.release(*taken)
+            raise
+        return self._flows(cookie, tunnel_id, peer_tunnel_id, vlan_out,
+                           vlan_in, tun_ofport)
+
+    def _flows(self, cookie, tunnel_id, peer_tunnel_id, vlan_out, vlan_in,
+               tun_ofport):
+        priority = ovsnetwork_reconcile.FLOW_PRIORITY
+        int_flows = dict([
+            ovsnetwork_reconcile.flow_entry(
+                '1', priority, cookie, 'mod_vlan_vid:%s,output:%s' %
+                (vlan_out, self.patch_tun_ofport), tun_id=tunnel_id),
+            ovsnetwork_reconcile.flow_entry(
+                '0', priority, cookie, 'strip_vlan,set_tunnel:%s,'
+                'resubmit(,1)' % peer_tunnel_id,
+                in_port=self.patch_tun_ofport, dl_vlan=vlan_in)])
+        tun_flows = dict([
+            ovsnetwork_reconcile.flow_entry(
+                '0', priority, cookie, 'strip_vlan,set_tunnel:%s,output:%s' %
+                (tunnel_id, tun_ofport), in_port=self.patch_int_ofport,
+                dl_vlan=vlan_out),
+            ovsnetwork_reconcile.flow_entry(
+                self.tun_table, priority, cookie, 'mod_vlan_vid:%s,output:%s' %
+                (vlan_in, self.patch_int_ofport), tun_id=peer_tunnel_id)])
+        return int_flows, tun_flows
+
 
 class OVSNetworkDriver(object):
     """The driver for ovs network extension implementation on the agent side."""
@@ -14,10 +598,346 @@ class OVSNetworkDriver(object):
 
     def __init__(self):
         self.root_helper = cfg.CONF.AGENT.root_helper
-        self.ip_wrapper = ip_lib.IPWrapper(root_helper=self.root_helper)
         self.bridge = ovs_lib.OVSBridge('br-int', self.root_helper)
+        # flow batches are tracked per greenthread
+        self._local = threading.local()
+        daemon_cmd = cfg.CONF.OVSNETWORK.root_helper_daemon
+        self.executor = ovsnetwork_rootwrap.CommandExecutor(
+            self.root_helper, daemon_cmd and shlex.split(daemon_cmd))
+        if cfg.CONF.OVSNETWORK.ovsdb_interface == 'native':
+            self.ovsdb = ovsnetwork_ovsdb.NativeOVSDBBackend()
+        else:
+            self.ovsdb = VsctlOVSDBBackend(self.executor)
+        self.ovsdb.start()
+        if cfg.CONF.OVSNETWORK.veth_interface == 'netlink':
+            self.veth = ovsnetwork_netlink.NetlinkVethManager()
+        else:
+            self.veth = IPVethManager(self.executor)
+        self.desired = ovsnetwork_reconcile.DesiredState()
+        # set by setup_tunneling() when the agent has a tunnel bridge
+        self.tunnel = None
+        self.link_mode = cfg.CONF.OVSNETWORK.link_mode
+        if self.link_mode not in ('veth', 'patch'):
+            LOG.warning(_("Unknown link_mode %s, using veth"), self.link_mode)
+            self.link_mode = 'veth'
+        self.veth_pool = None
+        if self.link_mode == 'veth' and cfg.CONF.OVSNETWORK.veth_pool_size > 0:
+            self.veth_pool = VethPool(self.veth, cfg.CONF.OVSNETWORK.veth_pool_size)
+            self.veth_pool.start()
+        self.bridge_mode = cfg.CONF.OVSNETWORK.bridge_mode
+        if self.bridge_mode not in ('dedicated', 'shared'):
+            LOG.warning(_("Unknown bridge_mode %s, using dedicated"), self.bridge_mode)
+            self.bridge_mode = 'dedicated'
+        self.shared_bridge = cfg.CONF.OVSNETWORK.shared_bridge
+        # ovs network name -> VLAN tag of its ports on the shared bridge
+        self.network_tags = {}
+        if self.bridge_mode == 'shared':
+            self.load_network_tags()
         LOG.info(_("OVSNetworkDriver is initialized successfully.\n"))
    
+    @contextlib.contextmanager
+    def flow_batch(self, bridge=None):
+        """Collect the flow changes made inside the block on a bridge.
+
+        The bridge defaults to br-int. The batches of all bridges are
+        applied when the outermost block exits, so a caller may wrap a
+        burst of events to push all of their flows at once. They are
+        dropped if the block raises.
+        """
+        bridge = bridge or self.bridge
+        batches = getattr(self._local, 'flow_batches', None)
+        if batches is not None:
+            if bridge.br_name not in batches:
+                batches[bridge.br_name] = OVSFlowBatch(bridge, self.executor)
+            yield batches[bridge.br_name]
+            return
+        batch = OVSFlowBatch(bridge, self.executor)
+        batches = self._local.flow_batches = {bridge.br_name: batch}
+        try:
+            yield batch
+        finally:
+            self._local.flow_batches = None
+        errors = []
+        for batch in batches.values():
+            try:
+                batch.apply()
+            except FlowBatchError as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def load_network_tags(self):
+        """Recover the VLAN tags of the shared ovs networks from OVSDB."""
+        snapshot = self.ovsdb.snapshot()
+        for interface in snapshot['interfaces'].values():
+            value = interface['external_ids'].get(SLICE_EXTERNAL_ID)
+            if value:
+                name, tag = value.rsplit(':', 1)
+                self.network_tags[name] = int(tag)
+
+    def _allocate_network_tag(self, name):
+        used = set(self.network_tags.values())
+        for tag in xrange(1, 4095):
+            if tag not in used:
+                self.network_tags[name] = tag
+                return tag
+        raise SharedBridgeFullError(bridge=self.shared_bridge, name=name)
+
+    def get_ovs_network_placement(self, name, allocate=True):
+        """Return (bridge, VLAN tag) carrying the ports of a bridge.
+
+        The bridge is the ovs network bridge itself or br-int with no tag,
+        except for ovs networks on the shared bridge in the shared
+        bridge_mode. Whether an ovs network is shared is known from its
+        controller once recorded, otherwise from the dedicated bridge
+        existing.
+        """
+        if self.bridge_mode != 'shared' or name == self.bridge.br_name:
+            return name, None
+        if name not in self.network_tags:
+            if name in self.desired.bridges:
+                dedicated = bool(self.desired.bridges[name])
+            else:
+                dedicated = self.ovsdb.bridge_exists(name)
+            if dedicated or not allocate:
+                return name, None
+            self._allocate_network_tag(name)
+        return self.shared_bridge, self.network_tags[name]
+
+    def get_port_pair_specs(self, network, port1, peer_bridge, port2):
+        """Return the add_ports() tuples of a pair serving an ovs network.
+
+        port1 goes on the ovs network bridge named network, port2 on
+        peer_bridge, br-int or the other network of a direct link. Both
+        interfaces are tagged with network, and ports on the shared bridge
+        with the network and VLAN tag they belong to.
+        """
+        peer1, peer2 = self.get_endpoint_peers(port1, port2)
+        specs = []
+        for name, port, peer in ((network, port1, peer1),
+                                 (peer_bridge, port2, peer2)):
+            bridge, tag = self.get_ovs_network_placement(name)
+            external_ids = {ovsnetwork_reconcile.ENDPOINT_EXTERNAL_ID: network}
+            if tag:
+                external_ids[SLICE_EXTERNAL_ID] = '%s:%s' % (name, tag)
+            specs.append((bridge, port, external_ids, peer, tag))
+        return specs
+
+    def setup_tunneling(self, tun_br, patch_int_ofport, patch_tun_ofport,
+                        tun_table, get_tunnel_ofport, local_vlans):
+        """Forward to peer endpoints on other hosts through tun_br.
+
+        Called by the agent once br-tun is set up and again when it was
+        reset, the local VLANs in use are kept.
+
+        :param tun_table: br-tun table of the tunnel type in use.
+        :param get_tunnel_ofport: callable returning the ofport of the
+                                  tunnel to a remote ip, 0 if unavailable.
+        :param local_vlans: the agent's set of free local VLANs, at most
+                            max_tunnel_vlans of them are taken.
+        """
+        self.tunnel = TunnelForwarder(
+            tun_br, patch_int_ofport, patch_tun_ofport, tun_table,
+            get_tunnel_ofport, local_vlans, self.tunnel and self.tunnel.vlans,
+            cfg.CONF.OVSNETWORK.max_tunnel_vlans)
+
+    def is_remote_peer(self, peer_host, peer_ip):
+        return bool(peer_host and peer_ip and peer_host != cfg.CONF.host)
+
+    def add_peer_forwarding(self, bridge_name, tunnel_id, peer_tunnel_id,
+                            peer_host, peer_ip, link_id=None):
+        """Forward between a local endpoint and a peer on another host.
+
+        Nothing is done when the peer is on this host, br-int connects
+        both already.
+
+        :raises TunnelForwardingError: when there is no tunnel to peer_ip
+                                       or no local VLAN left.
+        """
+        if not self.is_remote_peer(peer_host, peer_ip):
+            return
+        if not self.tunnel:
+            LOG.warning(_("Cannot reach the peer of tunnel %(tunnel)s on "
+                          "%(host)s, tunneling is disabled"),
+                        {'tunnel': tunnel_id, 'host': peer_host})
+            return
+        cookie = ovsnetwork_reconcile.endpoint_cookie(bridge_name, tunnel_id)
+        try:
+            int_flows, tun_flows = self.tunnel.flows(cookie, tunnel_id,
+                                                     peer_tunnel_id, peer_ip)
+        except TunnelForwardingError as e:
+            LOG.error(_("Cannot forward tunnel %(tunnel)s of link %(link)s "
+                        "to %(host)s: %(error)s"),
+                      {'tunnel': tunnel_id, 'link': link_id,
+                       'host': peer_host, 'error': e})
+            raise
+        with self.flow_batch() as flows:
+            ovsnetwork_reconcile.add_flow_entries(flows, int_flows)
+        with self.flow_batch(self.tunnel.tun_br) as flows:
+            ovsnetwork_reconcile.add_flow_entries(flows, tun_flows)
+
+    def replace_endpoint_flows(self, ofport, old_bridge_name,
+                               old_peer_tunnel_id, bridge_name, tunnel_id, peer_tunnel_id,
+                               peer_host, peer_ip, link_id=None):
+        """Move a local endpoint to a new peer without dropping traffic.
+
+        The flows to the new peer are added first, flows whose match does
+        not change are replaced in place, and only then what is left of
+        the old flows is deleted, by exact match and old cookie.
+
+        :param ofport: br-int ofport of the endpoint, None when its
+                       local flows are not to be touched.
+        """
+        old_cookie = ovsnetwork_reconcile.cookie_match(
+            ovsnetwork_reconcile.endpoint_cookie(old_bridge_name, tunnel_id))
+        old_int_keys, old_tun_keys = set(), set()
+        if self.tunnel:
+            old_int_keys, old_tun_keys = self.tunnel.flow_keys(
+                tunnel_id, old_peer_tunnel_id)
+        new_int_keys, new_tun_keys = set(), set()
+        if ofport:
+            old_int_keys.update(ovsnetwork_reconcile.endpoint_flows(
+                ofport, old_bridge_name, tunnel_id, old_peer_tunnel_id))
+            local_flows = ovsnetwork_reconcile.endpoint_flows(
+                ofport, bridge_name, tunnel_id, peer_tunnel_id)
+            new_int_keys.update(local_flows)
+        with self.flow_batch() as flows:
+            if ofport:
+                ovsnetwork_reconcile.add_flow_entries(flows, local_flows)
+            self.add_peer_forwarding(bridge_name, tunnel_id, peer_tunnel_id,
+                                     peer_host, peer_ip, link_id=link_id)
+            remote = self.tunnel and self.is_remote_peer(peer_host, peer_ip)
+            if remote:
+                int_keys, tun_keys = self.tunnel.flow_keys(tunnel_id,
+                                                           peer_tunnel_id)
+                new_int_keys.update(int_keys)
+                new_tun_keys.update(tun_keys)
+            for table, match in old_int_keys - new_int_keys:
+                flows.delete_stale_flows(cookie=old_cookie, table=table,
+                                         **dict(match))
+            if old_tun_keys - new_tun_keys:
+                with self.flow_batch(self.tunnel.tun_br) as tun_flows:
+                    for table, match in old_tun_keys - new_tun_keys:
+                        tun_flows.delete_stale_flows(cookie=old_cookie,
+                                                     table=table,
+                                                     **dict(match))
+        if self.tunnel:
+            if not remote:
+                self.tunnel.release(tunnel_id, old_peer_tunnel_id)
+            elif int(old_peer_tunnel_id) != int(peer_tunnel_id):
+                self.tunnel.release(old_peer_tunnel_id)
+
+    def delete_peer_forwarding(self, bridge_name, tunnel_id, peer_tunnel_id):
+        """Undo add_peer_forwarding(), the local endpoint flows stay."""
+        if not self.tunnel or int(tunnel_id) not in self.tunnel.vlans:
+            return
+        cookie = ovsnetwork_reconcile.cookie_match(
+            ovsnetwork_reconcile.endpoint_cookie(bridge_name, tunnel_id))
+        with self.flow_batch() as flows:
+            flows.delete_flows(cookie=cookie, table='1', tun_id=tunnel_id)
+            if int(peer_tunnel_id) in self.tunnel.vlans:
+                flows.delete_flows(cookie=cookie, table='0',
+                                   in_port=self.tunnel.patch_tun_ofport,
+                                   dl_vlan=self.tunnel.vlans[int(peer_tunnel_id)])
+        with self.flow_batch(self.tunnel.tun_br) as flows:
+            flows.delete_flows(cookie=cookie)
+        self.tunnel.release(tunnel_id, peer_tunnel_id)
+
+    def reconcile(self, topology=None):
+        """Repair this host against the desired state.
+
+        :param topology: optional full topology of this host, replacing the
+                         recorded state. It is a dict of lists keyed by
+                         'ovs_networks', 'ovs_link_left_endpoints',
+                         'ovs_link_right_endpoints', 'ovs_links_direct',
+                         'vm_link_ovs_endpoints' and 'vm_link_vm_endpoints',
+                         the items being what the matching *_created
+                         callbacks receive.
+        :returns: dict counting the changes made, by kind.
+        """
+        if topology is not None:
+            self.desired = self.load_topology(topology)
+        return ovsnetwork_reconcile.Reconciler(self).reconcile(self.desired)
+
+    def load_topology(self, topology):
+        desired = ovsnetwork_reconcile.DesiredState()
+        for ovs_network in topology.get('ovs_networks', []):
+            self._record_ovs_network(desired, ovs_network)
+        for side in ('left', 'right'):
+            for ovs_link in topology.get('ovs_link_%s_endpoints' % side, []):
+                self._record_ovs_link_endpoint(desired, ovs_link, side)
+        for ovs_link in topology.get('ovs_links_direct', []):
+            self._record_ovs_link_direct(desired, ovs_link)
+        for vm_link in topology.get('vm_link_ovs_endpoints', []):
+            self._record_vm_link_ovs_endpoint(desired, vm_link)
+        for vm_link in topology.get('vm_link_vm_endpoints', []):
+            self._record_vm_link_vm_endpoint(desired, vm_link)
+        desired.complete = True
+        return desired
+
+    def _record_ovs_network(self, desired, ovs_network):
+        desired.set_bridge(
+            self.get_ovs_network_name_from_id(ovs_network['id']),
+            self.get_ovs_network_controller_name(ovs_network))
+
+    def _record_ovs_link_endpoint(self, desired, ovs_link, side):
+        peer = 'right' if side == 'left' else 'left'
+        olo_port, olb_port = self.get_ovs_link_pair_names(
+            ovs_link['%s_port_id' % side])
+        bridge_name = self.get_ovs_network_name_from_id(
+            ovs_link['%s_ovs_id' % side])
+        desired.add_endpoint(olb_port, bridge_name, olo_port,
+                             ovs_link['%s_tunnel_id' % side],
+                             ovs_link['%s_tunnel_id' % peer])
+        self._record_remote_peer(desired, bridge_name,
+                                 ovs_link['%s_tunnel_id' % side],
+                                 ovs_link['%s_tunnel_id' % peer],
+                                 ovs_link.get('%s_host' % peer),
+                                 ovs_link.get('%s_tunnel_ip' % peer))
+
+    def _record_ovs_link_direct(self, desired, ovs_link):
+        desired.add_direct_link(
+            self.get_ovs_link_pair_names(ovs_link['left_port_id'])[0],
+            self.get_ovs_network_name_from_id(ovs_link['left_ovs_id']),
+            self.get_ovs_link_pair_names(ovs_link['right_port_id'])[0],
+            self.get_ovs_network_name_from_id(ovs_link['right_ovs_id']))
+
+    def _record_vm_link_ovs_endpoint(self, desired, vm_link):
+        vlo_port, vlb_port = self.get_vm_link_ovs_endpoint_pair_names(
+            vm_link['ovs_port_id'])
+        bridge_name = self.get_ovs_network_name_from_id(
+            vm_link['ovs_network_id'])
+        desired.add_endpoint(vlb_port, bridge_name, vlo_port,
+                             vm_link['ovs_tunnel_id'], vm_link['vm_tunnel_id'])
+        self._record_remote_peer(desired, bridge_name,
+                                 vm_link['ovs_tunnel_id'],
+                                 vm_link['vm_tunnel_id'],
+                                 vm_link.get('vm_host'),
+                                 vm_link.get('vm_tunnel_ip'))
+
+    def _record_vm_link_vm_endpoint(self, desired, vm_link):
+        bridge_name = self.get_ovs_network_name_from_id(
+            vm_link['ovs_network_id'])
+        desired.add_vm_endpoint(vm_link['vm_ofport'], bridge_name,
+                                vm_link['vm_tunnel_id'],
+                                vm_link['ovs_tunnel_id'])
+        self._record_remote_peer(desired, bridge_name,
+                                 vm_link['vm_tunnel_id'],
+                                 vm_link['ovs_tunnel_id'],
+                                 vm_link.get('ovs_host'),
+                                 vm_link.get('ovs_tunnel_ip'))
+
+    def _record_remote_peer(self, desired, bridge_name, tunnel_id,
+                            peer_tunnel_id, peer_host, peer_ip):
+        if self.is_remote_peer(peer_host, peer_ip):
+            desired.add_remote_peer(bridge_name, tunnel_id, peer_tunnel_id,
+                                    peer_ip)
+        else:
+            desired.remove_remote_peer(bridge_name, tunnel_id)
+
+    def get_port_ofport(self, port_name):
+        return self.ovsdb.get_ofport(port_name)
+
     def get_ovs_network_name_from_id(self, id):
         ovs_network_name = 'ovs' + str(id)
         return ovs_network_name[:self.NIC_NAME_LEN]
@@ -36,28 +956,98 @@ class OVSNetworkDriver(object):
 
     def ovs_network_created(self, context, ovs_network):
         ovs_network_br = self.get_ovs_network_br(ovs_network['id'])
-        ovs_network_br.create()
         controller_name = self.get_ovs_network_controller_name(ovs_network)
-        if controller_name:
-            ovs_network_br.set_controller([controller_name])
+        self._record_ovs_network(self.desired, ovs_network)
+        bridge_name, tag = self.get_ovs_network_placement(ovs_network_br.br_name)
+        self.ovsdb.add_bridge(bridge_name, controller_name and [controller_name])
         LOG.info(_("OVS Network %s is created successfully, and it's controller is %s.\n"), ovs_network, controller_name)
 
     def ovs_network_updated(self, context, ovs_network):
         controller_name = self.get_ovs_network_controller_name(ovs_network)
         if controller_name:
             ovs_network_br = self.get_ovs_network_br(ovs_network['id'])
+            if self.get_ovs_network_placement(ovs_network_br.br_name, allocate=False)[1]:
+                self.move_to_dedicated_bridge(ovs_network)
+                return
             try:
-                if ovs_network_br.get_controller():
-                    ovs_network_br.del_controller()
+                if self.ovsdb.get_controller(ovs_network_br.br_name):
+                    self.ovsdb.del_controller(ovs_network_br.br_name)
             finally:
-                ovs_network_br.set_controller([controller_name])
+                self.ovsdb.set_controller(ovs_network_br.br_name, [controller_name])
+            self._record_ovs_network(self.desired, ovs_network)
             LOG.info(_("OVS Network %s is updated successfully, and it's controller is %s"), id, controller_name)
 
+    def move_to_dedicated_bridge(self, ovs_network):
+        """Move a shared ovs network which got a controller to its own bridge.
+
+        A controller owns a whole bridge. Its ports are removed from the
+        shared bridge along with its VLAN tag, and once its controller is
+        recorded the network is placed on its own bridge, where the
+        reconciler creates them again.
+        """
+        ovs_network_br = self.get_ovs_network_br(ovs_network['id'])
+        self.delete_shared_ports(ovs_network_br.br_name)
+        self._record_ovs_network(self.desired, ovs_network)
+        self.reconcile()
+        LOG.info(_("OVS Network %s is moved off the shared bridge to its own bridge with controller %s"), ovs_network['id'], self.get_ovs_network_controller_name(ovs_network))
+
     def ovs_network_deleted(self, context, id):
         ovs_network_br = self.get_ovs_network_br(id)
-        ovs_network_br.destroy()
+        if self.get_ovs_network_placement(ovs_network_br.br_name, allocate=False)[1]:
+            self.delete_shared_ports(ovs_network_br.br_name)
+        else:
+            self.ovsdb.del_bridge(ovs_network_br.br_name)
+        with self.flow_batch() as flows:
+            for cookie in self.desired.endpoint_cookies(ovs_network_br.br_name):
+                flows.delete_flows(cookie=ovsnetwork_reconcile.cookie_match(cookie))
+            for (bridge_name, tunnel_id), (peer_tunnel_id, _peer_ip) in self.desired.remote_peers.items():
+                if bridge_name == ovs_network_br.br_name:
+                    self.delete_peer_forwarding(bridge_name, tunnel_id, peer_tunnel_id)
+        self.desired.remove_bridge(ovs_network_br.br_name)
         LOG.info(_("OVS Network %s is deleted successfully."), id)
 
+    def delete_shared_ports(self, name):
+        """Remove what is left of an ovs network from the shared bridge.
+
+        Its VLAN tag is then free for another ovs network.
+        """
+        interfaces = self.ovsdb.snapshot()['interfaces']
+        ports = [port for port, interface in interfaces.items()
+                 if interface['external_ids'].get(SLICE_EXTERNAL_ID, '').startswith(name + ':')]
+        if ports:
+            self.ovsdb.del_ports([(self.shared_bridge, port) for port in ports])
+            if self.link_mode == 'veth':
+                self.veth.delete_links(ports)
+        self.network_tags.pop(name, None)
+
+    def get_endpoint_cookie(self, ovs_network_id, tunnel_id):
+        """Cookie of the br-int flows of an endpoint of an ovs network."""
+        return ovsnetwork_reconcile.endpoint_cookie(
+            self.get_ovs_network_name_from_id(ovs_network_id), tunnel_id)
+
+    def get_ovs_network_flows(self, ovs_network_id=None):
+        """Dump the br-int flows of one or, by default, all ovs networks."""
+        if ovs_network_id:
+            cookie = ovsnetwork_reconcile.cookie_match(
+                ovsnetwork_reconcile.network_cookie(
+                    self.get_ovs_network_name_from_id(ovs_network_id)),
+                ovsnetwork_reconcile.NETWORK_COOKIE_MASK)
+        else:
+            cookie = ovsnetwork_reconcile.cookie_match(
+                ovsnetwork_reconcile.COOKIE_TAG,
+                ovsnetwork_reconcile.COOKIE_TAG_MASK)
+        return self.executor.execute(['ovs-ofctl', 'dump-flows',
+                                      self.bridge.br_name,
+                                      'cookie=%s' % cookie])
+
+    def get_endpoint_counters(self):
+        """Traffic counters of the endpoints on this host by tunnel id.
+
+        Direct links have no br-int flows and are not counted.
+        """
+        return ovsnetwork_reconcile.parse_endpoint_counters(
+            self.get_ovs_network_flows())
+
     def get_ovs_link_pair_names(self, id):
         # veth pair names for ports of ovs link, 
         # olo is short for ovs link's port on ovs network side
@@ -66,66 +1056,132 @@ class OVSNetworkDriver(object):
                 ("olb%s" % id)[:self.NIC_NAME_LEN])
 
     def create_veth_pair_ports(self, name1, name2):
-        self.ip_wrapper.add_veth(name1, name2)
+        if self.veth_pool and self.veth_pool.take(name1, name2):
+            return
+        self.veth.add_veth_pairs([(name1, name2)])
+
+    def delete_veth_pair_ports(self, name):
+        # deleting one end of a veth pair removes its peer as well
+        self.veth.delete_links([name])
+
+    def get_endpoint_peers(self, ovs_port, int_port):
+        """Patch port peers of (ovs_port, int_port), None for veth ends."""
+        if self.link_mode == 'patch':
+            return int_port, ovs_port
+        return None, None
+
+    def plug_port_pair(self, br1, port1, br2, port2):
+        """Connect two bridges through port1 on br1 and port2 on br2.
+
+        In veth mode the veth pair is created first. Both ports and their
+        interface options go to OVSDB as a single transaction, see
+        get_port_pair_specs().
+        """
+        if self.link_mode == 'veth':
+            self.create_veth_pair_ports(port1, port2)
+        self.ovsdb.add_ports(self.get_port_pair_specs(br1.br_name, port1,
+                                                      br2.br_name, port2))
+
+    def unplug_port_pair(self, br1, port1, br2, port2):
+        """Remove both ports of a pair in one transaction."""
+        self.ovsdb.del_ports([
+            (self.get_ovs_network_placement(br1.br_name, allocate=False)[0], port1),
+            (self.get_ovs_network_placement(br2.br_name, allocate=False)[0], port2)])
+        if self.link_mode == 'veth':
+            self.delete_veth_pair_ports(port2)
+
+    def plug_endpoint_ports(self, ovs_network_br, ovs_port, int_port):
+        """Connect an ovs network bridge to br-int through an endpoint.
+
+        ovs-vswitchd only assigns the ofport once the ports are committed
+        to OVSDB, so it is read back afterwards.
+
+        :returns: ofport of int_port on br-int.
+        """
+        self.plug_port_pair(ovs_network_br, ovs_port, self.bridge, int_port)
+        return self.get_port_ofport(int_port)
+
+    def unplug_endpoint_ports(self, ovs_network_br, ovs_port, int_port):
+        self.unplug_port_pair(ovs_network_br, ovs_port, self.bridge, int_port)
 
     def ovs_link_left_endpoint_created(self, context, ovs_link):
         # create veth ports and add them to ovs bridges
         olo_port,olb_port = self.get_ovs_link_pair_names(ovs_link['left_port_id'])
-        self.create_veth_pair_ports(olo_port, olb_port)
         ovs_network_br = self.get_ovs_network_br(ovs_link['left_ovs_id'])
-        ovs_network_br.add_port(olo_port)
-        self.bridge.add_port(olb_port)
+        olb_ofport = self.plug_endpoint_ports(ovs_network_br, olo_port, olb_port)
         
-        # add flows 
-        # Improvement is needed to support multi compute nodes -- lijian
-        olb_ofport = self.bridge.get_port_ofport(olb_port)
-        self.bridge.add_flow(table='0', priority=10, in_port=olb_ofport, actions='set_tunnel:%s,resubmit(,1)'%ovs_link['left_tunnel_id'])
-        self.bridge.add_flow(table='1', priority=10, tun_id=ovs_link['right_tunnel_id'], actions='output:%s'%olb_ofport)
+        # add flows, and the br-tun ones when the peer is on another host
+        cookie = '0x%x' % self.get_endpoint_cookie(ovs_link['left_ovs_id'], ovs_link['left_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.add_flow(table='0', priority=10, cookie=cookie, in_port=olb_ofport, actions='set_tunnel:%s,resubmit(,1)'%ovs_link['left_tunnel_id'])
+            flows.add_flow(table='1', priority=10, cookie=cookie, tun_id=ovs_link['right_tunnel_id'], actions='output:%s'%olb_ofport)
+            self.add_peer_forwarding(ovs_network_br.br_name, ovs_link['left_tunnel_id'], ovs_link['right_tunnel_id'], ovs_link.get('right_host'), ovs_link.get('right_tunnel_ip'), link_id=ovs_link['id'])
+        self._record_ovs_link_endpoint(self.desired, ovs_link, 'left')
         LOG.info(_("Left endpoint of ovs link %s is created successfully.\n"), ovs_link)
 
     def ovs_link_right_endpoint_created(self, context, ovs_link):
         # create veth ports and add them to ovs bridges
         olo_port,olb_port = self.get_ovs_link_pair_names(ovs_link['right_port_id'])
-        self.create_veth_pair_ports(olo_port, olb_port)
         ovs_network_br = self.get_ovs_network_br(ovs_link['right_ovs_id'])
-        ovs_network_br.add_port(olo_port)
-        self.bridge.add_port(olb_port)
+        olb_ofport = self.plug_endpoint_ports(ovs_network_br, olo_port, olb_port)
         
-        # add flows 
-        # Improvement needed to support multi compute nodes -- lijian
-        olb_ofport = self.bridge.get_port_ofport(olb_port)
-        self.bridge.add_flow(table='0', priority=10, in_port=olb_ofport, actions='set_tunnel:%s,resubmit(,1)'%ovs_link['right_tunnel_id'])
-        self.bridge.add_flow(table='1', priority=10, tun_id=ovs_link['left_tunnel_id'], actions='output:%s'%olb_ofport)
+        # add flows, and the br-tun ones when the peer is on another host
+        cookie = '0x%x' % self.get_endpoint_cookie(ovs_link['right_ovs_id'], ovs_link['right_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.add_flow(table='0', priority=10, cookie=cookie, in_port=olb_ofport, actions='set_tunnel:%s,resubmit(,1)'%ovs_link['right_tunnel_id'])
+            flows.add_flow(table='1', priority=10, cookie=cookie, tun_id=ovs_link['left_tunnel_id'], actions='output:%s'%olb_ofport)
+            self.add_peer_forwarding(ovs_network_br.br_name, ovs_link['right_tunnel_id'], ovs_link['left_tunnel_id'], ovs_link.get('left_host'), ovs_link.get('left_tunnel_ip'), link_id=ovs_link['id'])
+        self._record_ovs_link_endpoint(self.desired, ovs_link, 'right')
         LOG.info(_("Right endpoint of ovs link %s is created successfully.\n"), ovs_link)
 
     def ovs_link_left_endpoint_deleted(self, context, ovs_link):
         olo_port,olb_port = self.get_ovs_link_pair_names(ovs_link['left_port_id'])
-        olb_ofport = self.bridge.get_port_ofport(olb_port)
         ovs_network_br = self.get_ovs_network_br(ovs_link['left_ovs_id'])
-        ovs_network_br.delete_port(olo_port)
-        self.bridge.delete_port(olb_port)
-        ip_link_device = ip_lib.IPDevice(olb_port, root_helper=self.root_helper)
-        ip_link_device.link.delete()
+        self.unplug_endpoint_ports(ovs_network_br, olo_port, olb_port)
        
         #delete flows       
-        self.bridge.delete_flows(table='0', in_port=olb_ofport)
-        self.bridge.delete_flows(table='1', tun_id=ovs_link['right_tunnel_id'])
+        cookie = self.get_endpoint_cookie(ovs_link['left_ovs_id'], ovs_link['left_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.delete_flows(cookie=ovsnetwork_reconcile.cookie_match(cookie))
+            self.delete_peer_forwarding(ovs_network_br.br_name, ovs_link['left_tunnel_id'], ovs_link['right_tunnel_id'])
+        self.desired.remove_endpoint(olb_port)
+        self.desired.remove_remote_peer(ovs_network_br.br_name, ovs_link['left_tunnel_id'])
         LOG.info(_("Left endpoint of ovs link %s is deleted successfully.\n"), ovs_link)
 
     def ovs_link_right_endpoint_deleted(self, context, ovs_link):
         olo_port,olb_port = self.get_ovs_link_pair_names(ovs_link['right_port_id'])
-        olb_ofport = self.bridge.get_port_ofport(olb_port)
         ovs_network_br = self.get_ovs_network_br(ovs_link['right_ovs_id'])
-        ovs_network_br.delete_port(olo_port)
-        self.bridge.delete_port(olb_port)
-        ip_link_device = ip_lib.IPDevice(olb_port, root_helper=self.root_helper)
-        ip_link_device.link.delete()
+        self.unplug_endpoint_ports(ovs_network_br, olo_port, olb_port)
        
         #delete flows       
-        self.bridge.delete_flows(table='0', in_port=olb_ofport)
-        self.bridge.delete_flows(table='1', tun_id=ovs_link['left_tunnel_id'])
+        cookie = self.get_endpoint_cookie(ovs_link['right_ovs_id'], ovs_link['right_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.delete_flows(cookie=ovsnetwork_reconcile.cookie_match(cookie))
+            self.delete_peer_forwarding(ovs_network_br.br_name, ovs_link['right_tunnel_id'], ovs_link['left_tunnel_id'])
+        self.desired.remove_endpoint(olb_port)
+        self.desired.remove_remote_peer(ovs_network_br.br_name, ovs_link['right_tunnel_id'])
         LOG.info(_("Right endpoint of ovs link %s is deleted successfully.\n"), ovs_link)
   
+    def ovs_link_direct_created(self, context, ovs_link):
+        # both ovs networks are on this host, one pair connects their
+        # bridges and br-int is not involved
+        left_port = self.get_ovs_link_pair_names(ovs_link['left_port_id'])[0]
+        right_port = self.get_ovs_link_pair_names(ovs_link['right_port_id'])[0]
+        left_br = self.get_ovs_network_br(ovs_link['left_ovs_id'])
+        right_br = self.get_ovs_network_br(ovs_link['right_ovs_id'])
+        self.plug_port_pair(left_br, left_port, right_br, right_port)
+        self._record_ovs_link_direct(self.desired, ovs_link)
+        LOG.info(_("Direct ovs link %s is created successfully.\n"), ovs_link)
+
+    def ovs_link_direct_deleted(self, context, ovs_link):
+        left_port = self.get_ovs_link_pair_names(ovs_link['left_port_id'])[0]
+        right_port = self.get_ovs_link_pair_names(ovs_link['right_port_id'])[0]
+        left_br = self.get_ovs_network_br(ovs_link['left_ovs_id'])
+        right_br = self.get_ovs_network_br(ovs_link['right_ovs_id'])
+        self.unplug_port_pair(left_br, left_port, right_br, right_port)
+        self.desired.remove_direct_link(left_port)
+        LOG.info(_("Direct ovs link %s is deleted successfully.\n"), ovs_link)
+
     def get_vm_link_ovs_endpoint_pair_names(self, id):
         return (("vlo%s" % id)[:self.NIC_NAME_LEN],
                 ("vlb%s" % id)[:self.NIC_NAME_LEN])
@@ -135,44 +1191,65 @@ class OVSNetworkDriver(object):
 
     def vm_link_ovs_endpoint_created(self, context, vm_link):
         vlo_port,vlb_port  = self.get_vm_link_ovs_endpoint_pair_names(vm_link['ovs_port_id'])
-        self.create_veth_pair_ports(vlo_port, vlb_port)
         ovs_network_br = self.get_ovs_network_br(vm_link['ovs_network_id'])
-        ovs_network_br.add_port(vlo_port)
-        self.bridge.add_port(vlb_port)
+        vlb_ofport = self.plug_endpoint_ports(ovs_network_br, vlo_port, vlb_port)
 
-        vlb_ofport = self.bridge.get_port_ofport(vlb_port)
-        self.bridge.add_flow(table='0', priority=10, in_port=vlb_ofport, actions='set_tunnel:%s,resubmit(,1)'%vm_link['ovs_tunnel_id'])
-        self.bridge.add_flow(table='1', priority=10, tun_id=vm_link['vm_tunnel_id'], actions='output:%s'%vlb_ofport)
+        cookie = '0x%x' % self.get_endpoint_cookie(vm_link['ovs_network_id'], vm_link['ovs_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.add_flow(table='0', priority=10, cookie=cookie, in_port=vlb_ofport, actions='set_tunnel:%s,resubmit(,1)'%vm_link['ovs_tunnel_id'])
+            flows.add_flow(table='1', priority=10, cookie=cookie, tun_id=vm_link['vm_tunnel_id'], actions='output:%s'%vlb_ofport)
+            self.add_peer_forwarding(ovs_network_br.br_name, vm_link['ovs_tunnel_id'], vm_link['vm_tunnel_id'], vm_link.get('vm_host'), vm_link.get('vm_tunnel_ip'), link_id=vm_link['id'])
+        self._record_vm_link_ovs_endpoint(self.desired, vm_link)
         LOG.info(_("OVS endpoint of vm link %s is created successfully.\n"), vm_link)
 
+    def vm_link_ovs_endpoint_updated(self, context, vm_link):
+        # the vm endpoint was bound to a host, which may not be this one
+        ovs_network_name = self.get_ovs_network_name_from_id(vm_link['ovs_network_id'])
+        self.replace_endpoint_flows(None, ovs_network_name, vm_link['vm_tunnel_id'], ovs_network_name, vm_link['ovs_tunnel_id'], vm_link['vm_tunnel_id'], vm_link.get('vm_host'), vm_link.get('vm_tunnel_ip'), link_id=vm_link['id'])
+        self._record_vm_link_ovs_endpoint(self.desired, vm_link)
+        LOG.info(_("OVS endpoint of vm link %s is updated successfully.\n"), vm_link)
+
     def vm_link_ovs_endpoint_deleted(self, context, vm_link):
         vlo_port,vlb_port = self.get_vm_link_ovs_endpoint_pair_names(vm_link['ovs_port_id'])
-        vlb_ofport = self.bridge.get_port_ofport(vlb_port)
         ovs_network_br = self.get_ovs_network_br(vm_link['ovs_network_id'])
-        ovs_network_br.delete_port(vlo_port)
-        self.bridge.delete_port(vlb_port)
-        ip_link_device = ip_lib.IPDevice(vlb_port, root_helper=self.root_helper)
-        ip_link_device.link.delete()
+        self.unplug_endpoint_ports(ovs_network_br, vlo_port, vlb_port)
        
         #delete flows       
-        self.bridge.delete_flows(table='0', in_port=vlb_ofport)
-        self.bridge.delete_flows(table='1', tun_id=vm_link['vm_tunnel_id'])
+        cookie = self.get_endpoint_cookie(vm_link['ovs_network_id'], vm_link['ovs_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.delete_flows(cookie=ovsnetwork_reconcile.cookie_match(cookie))
+            self.delete_peer_forwarding(ovs_network_br.br_name, vm_link['ovs_tunnel_id'], vm_link['vm_tunnel_id'])
+        self.desired.remove_endpoint(vlb_port)
+        self.desired.remove_remote_peer(ovs_network_br.br_name, vm_link['ovs_tunnel_id'])
         LOG.info(_("OVS endpoint of vm link %s is deleted successfully.\n"), vm_link)
 
     def vm_link_vm_endpoint_created(self, context, vm_link):
         vlb_ofport = vm_link['vm_ofport']
-        self.bridge.add_flow(table='0', priority=10, in_port=vlb_ofport, actions='set_tunnel:%s,resubmit(,1)'%vm_link['vm_tunnel_id'])
-        self.bridge.add_flow(table='1', priority=10, tun_id=vm_link['ovs_tunnel_id'], actions='output:%s'%vlb_ofport)
+        cookie = '0x%x' % self.get_endpoint_cookie(vm_link['ovs_network_id'], vm_link['vm_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.add_flow(table='0', priority=10, cookie=cookie, in_port=vlb_ofport, actions='set_tunnel:%s,resubmit(,1)'%vm_link['vm_tunnel_id'])
+            flows.add_flow(table='1', priority=10, cookie=cookie, tun_id=vm_link['ovs_tunnel_id'], actions='output:%s'%vlb_ofport)
+            self.add_peer_forwarding(self.get_ovs_network_name_from_id(vm_link['ovs_network_id']), vm_link['vm_tunnel_id'], vm_link['ovs_tunnel_id'], vm_link.get('ovs_host'), vm_link.get('ovs_tunnel_ip'), link_id=vm_link['id'])
+        self._record_vm_link_vm_endpoint(self.desired, vm_link)
         LOG.info(_("VM endpoint of vm link %s is Created successfully.\n"), vm_link)
 
     def vm_link_vm_endpoint_updated(self, context, vm_link):
         vlb_ofport = vm_link['vm_ofport']
-        self.bridge.delete_flows(table='1', tun_id=vm_link['old_ovs_tunnel_id'])
-        self.bridge.add_flow(table='1', tun_id=vm_link['ovs_tunnel_id'], actions='output:%s'%vlb_ofport)
+        # the endpoint may have moved to another ovs network, possibly on
+        # another host, its flows are replaced so that they carry the new
+        # cookie without a gap in the traffic
+        old_ovs_network_name = self.get_ovs_network_name_from_id(vm_link.get('old_ovs_network_id', vm_link['ovs_network_id']))
+        self.replace_endpoint_flows(vlb_ofport, old_ovs_network_name, vm_link['old_ovs_tunnel_id'], self.get_ovs_network_name_from_id(vm_link['ovs_network_id']), vm_link['vm_tunnel_id'], vm_link['ovs_tunnel_id'], vm_link.get('ovs_host'), vm_link.get('ovs_tunnel_ip'), link_id=vm_link['id'])
+        self.desired.remove_remote_peer(old_ovs_network_name, vm_link['vm_tunnel_id'])
+        self._record_vm_link_vm_endpoint(self.desired, vm_link)
         LOG.info(_("VM endpoint of vm link %s is updated successfully.\n"), vm_link)
 
     def vm_link_vm_endpoint_deleted(self, context, vm_link):
         vlb_ofport = vm_link['vm_ofport']
-        self.bridge.delete_flows(table='0', in_port=vlb_ofport)
-        self.bridge.delete_flow(table='1', tun_id=vm_link['ovs_tunnel_id'])
-        LOG.info(_("VM endpoint of vm link %s is updated successfully.\n"), vm_link)
+        cookie = self.get_endpoint_cookie(vm_link['ovs_network_id'], vm_link['vm_tunnel_id'])
+        with self.flow_batch() as flows:
+            flows.delete_flows(cookie=ovsnetwork_reconcile.cookie_match(cookie))
+            self.delete_peer_forwarding(self.get_ovs_network_name_from_id(vm_link['ovs_network_id']), vm_link['vm_tunnel_id'], vm_link['ovs_tunnel_id'])
+        self.desired.remove_vm_endpoint(vlb_ofport)
+        self.desired.remove_remote_peer(self.get_ovs_network_name_from_id(vm_link['ovs_network_id']), vm_link['vm_tunnel_id'])
+        LOG.info(_("VM endpoint of vm link %s is deleted successfully.\n"), vm_link)
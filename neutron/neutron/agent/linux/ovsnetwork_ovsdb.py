@@ -0,0 +1,490 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# Native OVSDB backend of the ovs network driver, it talks the OVSDB
+# JSON-RPC protocol (RFC 7047) to ovsdb-server instead of forking ovs-vsctl.
+
+import itertools
+import socket
+
+import eventlet
+from eventlet import event
+from oslo.config import cfg
+
+from neutron.common import exceptions
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+ovsdb_opts = [
+    cfg.StrOpt('ovsdb_connection',
+               default='unix:/var/run/openvswitch/db.sock',
+               help=_('OVSDB server the native backend connects to. The '
+                      'agent must be allowed to open this socket.')),
+    cfg.IntOpt('ovsdb_timeout', default=10,
+               help=_('Seconds to wait for an OVSDB request to complete.')),
+]
+cfg.CONF.register_opts(ovsdb_opts, 'OVSNETWORK')
+
+OVSDB_DB = 'Open_vSwitch'
+
+# columns replicated in memory, everything the driver reads
+MONITORED_TABLES = {
+    'Open_vSwitch': ['bridges'],
+    'Bridge': ['name', 'ports', 'controller'],
+    'Port': ['name', 'interfaces'],
+    'Interface': ['name', 'type', 'ofport', 'external_ids'],
+    'Controller': ['target'],
+}
+
+
+class OVSDBError(exceptions.NeutronException):
+    message = _("OVSDB request failed: %(error)s")
+
+
+def from_json(value):
+    """Convert an OVSDB datum to python values.
+
+    uuids become strings, sets become lists and maps become dicts.
+    """
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind in ('uuid', 'named-uuid'):
+            return data
+        if kind == 'set':
+            return [from_json(v) for v in data]
+        if kind == 'map':
+            return dict((from_json(k), from_json(v)) for k, v in data)
+    return value
+
+
+def as_list(value):
+    # a set with exactly one element is encoded as the bare element
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def uuid_set(uuids, named=False):
+    kind = 'named-uuid' if named else 'uuid'
+    return ['set', [[kind, uuid] for uuid in uuids]]
+
+
+def ovs_map(values):
+    return ['map', [[k, v] for k, v in sorted(values.items())]]
+
+
+def make_snapshot(bridges, ports, controllers, interfaces):
+    """Summarize OVSDB rows for the ovs network reconciler.
+
+    :param bridges: Bridge rows with name, ports and controller.
+    :param ports: Port rows with a name, by uuid.
+    :param controllers: Controller rows with a target, by uuid.
+    :param interfaces: Interface rows with name, type, ofport and
+                       external_ids.
+    :returns: {'bridges': {name: {'controller': [target], 'ports': set}},
+               'interfaces': {name: {'type': type,
+                                     'ofport': ofport or None,
+                                     'external_ids': dict}}}
+    """
+    snapshot = {'bridges': {}, 'interfaces': {}}
+    for row in bridges:
+        snapshot['bridges'][row['name']] = {
+            'controller': [controllers[uuid]['target']
+                           for uuid in as_list(row.get('controller', []))
+                           if uuid in controllers],
+            'ports': set(ports[uuid]['name']
+                         for uuid in as_list(row.get('ports', []))
+                         if uuid in ports)}
+    for row in interfaces:
+        ofport = row.get('ofport')
+        snapshot['interfaces'][row['name']] = {
+            'type': row.get('type') or '',
+            'ofport': ofport if isinstance(ofport, int) and ofport > 0
+            else None,
+            'external_ids': row.get('external_ids') or {}}
+    return snapshot
+
+
+class JsonStreamParser(object):
+    """Split a stream of concatenated JSON texts into messages.
+
+    OVSDB does not delimit its messages, so the parser tracks the nesting
+    depth outside of strings and cuts a message when it drops back to 0.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, data):
+        messages = []
+        offset = len(self.buffer)
+        self.buffer += data
+        start = 0
+        for i in xrange(offset, len(self.buffer)):
+            c = self.buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == '\\':
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c in '{[':
+                self.depth += 1
+            elif c in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    messages.append(jsonutils.loads(self.buffer[start:i + 1]))
+                    start = i + 1
+        self.buffer = self.buffer[start:]
+        return messages
+
+
+class OVSDBConnection(object):
+    """A JSON-RPC connection to ovsdb-server.
+
+    A reader greenthread answers the server's echo requests, hands
+    'update' notifications to update_cb and wakes up the callers waiting
+    for a reply.
+    """
+
+    def __init__(self, connection, timeout, update_cb=None):
+        self.connection = connection
+        self.timeout = timeout
+        self.update_cb = update_cb
+        self.sock = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self):
+        kind, _sep, address = self.connection.partition(':')
+        if kind != 'unix':
+            raise OVSDBError(error=_("unsupported connection %s") %
+                             self.connection)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except socket.error as e:
+            sock.close()
+            raise OVSDBError(error=_("cannot connect to %(conn)s: %(e)s") %
+                             {'conn': self.connection, 'e': e})
+        self.sock = sock
+        eventlet.spawn_n(self._read_loop, sock)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self._disconnected(self.sock)
+
+    def _send(self, msg):
+        self.sock.sendall(jsonutils.dumps(msg))
+
+    def call(self, method, params, reply_cb=None):
+        """Send a request and wait for its result.
+
+        :param reply_cb: called with the result by the reader, before it
+                         reads any later message, e.g. to apply the rows
+                         of a monitor reply before the updates following
+                         it.
+        """
+        if not self.connected:
+            raise OVSDBError(error=_("not connected"))
+        msg_id = next(self._ids)
+        waiter = event.Event()
+        self._pending[msg_id] = (waiter, reply_cb)
+        try:
+            self._send({'method': method, 'params': params, 'id': msg_id})
+            with eventlet.Timeout(self.timeout, OVSDBError(
+                    error=_("timeout waiting for %s reply") % method)):
+                reply = waiter.wait()
+        finally:
+            self._pending.pop(msg_id, None)
+        if reply.get('error'):
+            raise OVSDBError(error=reply['error'])
+        return reply['result']
+
+    def _read_loop(self, sock):
+        parser = JsonStreamParser()
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            for msg in parser.feed(data):
+                self._dispatch(msg)
+        self._disconnected(sock)
+
+    def _dispatch(self, msg):
+        method = msg.get('method')
+        if method == 'echo':
+            self._send({'result': msg['params'], 'error': None,
+                        'id': msg['id']})
+        elif method == 'update':
+            if self.update_cb:
+                self.update_cb(msg['params'][1])
+        elif msg.get('id') in self._pending:
+            waiter, reply_cb = self._pending[msg['id']]
+            if reply_cb and not msg.get('error'):
+                reply_cb(msg['result'])
+            waiter.send(msg)
+
+    def _disconnected(self, sock):
+        if self.sock is not sock:
+            return
+        LOG.warning(_("Connection to OVSDB %s closed"), self.connection)
+        self.sock = None
+        for waiter, _reply_cb in self._pending.values():
+            if not waiter.ready():
+                waiter.send({'error': 'connection closed'})
+
+
+class NativeOVSDBBackend(object):
+    """OVSDB access of the ovs network driver over one JSON-RPC connection.
+
+    Bridge, Port, Interface and Controller rows are replicated in memory
+    through an OVSDB monitor, so reads never leave the process, and every
+    write is a single 'transact' request. The connection is (re)opened
+    lazily, which also resynchronizes the replica.
+    """
+
+    def __init__(self, connection=None, timeout=None):
+        self.connection = connection or cfg.CONF.OVSNETWORK.ovsdb_connection
+        self.timeout = timeout or cfg.CONF.OVSNETWORK.ovsdb_timeout
+        self.conn = None
+        self.tables = {}
+        self.names = {}
+        self._changed = event.Event()
+
+    def start(self):
+        self._ensure_connected()
+
+    def stop(self):
+        if self.conn:
+            self.conn.close()
+
+    def _ensure_connected(self):
+        if self.conn and self.conn.connected:
+            return
+        self.tables = dict((table, {}) for table in MONITORED_TABLES)
+        self.names = dict((table, {}) for table in MONITORED_TABLES)
+        self.conn = OVSDBConnection(self.connection, self.timeout,
+                                    self._apply_updates)
+        self.conn.connect()
+        requests = dict((table, {'columns': columns})
+                        for table, columns in MONITORED_TABLES.items())
+        # the initial rows go in before the updates which follow them
+        self.conn.call('monitor', [OVSDB_DB, None, requests],
+                       reply_cb=self._apply_updates)
+        LOG.debug(_("Connected to OVSDB %s"), self.connection)
+
+    def _apply_updates(self, updates):
+        for table, rows in updates.items():
+            replica = self.tables.setdefault(table, {})
+            names = self.names.setdefault(table, {})
+            for uuid, change in rows.items():
+                old = replica.pop(uuid, {})
+                names.pop(old.get('name'), None)
+                new = change.get('new')
+                if new is None:
+                    continue
+                old.update((column, from_json(value))
+                           for column, value in new.items())
+                replica[uuid] = old
+                if 'name' in old:
+                    names[old['name']] = uuid
+        changed, self._changed = self._changed, event.Event()
+        changed.send()
+
+    def wait_for(self, predicate, what):
+        """Wait until predicate() holds on the replica and return it."""
+        with eventlet.Timeout(self.timeout, OVSDBError(
+                error=_("timeout waiting for %s") % what)):
+            while True:
+                result = predicate()
+                if result:
+                    return result
+                self._changed.wait()
+
+    def _lookup(self, table, name):
+        uuid = self.names.get(table, {}).get(name)
+        if uuid:
+            return uuid, self.tables[table][uuid]
+        return None, None
+
+    def transact(self, ops):
+        self._ensure_connected()
+        if not ops:
+            return []
+        results = self.conn.call('transact', [OVSDB_DB] + ops)
+        for result in results:
+            if result and 'error' in result:
+                raise OVSDBError(error='%s: %s' % (result['error'],
+                                                   result.get('details', '')))
+        return results
+
+    def bridge_exists(self, name):
+        self._ensure_connected()
+        return self._lookup('Bridge', name)[0] is not None
+
+    def add_bridge(self, name, controllers=None):
+        """Add a bridge and set its controllers in one transaction."""
+        if self.bridge_exists(name):
+            if controllers:
+                self.set_controller(name, controllers)
+            return
+        ops = []
+        names = []
+        for i, target in enumerate(controllers or []):
+            names.append('controller%d' % i)
+            ops.append({'op': 'insert', 'table': 'Controller',
+                        'uuid-name': names[-1], 'row': {'target': target}})
+        self.transact(ops + [
+            {'op': 'insert', 'table': 'Interface', 'uuid-name': 'iface',
+             'row': {'name': name, 'type': 'internal'}},
+            {'op': 'insert', 'table': 'Port', 'uuid-name': 'port',
+             'row': {'name': name, 'interfaces': ['named-uuid', 'iface']}},
+            {'op': 'insert', 'table': 'Bridge', 'uuid-name': 'bridge',
+             'row': {'name': name, 'ports': ['named-uuid', 'port'],
+                     'controller': uuid_set(names, named=True)}},
+            {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+             'mutations': [['bridges', 'insert',
+                            uuid_set(['bridge'], named=True)]]}])
+
+    def del_bridge(self, name):
+        self._ensure_connected()
+        uuid, _row = self._lookup('Bridge', name)
+        if not uuid:
+            return
+        # ports, interfaces and controllers are garbage collected with it
+        self.transact([
+            {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+             'mutations': [['bridges', 'delete', uuid_set([uuid])]]}])
+
+    def get_controller(self, bridge):
+        self._ensure_connected()
+        _uuid, row = self._lookup('Bridge', bridge)
+        if not row:
+            return []
+        controllers = self.tables['Controller']
+        return [controllers[uuid]['target']
+                for uuid in as_list(row.get('controller', []))
+                if uuid in controllers]
+
+    def set_controller(self, bridge, targets):
+        ops = []
+        names = []
+        for i, target in enumerate(targets):
+            names.append('controller%d' % i)
+            ops.append({'op': 'insert', 'table': 'Controller',
+                        'uuid-name': names[-1], 'row': {'target': target}})
+        ops.append({'op': 'update', 'table': 'Bridge',
+                    'where': self._bridge_where(bridge),
+                    'row': {'controller': uuid_set(names, named=True)}})
+        self.transact(ops)
+
+    def del_controller(self, bridge):
+        self.transact([{'op': 'update', 'table': 'Bridge',
+                        'where': self._bridge_where(bridge),
+                        'row': {'controller': uuid_set([])}}])
+
+    def _bridge_where(self, bridge):
+        self._ensure_connected()
+        uuid, _row = self._lookup('Bridge', bridge)
+        if not uuid:
+            raise OVSDBError(error=_("no bridge named %s") % bridge)
+        return [['_uuid', '==', ['uuid', uuid]]]
+
+    def add_ports(self, ports):
+        """Add ports in one transaction.
+
+        :param ports: (bridge, port, external_ids, peer, tag) tuples, a
+                      port with a peer is a patch port to it, one with a
+                      tag an access port of that VLAN. Ports that already
+                      exist are left untouched.
+        """
+        self._ensure_connected()
+        ops = []
+        for i, (bridge, port, external_ids, peer, tag) in enumerate(ports):
+            if self._lookup('Port', port)[0]:
+                continue
+            iface, port_row = 'iface%d' % i, 'port%d' % i
+            row = {'name': port, 'external_ids': ovs_map(external_ids or {})}
+            if peer:
+                row.update(type='patch', options=ovs_map({'peer': peer}))
+            ops.append({'op': 'insert', 'table': 'Interface',
+                        'uuid-name': iface, 'row': row})
+            port_columns = {'name': port, 'interfaces': ['named-uuid', iface]}
+            if tag:
+                port_columns['tag'] = tag
+            ops.append({'op': 'insert', 'table': 'Port',
+                        'uuid-name': port_row, 'row': port_columns})
+            ops.append({'op': 'mutate', 'table': 'Bridge',
+                        'where': self._bridge_where(bridge),
+                        'mutations': [['ports', 'insert',
+                                       uuid_set([port_row], named=True)]]})
+        self.transact(ops)
+
+    def del_ports(self, ports):
+        """Delete (bridge, port) pairs in one transaction."""
+        self._ensure_connected()
+        ops = []
+        for bridge, port in ports:
+            bridge_uuid, _row = self._lookup('Bridge', bridge)
+            port_uuid, _row = self._lookup('Port', port)
+            if not bridge_uuid or not port_uuid:
+                continue
+            ops.append({'op': 'mutate', 'table': 'Bridge',
+                        'where': [['_uuid', '==', ['uuid', bridge_uuid]]],
+                        'mutations': [['ports', 'delete',
+                                       uuid_set([port_uuid])]]})
+        self.transact(ops)
+
+    def snapshot(self):
+        self._ensure_connected()
+        return make_snapshot(self.tables['Bridge'].values(),
+                             self.tables['Port'],
+                             self.tables['Controller'],
+                             self.tables['Interface'].values())
+
+    def get_ofport(self, name):
+        """Return the ofport of an interface, None if it does not exist.
+
+        ovs-vswitchd assigns the ofport of a new interface shortly after
+        it is committed, so wait for it to show up in the replica. Like
+        ovs-vsctl, -1 is returned for an interface vswitchd failed to add.
+        """
+        self._ensure_connected()
+        if not self._lookup('Interface', name)[0]:
+            return None
+
+        def _ofport():
+            _uuid, row = self._lookup('Interface', name)
+            # an unassigned ofport is an empty set
+            ofport = row and row.get('ofport')
+            if isinstance(ofport, int):
+                return ofport
+        return self.wait_for(_ofport, _("ofport of %s") % name)
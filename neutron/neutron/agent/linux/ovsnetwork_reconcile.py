@@ -0,0 +1,482 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# Desired state of the ovs network driver on this host and the reconciler
+# bringing bridges, veth pairs and br-int flows back in line with it from
+# one OVSDB snapshot and one dump-flows.
+
+import re
+import zlib
+
+from neutron.agent.linux import ovsnetwork_netlink
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# bridges are named 'ovs' followed by the start of the ovs network id
+BRIDGE_NAME_RE = re.compile(r'^ovs[0-9a-f-]+$')
+
+# endpoint interfaces are tagged with the ovs network bridge they serve
+ENDPOINT_EXTERNAL_ID = 'ovs-network'
+
+FLOW_PRIORITY = '10'
+
+# Every flow of an endpoint carries the cookie
+#     8 bit tag | 24 bit hash of the ovs network bridge | 32 bit tunnel key
+# where the tunnel key is the one the endpoint sets on its traffic, so the
+# flows of an endpoint, of an ovs network or of all ovs networks can be
+# matched with a cookie mask. The hash of two bridges may be the same, so
+# only the cookie of an endpoint is unique and flows are deleted by it.
+COOKIE_TAG = 0x4f << 56
+COOKIE_TAG_MASK = 0xff << 56
+NETWORK_COOKIE_MASK = COOKIE_TAG_MASK | (0xffffff << 32)
+ENDPOINT_COOKIE_MASK = 0xffffffffffffffff
+
+
+def network_cookie(bridge):
+    return COOKIE_TAG | ((zlib.crc32(bridge) & 0xffffff) << 32)
+
+
+def endpoint_cookie(bridge, tunnel_id):
+    return network_cookie(bridge) | (int(tunnel_id) & 0xffffffff)
+
+
+def cookie_match(cookie, mask=ENDPOINT_COOKIE_MASK):
+    """The cookie=value/mask match of ovs-ofctl del-flows and dump-flows."""
+    return '0x%x/0x%x' % (cookie, mask)
+
+
+# fields of dump-flows output which are not part of the match
+FLOW_STAT_FIELDS = ('cookie', 'duration', 'table', 'n_packets', 'n_bytes',
+                    'idle_age', 'hard_age', 'priority', 'idle_timeout',
+                    'hard_timeout', 'send_flow_rem')
+DEFAULT_PRIORITY = '32768'
+
+ENDPOINT_COUNTERS = ('rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes')
+
+
+def _int(value):
+    try:
+        return int(value, 0) if isinstance(value, basestring) else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _value(value):
+    number = _int(value)
+    return value if number is None else number
+
+
+def _normalize_actions(actions):
+    # dump-flows prints tunnel ids in hex
+    return re.sub(r'set_tunnel:(\w+)',
+                  lambda m: 'set_tunnel:%d' % _int(m.group(1)), actions)
+
+
+def flow_entry(table, priority, cookie, actions, **match):
+    """Describe a flow the way parse_flows() does.
+
+    :returns: ((table, match), (priority, cookie, actions)), the key being
+              what a delete of the flow matches on.
+    """
+    match = tuple(sorted((field, _value(str(value)))
+                         for field, value in match.items()))
+    return ((str(table), match),
+            (str(priority), cookie, _normalize_actions(actions)))
+
+
+def add_flow_entries(batch, entries):
+    for (table, match), (priority, cookie, actions) in entries.items():
+        batch.add_flow(table=table, priority=priority,
+                       cookie='0x%x' % cookie, actions=actions,
+                       **dict(match))
+
+
+def endpoint_flows(ofport, bridge, tunnel_id, peer_tunnel_id):
+    """The table 0/1 flows of an endpoint port on br-int."""
+    cookie = endpoint_cookie(bridge, tunnel_id)
+    return dict([
+        flow_entry('0', FLOW_PRIORITY, cookie,
+                   'set_tunnel:%s,resubmit(,1)' % tunnel_id, in_port=ofport),
+        flow_entry('1', FLOW_PRIORITY, cookie, 'output:%s' % ofport,
+                   tun_id=peer_tunnel_id)])
+
+
+def _dump_entries(dump):
+    """Yield the (fields, actions) of every flow in dump-flows output."""
+    for line in dump.splitlines():
+        if ' actions=' not in line:
+            continue
+        match, actions = line.strip().split(' actions=', 1)
+        fields = {}
+        for item in match.replace(', ', ',').split(','):
+            key, _sep, value = item.partition('=')
+            fields[key] = value
+        yield fields, actions
+
+
+def parse_flows(dump, legacy=False):
+    """Extract the ovs network flows from the output of dump-flows.
+
+    Those are the flows tagged with COOKIE_TAG and, with legacy set, the
+    br-int flows installed before cookies were used: the table 0 flows
+    resubmitting to table 1, and table 1.
+    """
+    flows = {}
+    for fields, actions in _dump_entries(dump):
+        table = fields.get('table')
+        cookie = _int(fields.get('cookie')) or 0
+        if cookie & COOKIE_TAG_MASK != COOKIE_TAG:
+            if not legacy:
+                continue
+            if not ((table == '0' and 'resubmit(,1)' in actions and
+                     'in_port' in fields) or table == '1'):
+                continue
+        match = tuple(sorted((field, _value(value))
+                             for field, value in fields.items()
+                             if field and field not in FLOW_STAT_FIELDS))
+        flows[(table, match)] = (fields.get('priority', DEFAULT_PRIORITY),
+                                 cookie, _normalize_actions(actions))
+    return flows
+
+
+def parse_endpoint_counters(dump):
+    """Sum the counters of the endpoint flows in dump-flows output.
+
+    tx counts what an endpoint sends into its link, on the table 0 flow
+    tagging its own tunnel id, rx what it receives, on the table 1 flows
+    matching the peer's. The flows forwarding to and from br-tun carry the
+    endpoint cookie too and are left out, so nothing is counted twice.
+
+    :returns: {tunnel id: {counter: value}} with ENDPOINT_COUNTERS.
+    """
+    counters = {}
+    for fields, actions in _dump_entries(dump):
+        cookie = _int(fields.get('cookie')) or 0
+        if cookie & COOKIE_TAG_MASK != COOKIE_TAG:
+            continue
+        tunnel_id = cookie & 0xffffffff
+        table = fields.get('table')
+        if (table == '0' and _normalize_actions(actions).startswith(
+                'set_tunnel:%d,' % tunnel_id)):
+            direction = 'tx'
+        elif table == '1' and _int(fields.get('tun_id')) != tunnel_id:
+            direction = 'rx'
+        else:
+            continue
+        entry = counters.setdefault(tunnel_id,
+                                    dict.fromkeys(ENDPOINT_COUNTERS, 0))
+        entry[direction + '_packets'] += _int(fields.get('n_packets')) or 0
+        entry[direction + '_bytes'] += _int(fields.get('n_bytes')) or 0
+    return counters
+
+
+class DesiredState(object):
+    """What the ovs network driver should have set up on this host.
+
+    The driver records every event it handles here. Until it is loaded
+    from a full topology the state is not complete, and the reconciler
+    only repairs what is missing or wrong without removing anything it
+    does not know about.
+    """
+
+    def __init__(self):
+        # bridge name -> controller target or None
+        self.bridges = {}
+        # br-int side port -> (bridge, ovs network side port,
+        #                      tunnel_id, peer_tunnel_id)
+        self.endpoints = {}
+        # ovs links between two bridges of this host,
+        # left port -> (left bridge, right port, right bridge)
+        self.direct_links = {}
+        # vm ofport on br-int -> (bridge, tunnel_id, peer_tunnel_id)
+        self.vm_endpoints = {}
+        # endpoints with a peer on another host,
+        # (bridge, tunnel_id) -> (peer_tunnel_id, peer_ip)
+        self.remote_peers = {}
+        self.complete = False
+
+    def set_bridge(self, name, controller=None):
+        self.bridges[name] = controller
+
+    def remove_bridge(self, name):
+        self.bridges.pop(name, None)
+        for int_port, endpoint in self.endpoints.items():
+            if endpoint[0] == name:
+                del self.endpoints[int_port]
+        for ofport, endpoint in self.vm_endpoints.items():
+            if endpoint[0] == name:
+                del self.vm_endpoints[ofport]
+        for key in self.remote_peers.keys():
+            if key[0] == name:
+                del self.remote_peers[key]
+        for port, link in self.direct_links.items():
+            if name in (link[0], link[2]):
+                del self.direct_links[port]
+
+    def add_endpoint(self, int_port, bridge, ovs_port, tunnel_id,
+                     peer_tunnel_id):
+        self.endpoints[int_port] = (bridge, ovs_port, tunnel_id,
+                                    peer_tunnel_id)
+
+    def remove_endpoint(self, int_port):
+        self.endpoints.pop(int_port, None)
+
+    def add_direct_link(self, left_port, left_bridge, right_port,
+                        right_bridge):
+        self.direct_links[left_port] = (left_bridge, right_port, right_bridge)
+
+    def remove_direct_link(self, left_port):
+        self.direct_links.pop(left_port, None)
+
+    def port_pairs(self):
+        """(bridge, port, peer bridge, peer port) of every desired pair.
+
+        The peer bridge of an endpoint is None, for br-int.
+        """
+        pairs = [(bridge, ovs_port, None, int_port)
+                 for int_port, (bridge, ovs_port, _tunnel_id,
+                                _peer_tunnel_id) in self.endpoints.items()]
+        pairs += [(left_bridge, left_port, right_bridge, right_port)
+                  for left_port, (left_bridge, right_port, right_bridge) in
+                  self.direct_links.items()]
+        return pairs
+
+    def endpoint_cookies(self, bridge):
+        """Cookies of the br-int flows of the endpoints of bridge."""
+        cookies = set(endpoint_cookie(bridge, tunnel_id)
+                      for endpoint_bridge, _ovs_port, tunnel_id,
+                      _peer_tunnel_id in self.endpoints.values()
+                      if endpoint_bridge == bridge)
+        cookies.update(endpoint_cookie(bridge, tunnel_id)
+                       for endpoint_bridge, tunnel_id, _peer_tunnel_id in
+                       self.vm_endpoints.values()
+                       if endpoint_bridge == bridge)
+        return cookies
+
+    def add_vm_endpoint(self, ofport, bridge, tunnel_id, peer_tunnel_id):
+        self.vm_endpoints[_int(ofport)] = (bridge, tunnel_id, peer_tunnel_id)
+
+    def remove_vm_endpoint(self, ofport):
+        self.vm_endpoints.pop(_int(ofport), None)
+
+    def add_remote_peer(self, bridge, tunnel_id, peer_tunnel_id, peer_ip):
+        self.remote_peers[(bridge, _int(tunnel_id))] = (peer_tunnel_id,
+                                                        peer_ip)
+
+    def remove_remote_peer(self, bridge, tunnel_id):
+        self.remote_peers.pop((bridge, _int(tunnel_id)), None)
+
+    def flows(self, ofports):
+        """Desired br-int flows, given the ofports of the endpoint ports."""
+        flows = {}
+        for int_port, endpoint in self.endpoints.items():
+            if ofports.get(int_port):
+                bridge, _ovs_port, tunnel_id, peer_tunnel_id = endpoint
+                flows.update(endpoint_flows(ofports[int_port], bridge,
+                                            tunnel_id, peer_tunnel_id))
+        for ofport, endpoint in self.vm_endpoints.items():
+            flows.update(endpoint_flows(ofport, *endpoint))
+        return flows
+
+    def remote_flows(self, forwarder):
+        """Desired br-int and br-tun flows of the remote peers."""
+        int_flows = {}
+        tun_flows = {}
+        for (bridge, tunnel_id), (peer_tunnel_id, peer_ip) in (
+                self.remote_peers.items()):
+            try:
+                flows = forwarder.flows(endpoint_cookie(bridge, tunnel_id),
+                                        tunnel_id, peer_tunnel_id, peer_ip)
+            except Exception:
+                LOG.exception(_("Cannot forward tunnel %(tunnel)s to "
+                                "%(ip)s"), {'tunnel': tunnel_id,
+                                            'ip': peer_ip})
+                continue
+            int_flows.update(flows[0])
+            tun_flows.update(flows[1])
+        return int_flows, tun_flows
+
+
+class Reconciler(object):
+    """Apply the difference between a DesiredState and the host.
+
+    OVSDB is read once through the driver's backend and br-int flows with
+    a single dump-flows, then only the missing, wrong or (for a complete
+    state) stale bridges, endpoint ports and flows are changed.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def reconcile(self, desired):
+        """:returns: dict counting the changes made, by kind."""
+        changes = {}
+        snapshot = self.driver.ovsdb.snapshot()
+        self._reconcile_bridges(desired, snapshot, changes)
+        ofports = self._reconcile_endpoints(desired, snapshot, changes)
+        self._reconcile_flows(desired, ofports, changes)
+        LOG.info(_("ovs network state reconciled: %s"), changes)
+        return changes
+
+    def _reconcile_bridges(self, desired, snapshot, changes):
+        ovsdb = self.driver.ovsdb
+        bridges = snapshot['bridges']
+        for name, controller in desired.bridges.items():
+            name = self.driver.get_ovs_network_placement(name)[0]
+            if name not in bridges:
+                ovsdb.add_bridge(name, controller and [controller])
+                changes['bridges_added'] = changes.get('bridges_added', 0) + 1
+                bridges[name] = {'controller': [controller] if controller
+                                 else [], 'ports': set()}
+            if controller and bridges[name]['controller'] != [controller]:
+                ovsdb.set_controller(name, [controller])
+                changes['controllers_set'] = (
+                    changes.get('controllers_set', 0) + 1)
+        if not desired.complete:
+            return
+        for name in self.driver.network_tags.keys():
+            # their ports on the shared bridge are stale as well
+            if name not in desired.bridges:
+                del self.driver.network_tags[name]
+        for name in bridges.keys():
+            # including the own bridges of ovs networks now shared
+            if (BRIDGE_NAME_RE.match(name) and
+                    name != self.driver.bridge.br_name and
+                    (name not in desired.bridges or
+                     self.driver.get_ovs_network_placement(name)[1])):
+                ovsdb.del_bridge(name)
+                del bridges[name]
+                changes['bridges_deleted'] = (
+                    changes.get('bridges_deleted', 0) + 1)
+
+    def _reconcile_endpoints(self, desired, snapshot, changes):
+        """Repair endpoint and direct link ports, and their veth pairs.
+
+        Ports on the wrong bridge or of the wrong kind for the link mode
+        are recreated.
+
+        :returns: ofports of the desired br-int side ports.
+        """
+        int_br = self.driver.bridge.br_name
+        bridges = snapshot['bridges']
+        interfaces = snapshot['interfaces']
+        port_bridges = dict((port, name)
+                            for name, bridge in bridges.items()
+                            for port in bridge['ports'])
+        patch = self.driver.link_mode == 'patch'
+
+        stale_ports = []
+        stale_links = []
+        broken_links = []
+        missing_pairs = []
+        missing_ports = []
+        renewed = set()
+        for bridge, ovs_port, peer_bridge, int_port in desired.port_pairs():
+            peer_bridge = peer_bridge or int_br
+            links = [name for name in (int_port, ovs_port)
+                     if ovsnetwork_netlink.link_exists(name)]
+            if patch:
+                # left over from the veth link mode
+                stale_links += links
+            elif len(links) < 2:
+                broken_links += links
+                missing_pairs.append((ovs_port, int_port))
+                renewed.add(int_port)
+            for spec in self.driver.get_port_pair_specs(
+                    bridge, ovs_port, peer_bridge, int_port):
+                br, port, external_ids = spec[:3]
+                interface = interfaces.get(port, {})
+                current = port_bridges.get(port)
+                is_patch = interface.get('type') == 'patch'
+                actual_ids = interface.get('external_ids', {})
+                if current and (current != br or is_patch != patch or
+                                any(actual_ids.get(key) != value
+                                    for key, value in external_ids.items())):
+                    stale_ports.append((current, port))
+                    current = None
+                if not current:
+                    missing_ports.append(spec)
+                    renewed.add(int_port)
+
+        if desired.complete:
+            wanted = set()
+            for _bridge, port, _peer_bridge, peer_port in desired.port_pairs():
+                wanted.update((port, peer_port))
+            for name, interface in interfaces.items():
+                if (ENDPOINT_EXTERNAL_ID not in interface['external_ids'] or
+                        name in wanted):
+                    continue
+                if name in port_bridges:
+                    stale_ports.append((port_bridges[name], name))
+                if ovsnetwork_netlink.link_exists(name):
+                    stale_links.append(name)
+
+        if stale_ports:
+            self.driver.ovsdb.del_ports(stale_ports)
+        if stale_links or broken_links:
+            self.driver.veth.delete_links(stale_links + broken_links)
+        if missing_pairs:
+            self.driver.veth.add_veth_pairs(missing_pairs)
+        if missing_ports:
+            self.driver.ovsdb.add_ports(missing_ports)
+        for kind, items in (('ports_deleted', stale_ports),
+                            ('links_deleted', stale_links),
+                            ('veth_pairs_added', missing_pairs),
+                            ('ports_added', missing_ports)):
+            if items:
+                changes[kind] = len(items)
+
+        ofports = {}
+        for int_port in desired.endpoints:
+            ofport = interfaces.get(int_port, {}).get('ofport')
+            if int_port in renewed or not ofport:
+                ofport = _int(self.driver.get_port_ofport(int_port))
+            if ofport and ofport > 0:
+                ofports[int_port] = ofport
+        return ofports
+
+    def _reconcile_flows(self, desired, ofports, changes):
+        int_flows = desired.flows(ofports)
+        forwarder = self.driver.tunnel
+        if forwarder:
+            remote_int_flows, tun_flows = desired.remote_flows(forwarder)
+            int_flows.update(remote_int_flows)
+            self._reconcile_bridge_flows(forwarder.tun_br, tun_flows,
+                                         desired.complete, changes)
+        self._reconcile_bridge_flows(self.driver.bridge, int_flows,
+                                     desired.complete, changes, legacy=True)
+
+    def _reconcile_bridge_flows(self, bridge, wanted, complete, changes,
+                                legacy=False):
+        args = ['ovs-ofctl', 'dump-flows', bridge.br_name]
+        if not legacy:
+            args.append('cookie=%s' % cookie_match(COOKIE_TAG,
+                                                   COOKIE_TAG_MASK))
+        actual = parse_flows(self.driver.executor.execute(args), legacy)
+        with self.driver.flow_batch(bridge) as flows:
+            for key, flow in actual.items():
+                if wanted.get(key) == flow:
+                    continue
+                if key in wanted or complete:
+                    table, match = key
+                    flows.delete_flows(table=table, **dict(match))
+                    changes['flows_deleted'] = (
+                        changes.get('flows_deleted', 0) + 1)
+            missing = dict((key, flow) for key, flow in wanted.items()
+                           if actual.get(key) != flow)
+            add_flow_entries(flows, missing)
+            if missing:
+                changes['flows_added'] = (changes.get('flows_added', 0) +
+                                          len(missing))
@@ -0,0 +1,246 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# A long-lived privileged helper for the ovs network driver. The agent
+# starts it once through sudo:
+#
+#     sudo python -m neutron.agent.linux.ovsnetwork_rootwrap \
+#         /etc/neutron/rootwrap.conf
+#
+# and sends it batches of commands, one JSON request per line on its stdin,
+# instead of paying sudo and neutron-rootwrap startup on every command.
+# Every command is checked against the filters configured in rootwrap.conf
+# exactly like neutron-rootwrap does.
+
+import ConfigParser
+import itertools
+import os
+import signal
+import sys
+
+from eventlet.green import subprocess
+from eventlet import semaphore
+from oslo.rootwrap import wrapper
+
+from neutron.agent.linux import utils
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# the exit codes of neutron-rootwrap
+RC_UNAUTHORIZED = 99
+RC_NOCOMMAND = 98
+RC_BADCONFIG = 97
+RC_NOEXECFOUND = 96
+
+
+def _subprocess_setup():
+    # python installs a SIGPIPE handler by default, which is usually not
+    # what non-python subprocesses expect
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class RootwrapDaemon(object):
+    """The privileged side, runs filtered commands read from a pipe.
+
+    A request is {"id": n, "commands": [[argv, stdin], ...],
+    "stop_on_error": bool} and is answered with {"id": n, "results":
+    [{"returncode": rc, "stdout": out, "stderr": err}, ...]}. With
+    stop_on_error the commands following a failed one are not run and
+    have no result.
+    """
+
+    def __init__(self, config_file):
+        rawconfig = ConfigParser.RawConfigParser()
+        rawconfig.read(config_file)
+        self.config = wrapper.RootwrapConfig(rawconfig)
+        self.filters = wrapper.load_filters(self.config.filters_path)
+
+    def run_command(self, userargs, process_input=None):
+        try:
+            filtermatch = wrapper.match_filter(
+                self.filters, userargs, exec_dirs=self.config.exec_dirs)
+        except wrapper.FilterMatchNotExecutable as e:
+            return {'returncode': RC_NOEXECFOUND, 'stdout': '',
+                    'stderr': 'Executable not found: %s' % e.match.exec_path}
+        except wrapper.NoFilterMatched:
+            return {'returncode': RC_UNAUTHORIZED, 'stdout': '',
+                    'stderr': 'Unauthorized command: %s' % ' '.join(userargs)}
+        command = filtermatch.get_command(userargs,
+                                          exec_dirs=self.config.exec_dirs)
+        try:
+            obj = subprocess.Popen(command,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True,
+                                   preexec_fn=_subprocess_setup,
+                                   env=filtermatch.get_environment(userargs))
+            stdout, stderr = obj.communicate(process_input)
+        except OSError as e:
+            return {'returncode': RC_NOCOMMAND, 'stdout': '',
+                    'stderr': 'Failed to run %s: %s' % (command[0], e)}
+        return {'returncode': obj.returncode, 'stdout': stdout,
+                'stderr': stderr}
+
+    def handle(self, request):
+        results = []
+        for userargs, process_input in request['commands']:
+            result = self.run_command(userargs, process_input)
+            results.append(result)
+            if result['returncode'] and request.get('stop_on_error'):
+                break
+        return {'id': request['id'], 'results': results}
+
+    def serve(self, stdin, stdout):
+        for line in iter(stdin.readline, ''):
+            stdout.write(jsonutils.dumps(self.handle(jsonutils.loads(line))))
+            stdout.write('\n')
+            stdout.flush()
+
+
+class RootwrapDaemonClient(object):
+    """The agent side, starts the daemon on first use and talks to it.
+
+    Requests are serialized, a greenthread waiting on the daemon does not
+    block the others.
+    """
+
+    def __init__(self, daemon_cmd):
+        self.daemon_cmd = daemon_cmd
+        self.process = None
+        self.ids = itertools.count(1)
+        self.lock = semaphore.Semaphore()
+
+    def _ensure_started(self):
+        if self.process and self.process.poll() is None:
+            return
+        LOG.info(_("Starting privileged command daemon: %s"),
+                 ' '.join(self.daemon_cmd))
+        self.process = subprocess.Popen(self.daemon_cmd,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def run(self, commands, stop_on_error=True):
+        """Run (argv, process_input) commands in one round trip.
+
+        :returns: a result dict per command that was run.
+        """
+        with self.lock:
+            self._ensure_started()
+            request = {'id': next(self.ids), 'commands': commands,
+                       'stop_on_error': stop_on_error}
+            try:
+                self.process.stdin.write(jsonutils.dumps(request) + '\n')
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except IOError:
+                line = ''
+            if not line:
+                # the daemon died, the next request starts a new one
+                self.process = None
+                raise RuntimeError(_("Privileged command daemon exited"))
+        reply = jsonutils.loads(line)
+        if reply['id'] != request['id']:
+            self.stop()
+            raise RuntimeError(_("Unexpected reply %(reply)s from the "
+                                 "privileged command daemon to request "
+                                 "%(request)s") %
+                               {'reply': reply['id'], 'request': request['id']})
+        return reply['results']
+
+
+class CommandExecutor(object):
+    """Runs the privileged commands of the ovs network driver.
+
+    Without a daemon command every command goes through utils.execute and
+    the root helper, with one all commands go to a RootwrapDaemonClient and
+    a batch costs a single round trip.
+    """
+
+    def __init__(self, root_helper, daemon_cmd=None):
+        self.root_helper = root_helper
+        # called with the number of commands of every execute_many()
+        self.listeners = []
+        self.daemon = None
+        if daemon_cmd:
+            self.daemon = RootwrapDaemonClient(daemon_cmd)
+
+    def stop(self):
+        if self.daemon:
+            self.daemon.stop()
+
+    def execute(self, cmd, process_input=None, check_exit_code=True):
+        return self.execute_many([(cmd, process_input)],
+                                 check_exit_code=check_exit_code)[0]
+
+    def execute_many(self, commands, check_exit_code=True):
+        """Run (cmd, process_input) commands in order.
+
+        Like utils.execute, a failed command raises RuntimeError unless
+        check_exit_code is False, in which case all commands are run.
+
+        :returns: the stdout of every command.
+        """
+        commands = [(list(cmd), process_input)
+                    for cmd, process_input in commands]
+        for listener in self.listeners:
+            listener(len(commands))
+        if not self.daemon:
+            return [utils.execute(cmd, root_helper=self.root_helper,
+                                  process_input=process_input,
+                                  check_exit_code=check_exit_code)
+                    for cmd, process_input in commands]
+        results = self.daemon.run(commands, stop_on_error=check_exit_code)
+        outputs = []
+        for (cmd, _process_input), result in zip(commands, results):
+            LOG.debug(_("Running command (daemon): %s"), cmd)
+            if result['returncode'] and check_exit_code:
+                m = _("\nCommand: %(cmd)s\nExit code: %(code)s\nStdout: "
+                      "%(stdout)r\nStderr: %(stderr)r") % {
+                          'cmd': cmd, 'code': result['returncode'],
+                          'stdout': result['stdout'],
+                          'stderr': result['stderr']}
+                LOG.error(m)
+                raise RuntimeError(m)
+            outputs.append(result['stdout'])
+        return outputs
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s <rootwrap.conf>\n" %
+                         os.path.basename(sys.argv[0]))
+        sys.exit(RC_NOCOMMAND)
+    try:
+        daemon = RootwrapDaemon(sys.argv[1])
+    except ValueError as e:
+        sys.stderr.write("Incorrect value in %s: %s\n" % (sys.argv[1], e))
+        sys.exit(RC_BADCONFIG)
+    except ConfigParser.Error:
+        sys.stderr.write("Incorrect configuration file: %s\n" % sys.argv[1])
+        sys.exit(RC_BADCONFIG)
+    daemon.serve(sys.stdin, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# Timing of the operations of the ovs network driver. The agent dumps them
+# as JSON to every client of a unix socket, e.g.:
+#
+#     socat - UNIX-CONNECT:/var/lib/neutron/ovs-network-metrics.sock
+
+import bisect
+import contextlib
+import os
+import socket
+import threading
+import time
+
+import eventlet
+
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1, 2, 5, 10, 30, 60)
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram(object):
+    """Latencies counted in LATENCY_BUCKETS.
+
+    A percentile is reported as the upper bound of the bucket it falls in,
+    or as the largest latency seen for the last, unbounded bucket.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                break
+        if i < len(LATENCY_BUCKETS):
+            return min(LATENCY_BUCKETS[i], self.max)
+        return self.max
+
+    def get_stats(self):
+        stats = dict(('p%d' % percent, self.percentile(percent))
+                     for percent in PERCENTILES)
+        stats.update({'avg': self.total / self.count if self.count else 0.0,
+                      'max': self.max})
+        return stats
+
+
+class OperationMetrics(object):
+    """Count, errors, latency and external commands per operation.
+
+    Commands are attributed to the operation measured in the running
+    greenthread, through count_commands().
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self._local = threading.local()
+
+    def _operation(self, name):
+        if name not in self.operations:
+            self.operations[name] = {'count': 0, 'errors': 0, 'commands': 0,
+                                     'latency': LatencyHistogram()}
+        return self.operations[name]
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        outer = getattr(self._local, 'commands', None)
+        self._local.commands = 0
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            operation = self._operation(name)
+            operation['count'] += 1
+            operation['errors'] += int(failed)
+            operation['commands'] += self._local.commands
+            operation['latency'].add(time.time() - start)
+            if outer is not None:
+                outer += self._local.commands
+            self._local.commands = outer
+
+    def count_commands(self, count=1):
+        if getattr(self._local, 'commands', None) is not None:
+            self._local.commands += count
+
+    def get_stats(self):
+        stats = {}
+        for name, operation in self.operations.items():
+            stats[name] = operation['latency'].get_stats()
+            stats[name].update((key, operation[key])
+                               for key in ('count', 'errors', 'commands'))
+        return stats
+
+    def get_summary(self):
+        """Count, errors and p99 latency per operation.
+
+        It is small enough for the agent state report, get_stats() is not.
+        """
+        return dict((name, {'count': operation['count'],
+                            'errors': operation['errors'],
+                            'p99': operation['latency'].percentile(99)})
+                    for name, operation in self.operations.items())
+
+
+class MetricsServer(object):
+    """Write the stats of an OperationMetrics to clients of a unix socket."""
+
+    def __init__(self, path, metrics):
+        self.path = path
+        self.metrics = metrics
+        self.listener = None
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = eventlet.listen(self.path, family=socket.AF_UNIX)
+        self.server = eventlet.spawn(self._serve)
+
+    def stop(self):
+        if self.server:
+            self.server.kill()
+        if self.listener:
+            self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _serve(self):
+        while True:
+            client, _addr = self.listener.accept()
+            try:
+                client.sendall(jsonutils.dumps(self.metrics.get_stats()) +
+                               '\n')
+            except socket.error as e:
+                LOG.debug(_("Failed to send ovs network metrics: %s"), e)
+            finally:
+                client.close()
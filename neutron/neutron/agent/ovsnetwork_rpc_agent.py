@@ -17,11 +17,20 @@
 #
 # This is created by Jian LI @ BUPT
 
+import collections
+import contextlib
+import time
+
+import eventlet
+from eventlet import corolocal
+from eventlet import queue as eventlet_queue
 from oslo.config import cfg
 
+from neutron.agent import ovsnetwork_metrics
 from neutron.common import topics
 from neutron.openstack.common import importutils
 from neutron.openstack.common import log as logging
+from neutron.openstack.common import loopingcall
 from neutron import manager
 
 #from neutron.agent.linux import ovs_lib
@@ -33,6 +42,32 @@ ovs_network_opts = [
         'ovs_network_driver',
         default='neutron.agent.linux.ovsnetwork.OVSNetworkDriver',
         help=_('Driver for ovs network implementation on L2 agent')),
+    cfg.IntOpt(
+        'ovs_network_workers',
+        default=4,
+        help=_('Number of greenthreads applying ovs network events. Events '
+               'stay ordered per ovs network bridge, an event changing '
+               'two bridges with the events of both. Others run '
+               'concurrently. 0 applies every event inline in '
+               'the RPC dispatcher.')),
+    cfg.IntOpt(
+        'ovs_network_stats_interval',
+        default=30,
+        help=_('Seconds between two reports of the traffic counters of '
+               'the ovs link and vm link endpoints to the server. 0 '
+               'disables the reports.')),
+    cfg.StrOpt(
+        'ovs_network_metrics_socket',
+        help=_('Unix socket on which the agent dumps the count, errors, '
+               'latency percentiles and external commands of every ovs '
+               'network driver operation as JSON. Unset disables it.')),
+    cfg.FloatOpt(
+        'ovs_topology_notify_window',
+        default=0.1,
+        help=_('Seconds the server collects the ovs network events of a '
+               'host before sending them in one ovs_topology_changed '
+               'message, which the agent applies as one batch. 0 sends '
+               'every event on its own.')),
 ]
 cfg.CONF.register_opts(ovs_network_opts, 'OVSNETWORK')
 
@@ -41,9 +76,222 @@ OVS_NETWORK_RPC_VERSION = "1.0"
 OVS_NETWORK = 'ovs_network'
 OVS_LINK = 'ovs_link'
 VM_LINK = 'vm_link'
+OVS_TOPOLOGY = 'ovs_topology'
+
+# the events an ovs_topology_changed message may carry
+OVS_TOPOLOGY_EVENTS = frozenset([
+    'ovs_network_created', 'ovs_network_updated', 'ovs_network_deleted',
+    'ovs_link_left_endpoint_created', 'ovs_link_right_endpoint_created',
+    'ovs_link_left_endpoint_deleted', 'ovs_link_right_endpoint_deleted',
+    'ovs_link_direct_created', 'ovs_link_direct_deleted',
+    'vm_link_vm_endpoint_created', 'vm_link_vm_endpoint_updated',
+    'vm_link_vm_endpoint_deleted', 'vm_link_ovs_endpoint_created',
+    'vm_link_ovs_endpoint_updated', 'vm_link_ovs_endpoint_deleted'])
+
+# endpoint counters sent to the server in one message
+STATS_BATCH_SIZE = 500
+
+# seconds between two attempts to ask a host to resync
+OVS_TOPOLOGY_RESYNC_INTERVAL = 10
+
+
+@contextlib.contextmanager
+def _no_batch():
+    yield
+
+
+def _event_revision(args):
+    """The (revision, previous revision of the host) of an event."""
+    for value in args.values():
+        if isinstance(value, dict) and 'revision' in value:
+            return value['revision'], value.get('prev_revision')
+    return args.get('revision'), args.get('prev_revision')
+
+
+def _queue_keys(key):
+    """The keys of a work item, a tuple of keys or a single one."""
+    if isinstance(key, tuple):
+        return sorted(set(key))
+    return [key]
+
+
+class OVSNetworkWorkQueue(object):
+    """Run work in order per key and different keys concurrently.
+
+    Every key has its own FIFO queue. An item at the head of the queues of
+    all its keys is handed to one of a fixed number of worker
+    greenthreads, which runs it and then hands over the items behind it
+    which became ready, so a key is never worked on by two workers and a
+    busy key cannot starve the others.
+
+    An item submitted under a tuple of keys, e.g. the two bridges of a
+    direct ovs link, is queued under each of them in sorted order and is
+    ordered with the work of both.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = {}
+        self.ready = eventlet_queue.Queue()
+        self.processed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        for i in range(workers):
+            eventlet.spawn_n(self._worker)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func under key, a single key or a tuple of keys."""
+        keys = _queue_keys(key)
+        item = (time.time(), func, args, kwargs, keys)
+        for key in keys:
+            self.queues.setdefault(key, collections.deque()).append(item)
+        self._put_if_ready(item)
+
+    def _put_if_ready(self, item):
+        if all(self.queues[key][0] is item for key in item[4]):
+            self.ready.put(item)
+
+    def _worker(self):
+        while True:
+            item = self.ready.get()
+            enqueued, func, args, kwargs, keys = item
+            wait_time = time.time() - enqueued
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                LOG.exception(_("ovs network work item %(func)s for "
+                                "%(key)s failed"),
+                              {'func': func.__name__, 'key': keys})
+            self.processed += 1
+            for key in keys:
+                queue = self.queues[key]
+                queue.popleft()
+                if queue:
+                    self._put_if_ready(queue[0])
+                else:
+                    del self.queues[key]
+
+    def depth(self):
+        return len(set(id(item) for queue in self.queues.values()
+                       for item in queue))
+
+    def wait_idle(self, interval=0.1):
+        while self.queues:
+            eventlet.sleep(interval)
+
+    def get_stats(self):
+        now = time.time()
+        oldest = [queue[0][0] for queue in self.queues.values()]
+        return {'depth': self.depth(),
+                'busy_keys': len(self.queues),
+                'workers': self.workers,
+                'processed': self.processed,
+                'wait_time_avg': (self.wait_time_total / self.processed
+                                  if self.processed else 0.0),
+                'wait_time_max': self.wait_time_max,
+                'oldest_wait': now - min(oldest) if oldest else 0.0}
+
+
 class OVSNetworkAgentRpcApiMixin(object): 
     """A mix-in class supporting plugins to send message to the ovsnetwork agent."""
 
+    def _get_ovs_topology_topic(self, host=None):
+        return topics.get_topic_name(self.topic,
+                                     OVS_TOPOLOGY,
+                                     topics.UPDATE,
+                                     host)
+
+    # the events held by the ovs_topology_batch() of each greenthread
+    _ovs_topology_local = corolocal.local()
+
+    def _cast_ovs_event(self, context, msg, topic, host):
+        """Cast an event, or queue it for the next message to its host.
+
+        The events of a host are collected for ovs_topology_notify_window
+        and sent in order in one ovs_topology_changed message, in the
+        context of the first one. Inside ovs_topology_batch() they are
+        held until the block ends.
+        """
+        batch = getattr(self._ovs_topology_local, 'batch', None)
+        if batch is not None and host:
+            batch.setdefault(host, (context, []))[1].append(msg)
+            return
+        window = cfg.CONF.OVSNETWORK.ovs_topology_notify_window
+        if not window or not host:
+            self.cast(context, msg, version=OVS_NETWORK_RPC_VERSION,
+                      topic=topic)
+            return
+        pending = self.__dict__.setdefault('_ovs_topology_pending', {})
+        if host not in pending:
+            pending[host] = (context, [])
+            eventlet.spawn_after(window, self._send_ovs_topology, host)
+        pending[host][1].append(msg)
+
+    @contextlib.contextmanager
+    def ovs_topology_batch(self):
+        """Send the events cast in the block in one message per host.
+
+        The events are held per greenthread, so the batch of a request
+        does not hold back those of others.
+        """
+        local = self._ovs_topology_local
+        if getattr(local, 'batch', None) is not None:
+            # the outer block sends them
+            yield
+            return
+        batch = local.batch = collections.OrderedDict()
+        try:
+            yield
+        finally:
+            local.batch = None
+            for host, (context, events) in batch.items():
+                self._cast_ovs_topology(context, host, events)
+
+    def _send_ovs_topology(self, host):
+        context, events = self._ovs_topology_pending.pop(host)
+        self._cast_ovs_topology(context, host, events)
+
+    def _cast_ovs_topology(self, context, host, events):
+        try:
+            self.cast(context,
+                      self.make_msg('ovs_topology_changed', events=events),
+                      version=OVS_NETWORK_RPC_VERSION,
+                      topic=self._get_ovs_topology_topic(host))
+        except Exception:
+            LOG.exception(_("Failed to send %(count)d ovs network events "
+                            "to %(host)s, asking it to resync"),
+                          {'count': len(events), 'host': host})
+            self._resync_ovs_topology(context, host)
+
+    def _resync_ovs_topology(self, context, host):
+        """Ask host to resync its ovs networks until the message goes out.
+
+        The events lost are in the change log of the host, but without a
+        later event the agent would not notice the gap.
+        """
+        resync = self.__dict__.setdefault('_ovs_topology_resync', set())
+        if host in resync:
+            return
+        resync.add(host)
+        eventlet.spawn_after(OVS_TOPOLOGY_RESYNC_INTERVAL,
+                             self._send_ovs_topology_resync, context, host)
+
+    def _send_ovs_topology_resync(self, context, host):
+        try:
+            self.cast(context, self.make_msg('ovs_topology_resync'),
+                      version=OVS_NETWORK_RPC_VERSION,
+                      topic=self._get_ovs_topology_topic(host))
+        except Exception:
+            LOG.warning(_("Failed to ask %s to resync its ovs networks, "
+                          "retrying"), host)
+            eventlet.spawn_after(OVS_TOPOLOGY_RESYNC_INTERVAL,
+                                 self._send_ovs_topology_resync, context,
+                                 host)
+            return
+        self._ovs_topology_resync.discard(host)
+
     def _get_ovs_network_create_topic(self, host=None):
         return topics.get_topic_name(self.topic,
                                      OVS_NETWORK,                                     
@@ -95,100 +343,164 @@ class OVSNetworkAgentRpcApiMixin(object):
     def ovs_network_created(self, context, ovs_network):
         if not ovs_network:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('ovs_network_created',ovs_network=ovs_network),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_ovs_network_create_topic(ovs_network['host']))
+            self._get_ovs_network_create_topic(ovs_network['host']),
+            ovs_network['host'])
         
     def ovs_network_updated(self, context, ovs_network):
         if not id or not ovs_network:
             return
-        self.cast(context,
-             self.make_msg('ovs_network_updated', ovs_network=ovs_network),
-             version=OVS_NETWORK_RPC_VERSION,
-             topic=self._get_ovs_network_update_topic(ovs_network['host']))
+        self._cast_ovs_event(context,
+            self.make_msg('ovs_network_updated', ovs_network=ovs_network),
+            self._get_ovs_network_update_topic(ovs_network['host']),
+            ovs_network['host'])
     
-    def ovs_network_deleted(self, context, id, host):
+    def ovs_network_deleted(self, context, id, host, **revision):
         if not id:
             return
-        self.cast(context,
-             self.make_msg('ovs_network_deleted', id=id),
-             version=OVS_NETWORK_RPC_VERSION,
-             topic=self._get_ovs_network_delete_topic(host))
+        self._cast_ovs_event(context,
+            self.make_msg('ovs_network_deleted', id=id, **revision),
+            self._get_ovs_network_delete_topic(host),
+            host)
 
     def ovs_link_left_endpoint_created(self, context, ovs_link, host):
         if not ovs_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('ovs_link_left_endpoint_created', ovs_link=ovs_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_ovs_link_create_topic(host))
+            self._get_ovs_link_create_topic(host),
+            host)
 
     def ovs_link_right_endpoint_created(self, context, ovs_link, host):
         if not ovs_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('ovs_link_right_endpoint_created', ovs_link=ovs_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_ovs_link_create_topic(host))
+            self._get_ovs_link_create_topic(host),
+            host)
 
     def ovs_link_left_endpoint_deleted(self, context, ovs_link, host):
         if not ovs_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('ovs_link_left_endpoint_deleted', ovs_link=ovs_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_ovs_link_delete_topic(host))
+            self._get_ovs_link_delete_topic(host),
+            host)
 
     def ovs_link_right_endpoint_deleted(self, context, ovs_link, host):
         if not ovs_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('ovs_link_right_endpoint_deleted', ovs_link=ovs_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_ovs_link_create_topic(host))
+            self._get_ovs_link_create_topic(host),
+            host)
+
+    def ovs_link_direct_created(self, context, ovs_link, host):
+        if not ovs_link:
+            return
+        self._cast_ovs_event(context,
+            self.make_msg('ovs_link_direct_created', ovs_link=ovs_link),
+            self._get_ovs_link_create_topic(host),
+            host)
+
+    def ovs_link_direct_deleted(self, context, ovs_link, host):
+        if not ovs_link:
+            return
+        self._cast_ovs_event(context,
+            self.make_msg('ovs_link_direct_deleted', ovs_link=ovs_link),
+            self._get_ovs_link_delete_topic(host),
+            host)
 
     def vm_link_vm_endpoint_created(self, context, vm_link, host):
         if not vm_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('vm_link_vm_endpoint_created', vm_link=vm_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_vm_link_create_topic(host))
+            self._get_vm_link_create_topic(host),
+            host)
 
     def vm_link_vm_endpoint_updated(self, context, vm_link, host):
         if not vm_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('vm_link_vm_endpoint_updated', vm_link=vm_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_vm_link_update_topic(host))
+            self._get_vm_link_update_topic(host),
+            host)
 
     def vm_link_vm_endpoint_deleted(self, context, vm_link, host):
         if not vm_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('vm_link_vm_endpoint_deleted', vm_link=vm_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_vm_link_delete_topic(host))
+            self._get_vm_link_delete_topic(host),
+            host)
 
     def vm_link_ovs_endpoint_created(self, context, vm_link, host):
         if not vm_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('vm_link_ovs_endpoint_created', vm_link=vm_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_vm_link_create_topic(host))
+            self._get_vm_link_create_topic(host),
+            host)
+
+    def vm_link_ovs_endpoint_updated(self, context, vm_link, host):
+        if not vm_link:
+            return
+        self._cast_ovs_event(context,
+            self.make_msg('vm_link_ovs_endpoint_updated', vm_link=vm_link),
+            self._get_vm_link_update_topic(host),
+            host)
 
     def vm_link_ovs_endpoint_deleted(self, context, vm_link, host):
         if not vm_link:
             return
-        self.cast(context,
+        self._cast_ovs_event(context,
             self.make_msg('vm_link_ovs_endpoint_deleted', vm_link=vm_link),
-            version=OVS_NETWORK_RPC_VERSION,
-            topic=self._get_vm_link_delete_topic(host))
+            self._get_vm_link_delete_topic(host),
+            host)
                                                 
                          
+class OVSNetworkServerRpcApiMixin(object):
+    """A mix-in that enable ovs network support in plugin rpc."""
+
+    def update_ovs_network_stats(self, context, host, stats):
+        """Report the traffic counters of the endpoints on host.
+
+        :param stats: a list of dicts with tunnel_id and the counters.
+        """
+        self.cast(context,
+                  self.make_msg('update_ovs_network_stats',
+                                host=host, stats=stats),
+                  version=OVS_NETWORK_RPC_VERSION,
+                  topic=self.topic)
+
+    def get_ovs_network_topology(self, context, host):
+        """Get the ovs networks and links of host in one call.
+
+        :returns: the topology of OVSNetworkDriver.reconcile().
+        """
+        LOG.debug(_("Get ovs network topology of %s via rpc"), host)
+        return self.call(context,
+                         self.make_msg('get_ovs_network_topology', host=host),
+                         version=OVS_NETWORK_RPC_VERSION,
+                         topic=self.topic)
+
+
+    def get_ovs_network_changes(self, context, host, since):
+        """Get the events of host after revision since.
+
+        :returns: see OVSNetworkDbMixin.get_ovs_network_changes().
+        """
+        LOG.debug(_("Get ovs network changes of %(host)s since %(since)s "
+                    "via rpc"), {'host': host, 'since': since})
+        return self.call(context,
+                         self.make_msg('get_ovs_network_changes',
+                                       host=host, since=since),
+                         version=OVS_NETWORK_RPC_VERSION,
+                         topic=self.topic)
+
+
 class OVSNetworkAgentRpcCallbackMixin(object):
     """A mix-in that enable ovs agent to call ovs network agent."""
     
@@ -198,6 +510,30 @@ class OVSNetworkAgentRpcCallbackMixin(object):
                       "This should be set by the end of the init "
                       "process."))
 
+    def ovs_topology_changed(self, context, **kwargs):
+        """Callback for a batch of ovs network events.
+
+        :param events: the messages of the events, in order
+        """
+        events = kwargs.get('events', [])
+        LOG.debug(
+            _("%d ovs network events on remote: %s"), len(events), cfg.CONF.host)
+        if not self.ovs_network_agent:
+            return self._ovs_network_agent_not_set()
+        with self.ovs_network_agent.ovs_network_event_batch(context):
+            for event in events:
+                if event.get('method') not in OVS_TOPOLOGY_EVENTS:
+                    LOG.warning(_("Ignoring unknown ovs network event %s"), event.get('method'))
+                    continue
+                getattr(self, event['method'])(context, **event.get('args', {}))
+
+    def ovs_topology_resync(self, context, **kwargs):
+        """Callback when the server failed to send events to this host."""
+        LOG.info(_("ovs network events to %s were lost, resyncing"), cfg.CONF.host)
+        if not self.ovs_network_agent:
+            return self._ovs_network_agent_not_set()
+        self.ovs_network_agent.ovs_network_sync_needed = True
+
     def ovs_network_created(self, context, **kwargs):
         """Callback for ovs network create.
 
@@ -208,6 +544,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs network %s created on remote: %s"), ovs_network, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_network_created(context, ovs_network)
 
     def ovs_network_updated(self, context, **kwargs):
@@ -220,6 +558,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs network %s updated on remote: %s"), ovs_network, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_network_updated(context, ovs_network)
 
     def ovs_network_deleted(self, context, **kwargs):
@@ -232,6 +572,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs network %s deleted on remote: %s"), id, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_network_deleted(context, id)
 
     def ovs_link_left_endpoint_created(self, context, **kwargs):
@@ -244,6 +586,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs link %s left endpoint created on remote: %s"), ovs_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_link_left_endpoint_created(context, ovs_link)
 
     def ovs_link_right_endpoint_created(self, context, **kwargs):
@@ -256,6 +600,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs link %s right endpoint created on remote: %s"), ovs_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_link_right_endpoint_created(context, ovs_link)
 
     def ovs_link_left_endpoint_deleted(self, context, **kwargs):
@@ -268,6 +614,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs link %s left endpoint deleted on remote: %s"), ovs_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_link_left_endpoint_deleted(context, ovs_link)
 
     def ovs_link_right_endpoint_deleted(self, context, **kwargs):
@@ -280,8 +628,38 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("ovs link %s right endpoint deleted on remote: %s"), ovs_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.ovs_link_right_endpoint_deleted(context, ovs_link)
 
+    def ovs_link_direct_created(self, context, **kwargs):
+        """Callback for create of an ovs link within this host.
+
+        :param ovs_link: new ovs link
+        """
+        ovs_link = kwargs.get('ovs_link', {})
+        LOG.debug(
+            _("ovs link %s created directly on remote: %s"), ovs_link, cfg.CONF.host)
+        if not self.ovs_network_agent:
+            return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
+        self.ovs_network_agent.ovs_link_direct_created(context, ovs_link)
+
+    def ovs_link_direct_deleted(self, context, **kwargs):
+        """Callback for delete of an ovs link within this host.
+
+        :param ovs_link: ovs link
+        """
+        ovs_link = kwargs.get('ovs_link', {})
+        LOG.debug(
+            _("ovs link %s deleted directly on remote: %s"), ovs_link, cfg.CONF.host)
+        if not self.ovs_network_agent:
+            return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
+        self.ovs_network_agent.ovs_link_direct_deleted(context, ovs_link)
+
     def vm_link_vm_endpoint_created(self, context, **kwargs):
         """Callback for vm link vm endpoint create.
 
@@ -292,6 +670,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("vm link %s vm endpoint created on remote: %s"), vm_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.vm_link_vm_endpoint_created(context, vm_link)
 
     def vm_link_vm_endpoint_updated(self, context, **kwargs):
@@ -304,6 +684,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("vm link %s vm endpoint updated on remote: %s"), vm_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.vm_link_vm_endpoint_updated(context, vm_link)
 
     def vm_link_vm_endpoint_deleted(self, context, **kwargs):
@@ -316,6 +698,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("vm link %s vm endpoint delete on remote: %s"), vm_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.vm_link_vm_endpoint_deleted(context, vm_link)
 
     def vm_link_ovs_endpoint_created(self, context, **kwargs):
@@ -328,8 +712,24 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("vm link %s ovs endpoint created on remote: %s"), vm_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.vm_link_ovs_endpoint_created(context, vm_link)
 
+    def vm_link_ovs_endpoint_updated(self, context, **kwargs):
+        """Callback for vm link ovs endpoint update.
+
+        :param vm_link: vm link
+        """
+        vm_link = kwargs.get('vm_link', {})
+        LOG.debug(
+            _("vm link %s ovs endpoint updated on remote: %s"), vm_link, cfg.CONF.host)
+        if not self.ovs_network_agent:
+            return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
+        self.ovs_network_agent.vm_link_ovs_endpoint_updated(context, vm_link)
+
     def vm_link_ovs_endpoint_deleted(self, context, **kwargs):
         """Callback for vm link ovs endpoint delete.
 
@@ -340,6 +740,8 @@ class OVSNetworkAgentRpcCallbackMixin(object):
             _("vm link %s ovs endpoint deleted on remote: %s"), vm_link, cfg.CONF.host)
         if not self.ovs_network_agent:
             return self._ovs_network_agent_not_set()
+        if not self.ovs_network_agent.ovs_network_event_in_order(context, kwargs):
+            return
         self.ovs_network_agent.vm_link_ovs_endpoint_deleted(context, vm_link)
  
     
@@ -353,63 +755,340 @@ class OVSNetworkAgentRpcMixin(object):
             self.ovs_network_driver = importutils.import_object(self.ovs_network_driver)
         else:
             LOG.debug(_("ovs network driver is not defined on %s!"), cfg.CONF.host)
+        self.ovs_network_queue = None
+        if self.ovs_network_driver and cfg.CONF.OVSNETWORK.ovs_network_workers > 0:
+            self.ovs_network_queue = OVSNetworkWorkQueue(cfg.CONF.OVSNETWORK.ovs_network_workers)
+        self.ovs_network_stats_loop = None
+        # events collected by ovs_network_event_batch()
+        self.ovs_network_batch = None
+        # the last change of this host applied, None until synced
+        self.ovs_network_revision = None
+        # set when the change log cannot fill a gap
+        self.ovs_network_sync_needed = False
+        self.ovs_network_metrics = ovsnetwork_metrics.OperationMetrics()
+        executor = getattr(self.ovs_network_driver, 'executor', None)
+        if executor:
+            executor.listeners.append(self.ovs_network_metrics.count_commands)
+        self.ovs_network_metrics_server = None
+        metrics_socket = cfg.CONF.OVSNETWORK.ovs_network_metrics_socket
+        if self.ovs_network_driver and metrics_socket:
+            self.ovs_network_metrics_server = ovsnetwork_metrics.MetricsServer(
+                metrics_socket, self.ovs_network_metrics)
+            self.ovs_network_metrics_server.start()
+
+    def _measured(self, method):
+        """The driver method, timed under its own name."""
+        func = getattr(self.ovs_network_driver, method)
+
+        def measured(*args, **kwargs):
+            with self.ovs_network_metrics.measure(method):
+                return func(*args, **kwargs)
+        measured.__name__ = method
+        return measured
+
+    def _apply_ovs_network_event(self, key, method, context, resource):
+        """Hand an event to the driver, through the work queue if enabled.
+
+        :param key: the ovs network bridge the event changes, or a tuple
+                    of them. Events sharing a key are applied in order.
+        """
+        if self.ovs_network_batch is not None:
+            self.ovs_network_batch.append((key, method, resource))
+            return
+        func = self._measured(method)
+        if self.ovs_network_queue:
+            self.ovs_network_queue.submit(key, func, context, resource)
+        else:
+            func(context, resource)
+
+    @contextlib.contextmanager
+    def ovs_network_event_batch(self, context):
+        """Collect the events handed over inside the block as one batch.
+
+        The events sharing a key, directly or through other events, go
+        to the work queue as a single item under all their keys, so they
+        are applied in order with the single events of those keys and
+        with their flows pushed together, while other keys are applied
+        concurrently.
+        """
+        if self.ovs_network_batch is not None:
+            # the outer block applies them
+            yield
+            return
+        self.ovs_network_batch = []
+        try:
+            yield
+        finally:
+            events, self.ovs_network_batch = self.ovs_network_batch, None
+        if not events or not self.ovs_network_driver:
+            return
+        if not self.ovs_network_queue:
+            self._apply_ovs_network_batch(
+                context, [(method, resource) for key, method, resource in events])
+            return
+        # [keys, [(index, method, resource)]], merged when keys overlap
+        batches = []
+        for index, (key, method, resource) in enumerate(events):
+            keys = set(_queue_keys(key))
+            batch = [keys, [(index, method, resource)]]
+            for other in [b for b in batches if b[0] & keys]:
+                batches.remove(other)
+                keys.update(other[0])
+                batch[1].extend(other[1])
+            batches.append(batch)
+        for keys, batch in sorted(batches, key=lambda b: min(e[0] for e in b[1])):
+            keys = sorted(keys)
+            self.ovs_network_queue.submit(
+                keys[0] if len(keys) == 1 else tuple(keys),
+                self._apply_ovs_network_batch, context,
+                [(method, resource) for index, method, resource in
+                 sorted(batch, key=lambda e: e[0])])
+
+    def ovs_network_event_in_order(self, context, args):
+        """Check the revision of an event before it is applied.
+
+        Events which were already applied, e.g. by a catch up, are
+        dropped. When events were missed the ones after the last applied
+        are fetched from the change log of the server and applied first,
+        this one included.
+
+        :param args: the arguments of the event message
+        :returns: whether the event should be applied
+        """
+        revision, prev_revision = _event_revision(args)
+        if revision is None or self.ovs_network_revision is None:
+            return True
+        if revision <= self.ovs_network_revision:
+            LOG.debug(_("Dropping ovs network event of revision %d, already applied"), revision)
+            return False
+        if prev_revision == self.ovs_network_revision:
+            self.ovs_network_revision = revision
+            return True
+        LOG.info(_("Missed ovs network events between revision %(last)d and %(prev)s"),
+                 {'last': self.ovs_network_revision, 'prev': prev_revision})
+        if self.catch_up_ovs_networks(context):
+            return False
+        self.ovs_network_revision = revision
+        return True
+
+    def catch_up_ovs_networks(self, context):
+        """Apply the changes of this host after the last applied revision.
+
+        :returns: False if it failed, a full sync is then scheduled.
+        """
+        try:
+            delta = self.plugin_rpc.get_ovs_network_changes(
+                self.context, cfg.CONF.host, self.ovs_network_revision)
+        except Exception:
+            LOG.exception(_("Failed to get the ovs network changes of %s"), cfg.CONF.host)
+            self.ovs_network_sync_needed = True
+            return False
+        if delta.get('resync'):
+            LOG.info(_("ovs network change log of %s was pruned, resyncing"), cfg.CONF.host)
+            self.ovs_network_sync_needed = True
+            return False
+        with self.ovs_network_event_batch(context):
+            for change in delta['changes']:
+                if change['method'] in OVS_TOPOLOGY_EVENTS:
+                    getattr(self, change['method'])(context, change['resource'])
+        self.ovs_network_revision = max(self.ovs_network_revision, delta['revision'])
+        return True
+
+    def _apply_ovs_network_batch(self, context, events):
+        """Apply (method, resource) events with as few flow batches as possible.
+
+        A flow batch runs its deletes before its adds, so an event deleting
+        flows which an earlier event of the batch added starts a new one.
+        """
+        flow_batch = getattr(self.ovs_network_driver, 'flow_batch', None)
+        segments = []
+        for method, resource in events:
+            deleting = method.endswith('_deleted')
+            if not segments or (deleting and not segments[-1][-1][0].endswith('_deleted')):
+                segments.append([])
+            segments[-1].append((method, resource))
+        for segment in segments:
+            try:
+                with self.ovs_network_metrics.measure('ovs_topology_changed'):
+                    with (flow_batch() if flow_batch else _no_batch()):
+                        for method, resource in segment:
+                            try:
+                                self._measured(method)(context, resource)
+                            except Exception:
+                                LOG.exception(_("ovs network event %(method)s failed on %(resource)s"),
+                                              {'method': method, 'resource': resource})
+            except Exception:
+                LOG.exception(_("Failed to apply %d ovs network events"), len(segment))
+        LOG.info(_("Applied %d ovs network events by driver %s"), len(events), self.ovs_network_driver)
+
+    def get_ovs_network_queue_stats(self):
+        if self.ovs_network_queue:
+            return self.ovs_network_queue.get_stats()
+        return {}
+
+    def get_ovs_network_metrics(self):
+        return self.ovs_network_metrics.get_stats()
+
+    def get_ovs_network_metrics_summary(self):
+        return self.ovs_network_metrics.get_summary()
+
+    def start_ovs_network_stats_report(self):
+        """Report the endpoint counters every ovs_network_stats_interval.
+
+        The agent must have set plugin_rpc and context.
+        """
+        interval = cfg.CONF.OVSNETWORK.ovs_network_stats_interval
+        if not interval or not hasattr(self.ovs_network_driver, 'get_endpoint_counters'):
+            return
+        self.ovs_network_stats_loop = loopingcall.FixedIntervalLoopingCall(
+            self.report_ovs_network_stats)
+        self.ovs_network_stats_loop.start(interval=interval)
+
+    def report_ovs_network_stats(self):
+        try:
+            counters = self._measured('get_endpoint_counters')()
+        except Exception:
+            LOG.exception(_("Failed to collect ovs network counters on %s"), cfg.CONF.host)
+            return
+        stats = [dict(counters[tunnel_id], tunnel_id=tunnel_id)
+                 for tunnel_id in sorted(counters)]
+        try:
+            for i in range(0, len(stats), STATS_BATCH_SIZE):
+                self.plugin_rpc.update_ovs_network_stats(
+                    self.context, cfg.CONF.host, stats[i:i + STATS_BATCH_SIZE])
+        except Exception:
+            LOG.exception(_("Failed to report ovs network counters of %s"), cfg.CONF.host)
+
+    def setup_ovs_network_tunneling(self, tun_br, patch_int_ofport,
+                                    patch_tun_ofport, tun_table,
+                                    get_tunnel_ofport, local_vlans):
+        """Let the driver reach peer endpoints on other hosts via br-tun.
+
+        See OVSNetworkDriver.setup_tunneling().
+        """
+        if not self.ovs_network_driver or not hasattr(self.ovs_network_driver, 'setup_tunneling'):
+            return
+        self.ovs_network_driver.setup_tunneling(tun_br, patch_int_ofport,
+                                                patch_tun_ofport, tun_table,
+                                                get_tunnel_ofport, local_vlans)
+
+    def reconcile_ovs_networks(self, topology=None):
+        """Repair the ovs networks of this host, e.g. after an OVS restart.
+
+        :param topology: optional full topology of this host, see
+                         OVSNetworkDriver.reconcile().
+        :returns: False if it failed.
+        """
+        if not self.ovs_network_driver:
+            return True
+        if self.ovs_network_queue:
+            # the reconciler works on the whole host
+            self.ovs_network_queue.wait_idle()
+        try:
+            changes = self._measured('reconcile')(topology)
+        except Exception:
+            LOG.exception(_("Failed to reconcile ovs networks on %s"), cfg.CONF.host)
+            return False
+        LOG.info(_("Reconciled ovs networks by driver %s: %s"), self.ovs_network_driver, changes)
+        return True
+
+    def sync_ovs_networks(self):
+        """Converge on the topology of this host as the server knows it.
+
+        Used at startup and whenever the agent may have missed events.
+
+        :returns: False if it failed and should be retried.
+        """
+        self.ovs_network_sync_needed = False
+        if not self.ovs_network_driver:
+            return True
+        try:
+            topology = self.plugin_rpc.get_ovs_network_topology(self.context, cfg.CONF.host)
+        except Exception:
+            LOG.exception(_("Failed to get the ovs network topology of %s"), cfg.CONF.host)
+            # still repair what the driver has recorded
+            self.reconcile_ovs_networks()
+            return False
+        if not self.reconcile_ovs_networks(topology):
+            return False
+        if topology.get('revision') is not None:
+            # events applied while the topology was on its way may have
+            # been undone, apply again all those it does not include
+            self.ovs_network_revision = topology['revision']
+            self.catch_up_ovs_networks(self.context)
+        return True
 
     def ovs_network_created(self, context, ovs_network):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_network_created(context, ovs_network)
+            self._apply_ovs_network_event(ovs_network['id'], 'ovs_network_created', context, ovs_network)
         LOG.info(_("Create ovs network %s by driver %s"), ovs_network, self.ovs_network_driver)
 
     def ovs_network_updated(self, context, ovs_network):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_network_updated(context, ovs_network)
+            self._apply_ovs_network_event(ovs_network['id'], 'ovs_network_updated', context, ovs_network)
         LOG.info(_("Update ovs network %s by driver %s"), ovs_network, self.ovs_network_driver)
 
     def ovs_network_deleted(self, context, id):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_network_deleted(context, id)
+            self._apply_ovs_network_event(id, 'ovs_network_deleted', context, id)
         LOG.info(_("Delete ovs network %s by driver %s"), id, self.ovs_network_driver)
 
     def ovs_link_left_endpoint_created(self, context, ovs_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_link_left_endpoint_created(context, ovs_link)
+            self._apply_ovs_network_event(ovs_link['left_ovs_id'], 'ovs_link_left_endpoint_created', context, ovs_link)
         LOG.info(_("Create left endpoint of ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
 
     def ovs_link_right_endpoint_created(self, context, ovs_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_link_right_endpoint_created(context, ovs_link)
+            self._apply_ovs_network_event(ovs_link['right_ovs_id'], 'ovs_link_right_endpoint_created', context, ovs_link)
         LOG.info(_("Create right endpoint of ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
 
     def ovs_link_left_endpoint_deleted(self, context, ovs_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_link_left_endpoint_deleted(context, ovs_link)
+            self._apply_ovs_network_event(ovs_link['left_ovs_id'], 'ovs_link_left_endpoint_deleted', context, ovs_link)
         LOG.info(_("Delete left endpoint of ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
 
     def ovs_link_right_endpoint_deleted(self, context, ovs_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.ovs_link_right_endpoint_deleted(context, ovs_link)
+            self._apply_ovs_network_event(ovs_link['right_ovs_id'], 'ovs_link_right_endpoint_deleted', context, ovs_link)
         LOG.info(_("Delete right endpoint of ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
 
+    def ovs_link_direct_created(self, context, ovs_link):
+        if self.ovs_network_driver:
+            self._apply_ovs_network_event((ovs_link['left_ovs_id'], ovs_link['right_ovs_id']), 'ovs_link_direct_created', context, ovs_link)
+        LOG.info(_("Create direct ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
+
+    def ovs_link_direct_deleted(self, context, ovs_link):
+        if self.ovs_network_driver:
+            self._apply_ovs_network_event((ovs_link['left_ovs_id'], ovs_link['right_ovs_id']), 'ovs_link_direct_deleted', context, ovs_link)
+        LOG.info(_("Delete direct ovs link %s by driver %s"), ovs_link, self.ovs_network_driver)
+
     def vm_link_vm_endpoint_created(self, context, vm_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.vm_link_vm_endpoint_created(context, vm_link)
+            self._apply_ovs_network_event(vm_link['ovs_network_id'], 'vm_link_vm_endpoint_created', context, vm_link)
         LOG.info(_("Create vm endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
 
     def vm_link_vm_endpoint_updated(self, context, vm_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.vm_link_vm_endpoint_updated(context, vm_link)
+            self._apply_ovs_network_event((vm_link.get('old_ovs_network_id', vm_link['ovs_network_id']), vm_link['ovs_network_id']), 'vm_link_vm_endpoint_updated', context, vm_link)
         LOG.info(_("Update vm endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
 
     def vm_link_vm_endpoint_deleted(self, context, vm_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.vm_link_vm_endpoint_deleted(context, vm_link)
+            self._apply_ovs_network_event(vm_link['ovs_network_id'], 'vm_link_vm_endpoint_deleted', context, vm_link)
         LOG.info(_("Delete vm endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
 
     def vm_link_ovs_endpoint_created(self, context, vm_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.vm_link_ovs_endpoint_created(context, vm_link)
+            self._apply_ovs_network_event(vm_link['ovs_network_id'], 'vm_link_ovs_endpoint_created', context, vm_link)
         LOG.info(_("Create ovs endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
 
+    def vm_link_ovs_endpoint_updated(self, context, vm_link):
+        if self.ovs_network_driver:
+            self._apply_ovs_network_event(vm_link['ovs_network_id'], 'vm_link_ovs_endpoint_updated', context, vm_link)
+        LOG.info(_("Update ovs endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
+
     def vm_link_ovs_endpoint_deleted(self, context, vm_link):
         if self.ovs_network_driver:
-            self.ovs_network_driver.vm_link_ovs_endpoint_deleted(context, vm_link)
+            self._apply_ovs_network_event(vm_link['ovs_network_id'], 'vm_link_ovs_endpoint_deleted', context, vm_link)
         LOG.info(_("Delete ovs endpoint of vm link %s by driver %s"), vm_link, self.ovs_network_driver)
@@ -0,0 +1,69 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Indexes of the ovs network tables
+
+Revision ID: 1e5b3f7a9c24
+Revises: 52d1a7c3e8f0
+Create Date: 2014-12-22 10:37:15.480253
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1e5b3f7a9c24'
+down_revision = '52d1a7c3e8f0'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+
+from neutron.db import migration
+
+
+# (table, column, unique, column is a foreign key)
+INDEXES = (
+    ('vmlinks', 'vm_port_id', False, True),
+    ('vmlinks', 'ovs_network_id', False, True),
+    ('vmlinks', 'vm_host', False, False),
+    ('ovslinks', 'left_ovs_id', False, True),
+    ('ovslinks', 'right_ovs_id', False, True),
+    ('ovsnetworks', 'host', False, False),
+    ('tunnelkeys', 'port_id', True, True),
+)
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    for table, column, unique, _fk in INDEXES:
+        op.create_index('ix_%s_%s' % (table, column), table, [column],
+                        unique=unique)
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    # MySQL dropped the index it had made for a foreign key when ours was
+    # created, and refuses to drop ours as the foreign key needs it
+    mysql = op.get_bind().dialect.name == 'mysql'
+    for table, column, _unique, fk in INDEXES:
+        if not (mysql and fk):
+            op.drop_index('ix_%s_%s' % (table, column), table)
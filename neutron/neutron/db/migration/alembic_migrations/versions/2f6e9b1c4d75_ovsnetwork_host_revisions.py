@@ -0,0 +1,59 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Last revision of the ovs network change log of each host
+
+Revision ID: 2f6e9b1c4d75
+Revises: 4a8b2c6d1f93
+Create Date: 2015-01-12 11:02:46.190385
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f6e9b1c4d75'
+down_revision = '4a8b2c6d1f93'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table('ovsnetworkhostrevisions',
+    sa.Column('host', sa.String(length=255), nullable=False),
+    sa.Column('revision', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('host'),
+    mysql_default_charset=u'utf8',
+    mysql_engine=u'InnoDB'
+    )
+    op.execute("INSERT INTO ovsnetworkhostrevisions (host, revision) "
+               "SELECT host, MAX(id) FROM ovsnetworkchanges GROUP BY host")
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_table('ovsnetworkhostrevisions')
@@ -0,0 +1,66 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Traffic counters of ovs link and vm link endpoints
+
+Revision ID: 3c1f0a9d7e25
+Revises: 678dd7887ab
+Create Date: 2014-12-08 10:21:37.402159
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0a9d7e25'
+down_revision = '678dd7887ab'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table('ovsnetworkportstats',
+    sa.Column('port_id', sa.String(length=36), nullable=False),
+    sa.Column('rx_packets', sa.BigInteger(), nullable=False),
+    sa.Column('rx_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('tx_packets', sa.BigInteger(), nullable=False),
+    sa.Column('tx_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('rx_packet_rate', sa.Float(), nullable=False),
+    sa.Column('rx_byte_rate', sa.Float(), nullable=False),
+    sa.Column('tx_packet_rate', sa.Float(), nullable=False),
+    sa.Column('tx_byte_rate', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['port_id'], ['ports.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('port_id'),
+    mysql_default_charset=u'utf8',
+    mysql_engine=u'InnoDB'
+    )
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_table('ovsnetworkportstats')
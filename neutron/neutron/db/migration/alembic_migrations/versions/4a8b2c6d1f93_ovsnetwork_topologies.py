@@ -0,0 +1,75 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Ovs topologies
+
+Revision ID: 4a8b2c6d1f93
+Revises: 1e5b3f7a9c24
+Create Date: 2015-01-06 14:21:08.735914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a8b2c6d1f93'
+down_revision = '1e5b3f7a9c24'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+# the tables whose rows may belong to an ovs topology
+MEMBER_TABLES = ('ovsnetworks', 'ovslinks', 'vmlinks')
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table('ovstopologies',
+    sa.Column('tenant_id', sa.String(length=255), nullable=True),
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name', 'tenant_id'),
+    mysql_default_charset=u'utf8',
+    mysql_engine=u'InnoDB'
+    )
+
+    for table in MEMBER_TABLES:
+        op.add_column(table, sa.Column('topology_id', sa.String(length=36),
+                                       nullable=True))
+        op.create_index('ix_%s_topology_id' % table, table, ['topology_id'])
+        op.create_foreign_key('%s_topology_id_fkey' % table, table,
+                              'ovstopologies', ['topology_id'], ['id'])
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    for table in MEMBER_TABLES:
+        op.drop_constraint('%s_topology_id_fkey' % table, table,
+                           type_='foreignkey')
+        op.drop_index('ix_%s_topology_id' % table, table)
+        op.drop_column(table, 'topology_id')
+    op.drop_table('ovstopologies')
@@ -0,0 +1,70 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Revisions and change log of ovs networks
+
+Revision ID: 52d1a7c3e8f0
+Revises: 3c1f0a9d7e25
+Create Date: 2014-12-15 16:04:52.117806
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52d1a7c3e8f0'
+down_revision = '3c1f0a9d7e25'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    for table in ('ovsnetworks', 'vmlinks', 'ovslinks'):
+        op.add_column(table, sa.Column('revision', sa.Integer(),
+                                       nullable=False, server_default='0'))
+
+    op.create_table('ovsnetworkchanges',
+    sa.Column('id', sa.Integer(), nullable=False, autoincrement=True),
+    sa.Column('host', sa.String(length=255), nullable=False),
+    sa.Column('method', sa.String(length=64), nullable=False),
+    sa.Column('resource', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    mysql_default_charset=u'utf8',
+    mysql_engine=u'InnoDB'
+    )
+    op.create_index('ovsnetworkchanges_host_id', 'ovsnetworkchanges',
+                    ['host', 'id'])
+    op.create_index('ix_ovsnetworkchanges_created_at',
+                    'ovsnetworkchanges', ['created_at'])
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_table('ovsnetworkchanges')
+    for table in ('ovsnetworks', 'vmlinks', 'ovslinks'):
+        op.drop_column(table, 'revision')
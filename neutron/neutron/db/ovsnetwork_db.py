@@ -17,23 +17,31 @@
 # @author: Jian LI, BUPT
 # Tunnelkey is copied from ryu plugin in icehouse release
 
+import collections
+import datetime
+import threading
+
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.orm import exc
 from sqlalchemy import UniqueConstraint
 
 from sqlalchemy import func
+from sqlalchemy import event
 from sqlalchemy import exc as sa_exc
 
 from neutron.api.v2 import attributes as attr
+from neutron.db import api as db_api
 from neutron.db import db_base_plugin_v2
 from neutron.db import portbindings_db
 from neutron.db import model_base
 from neutron.db import models_v2
 
 from neutron.extensions import ovsnetwork as ext_ovsnetwork
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import uuidutils
 from neutron.openstack.common import log as logging
+from neutron.openstack.common import timeutils
 from neutron.common import exceptions as n_exc
 from oslo.config import cfg
 
@@ -42,6 +50,23 @@ from oslo.config import cfg
 
 LOG = logging.getLogger(__name__)
 
+ovs_network_change_opts = [
+    cfg.IntOpt('change_log_ttl', default=86400,
+               help=_('Seconds the events sent to the agents are kept in '
+                      'the ovs network change log. An agent which missed '
+                      'older events resyncs its whole topology.')),
+    cfg.IntOpt('change_log_prune_interval', default=60,
+               help=_('Seconds between two runs of the server task deleting '
+                      'the changes older than change_log_ttl. 0 disables '
+                      'it.')),
+]
+cfg.CONF.register_opts(ovs_network_change_opts, 'OVSNETWORK')
+
+LINK_COUNTERS = ('rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes')
+LINK_RATES = ('rx_packet_rate', 'rx_byte_rate', 'tx_packet_rate',
+              'tx_byte_rate')
+OVS_TOPOLOGY_MEMBERS = ('ovs_networks', 'ovs_links', 'vm_links')
+
 
 class TunnelKeyLast(model_base.BASEV2):
     """Last allocated Tunnel key.
@@ -57,7 +82,7 @@ class TunnelKeyLast(model_base.BASEV2):
 class TunnelKey(model_base.BASEV2):
     """Port ID <-> tunnel key mapping."""
     port_id = sa.Column(sa.String(36), sa.ForeignKey("ports.id"),
-                        nullable=False)
+                        nullable=False, unique=True, index=True)
     tunnel_key = sa.Column(sa.Integer, primary_key=True,
                            nullable=False, autoincrement=False)
 
@@ -70,22 +95,57 @@ class OVSNetwork(model_base.BASEV2, models_v2.HasTenant):
                    sa.ForeignKey("networks.id", ondelete='CASCADE'),
                    primary_key=True)
     name = sa.Column(sa.String(255))
-    host = sa.Column(sa.String(255), nullable=True)
+    host = sa.Column(sa.String(255), nullable=True, index=True)
     controller_ipv4_address = sa.Column(sa.String(36))
     controller_port_num = sa.Column(sa.Integer) 
+    # the last change sent to the agent
+    revision = sa.Column(sa.Integer, nullable=False, default=0)
+    # the ovs topology which created the ovs network, if any
+    topology_id = sa.Column(sa.String(36), sa.ForeignKey('ovstopologies.id'),
+                            nullable=True, index=True)
     __table_args__ = (
         UniqueConstraint("name", "tenant_id"),
     )
 
 
+class OVSNetworkPortStats(model_base.BASEV2):
+    """Traffic of an ovs link or vm link endpoint, as counted by its agent.
+
+    tx is what the endpoint sent into the link, rx what it received. The
+    rates are per second, between the last two reports.
+    """
+    port_id = sa.Column(sa.String(36),
+                        sa.ForeignKey("ports.id", ondelete='CASCADE'),
+                        primary_key=True)
+    rx_packets = sa.Column(sa.BigInteger, nullable=False, default=0)
+    rx_bytes = sa.Column(sa.BigInteger, nullable=False, default=0)
+    tx_packets = sa.Column(sa.BigInteger, nullable=False, default=0)
+    tx_bytes = sa.Column(sa.BigInteger, nullable=False, default=0)
+    rx_packet_rate = sa.Column(sa.Float, nullable=False, default=0.0)
+    rx_byte_rate = sa.Column(sa.Float, nullable=False, default=0.0)
+    tx_packet_rate = sa.Column(sa.Float, nullable=False, default=0.0)
+    tx_byte_rate = sa.Column(sa.Float, nullable=False, default=0.0)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+
+
 class VMLink(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
     name = sa.Column(sa.String(255))
-    vm_port_id = sa.Column(sa.String(36), sa.ForeignKey("ports.id", ondelete='CASCADE'))
+    vm_port_id = sa.Column(sa.String(36), sa.ForeignKey("ports.id", ondelete='CASCADE'), index=True)
     vm_ofport = sa.Column(sa.Integer, nullable=True)
     status = sa.Column(sa.String(16), nullable=False)
-    vm_host = sa.Column(sa.String(255), nullable=True)
+    vm_host = sa.Column(sa.String(255), nullable=True, index=True)
     ovs_port_id = sa.Column(sa.String(36), sa.ForeignKey("ports.id", ondelete='CASCADE'))
-    ovs_network_id = sa.Column(sa.String(36), sa.ForeignKey("ovsnetworks.id", ondelete='CASCADE'))
+    ovs_network_id = sa.Column(sa.String(36), sa.ForeignKey("ovsnetworks.id", ondelete='CASCADE'), index=True)
+    # the last change sent to an agent
+    revision = sa.Column(sa.Integer, nullable=False, default=0)
+    topology_id = sa.Column(sa.String(36), sa.ForeignKey('ovstopologies.id'),
+                            nullable=True, index=True)
+    # the traffic of a vm link is counted at its ovs endpoint
+    ovs_port_stats = orm.relationship(
+        OVSNetworkPortStats,
+        primaryjoin='VMLink.ovs_port_id == OVSNetworkPortStats.port_id',
+        foreign_keys='OVSNetworkPortStats.port_id',
+        uselist=False, lazy='joined', viewonly=True)
     __table_args__ = (
         UniqueConstraint("name", "tenant_id"),
     )
@@ -98,24 +158,91 @@ class OVSLink(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
     right_port_id = sa.Column(sa.String(36),
                               sa.ForeignKey("ports.id", ondelete='CASCADE'))
     left_ovs_id = sa.Column(sa.String(36),
-                            sa.ForeignKey('ovsnetworks.id', ondelete='CASCADE'))
+                            sa.ForeignKey('ovsnetworks.id', ondelete='CASCADE'),
+                            index=True)
     right_ovs_id = sa.Column(sa.String(36),
-                            sa.ForeignKey('ovsnetworks.id', ondelete='CASCADE'))
+                            sa.ForeignKey('ovsnetworks.id', ondelete='CASCADE'),
+                            index=True)
+    # the last change sent to an agent
+    revision = sa.Column(sa.Integer, nullable=False, default=0)
+    topology_id = sa.Column(sa.String(36), sa.ForeignKey('ovstopologies.id'),
+                            nullable=True, index=True)
+    # the traffic of an ovs link is counted at its left endpoint
+    left_port_stats = orm.relationship(
+        OVSNetworkPortStats,
+        primaryjoin='OVSLink.left_port_id == OVSNetworkPortStats.port_id',
+        foreign_keys='OVSNetworkPortStats.port_id',
+        uselist=False, lazy='joined', viewonly=True)
     __table_args__ = (
         UniqueConstraint("name", "tenant_id"),
     )
 
 
+class OVSTopology(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
+    """A graph of ovs networks and links created and deleted as a whole."""
+    __tablename__ = 'ovstopologies'
+    name = sa.Column(sa.String(255))
+    ovs_networks = orm.relationship(OVSNetwork, lazy='subquery',
+                                    viewonly=True)
+    ovs_links = orm.relationship(OVSLink, lazy='subquery', viewonly=True)
+    vm_links = orm.relationship(VMLink, lazy='subquery', viewonly=True)
+    __table_args__ = (
+        UniqueConstraint("name", "tenant_id"),
+    )
+
+
+class OVSNetworkChange(model_base.BASEV2):
+    """An event sent to the agent of host, in the change log of the host.
+
+    The id is the revision of the change, increasing over all hosts.
+    """
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    host = sa.Column(sa.String(255), nullable=False)
+    method = sa.Column(sa.String(64), nullable=False)
+    # JSON, the resource argument of the event
+    resource = sa.Column(sa.Text, nullable=False)
+    created_at = sa.Column(sa.DateTime, nullable=False, index=True)
+    __table_args__ = (
+        sa.Index('ovsnetworkchanges_host_id', 'host', 'id'),
+    )
+
+
+class OVSNetworkHostRevision(model_base.BASEV2):
+    """The last revision in the change log of a host.
+
+    Writers lock the row of a host, so the events of a host get increasing
+    revisions in the order they are committed.
+    """
+    host = sa.Column(sa.String(255), primary_key=True)
+    revision = sa.Column(sa.Integer, nullable=False, default=0)
+
+
 class TunnelKeyDbMixin(object):
+    """Allocate tunnel keys from chunks reserved in the database.
+
+    TunnelKeyLast is the high-water mark of the reserved keys. A process
+    moves it forward by a whole chunk in a short transaction of its own,
+    wrapping around at key_max, and hands the keys of the chunk which are
+    not in use out of memory, so the allocation of a key costs no query
+    and processes do not contend. Keys it releases are reused last, once
+    the keys of the reserved chunks are used up, which gives the agents
+    time to remove the flows of a key before another port gets it.
+
+    Once the reservation has wrapped around, another process may hand
+    out keys of the same chunk, and then the INSERT of a key fails. The
+    allocation drops its unused keys and retries with a fresh chunk.
+    """
     # VLAN: 12 bits
     # GRE, VXLAN: 24bits
     # TODO(yamahata): STT: 64bits
     _KEY_MIN_HARD = 1
     _KEY_MAX_HARD = 0xffffffff
 
-    def __init__(self, key_min=_KEY_MIN_HARD, key_max=_KEY_MAX_HARD):
+    def __init__(self, key_min=_KEY_MIN_HARD, key_max=_KEY_MAX_HARD,
+                 chunk_size=1024):
         self.key_min = key_min
         self.key_max = key_max
+        self.chunk_size = chunk_size
 
         if (key_min < self._KEY_MIN_HARD or key_max > self._KEY_MAX_HARD or
                 key_min > key_max):
@@ -124,126 +251,155 @@ class TunnelKeyDbMixin(object):
                                'tunnel_key_max: %(key_max)d. '
                                'Using default value') % {'key_min': key_min,
                                                          'key_max': key_max})
+        # unused keys of the reserved chunks and released keys
+        self._free = collections.deque()
+        self._lock = threading.Lock()
 
     def _last_key(self, session):
         try:
-            return session.query(TunnelKeyLast).one()
+            return session.query(TunnelKeyLast).with_lockmode('update').one()
         except exc.MultipleResultsFound:
             max_key = session.query(
-                func.max(TunnelKeyLast.last_key))
+                func.max(TunnelKeyLast.last_key)).scalar()
             if max_key > self.key_max:
                 max_key = self.key_min
 
             session.query(TunnelKeyLast).delete()
             last_key = TunnelKeyLast(last_key=max_key)
         except exc.NoResultFound:
-            last_key = TunnelKeyLast(last_key=self.key_min)
+            last_key = TunnelKeyLast(last_key=self.key_min - 1)
 
         session.add(last_key)
         session.flush()
-        return session.query(TunnelKeyLast).one()
-
-    def _find_key(self, session, last_key):
-        """Try to find unused tunnel key.
-        Trying to find unused tunnel key in TunnelKey table starting
-        from last_key + 1.
-        When all keys are used, raise sqlalchemy.orm.exc.NoResultFound
-        """
-        # key 0 is used for special meanings. So don't allocate 0.
-
-        # sqlite doesn't support
-        # '(select order by limit) union all (select order by limit) '
-        # 'order by limit'
-        # So do it manually
-        # new_key = session.query("new_key").from_statement(
-        #     # If last_key + 1 isn't used, it's the result
-        #     'SELECT new_key '
-        #     'FROM (SELECT :last_key + 1 AS new_key) q1 '
-        #     'WHERE NOT EXISTS '
-        #     '(SELECT 1 FROM tunnelkeys WHERE tunnel_key = :last_key + 1) '
-        #
-        #     'UNION ALL '
-        #
-        #     # if last_key + 1 used,
-        #     # find the least unused key from last_key + 1
-        #     '(SELECT t.tunnel_key + 1 AS new_key '
-        #     'FROM tunnelkeys t '
-        #     'WHERE NOT EXISTS '
-        #     '(SELECT 1 FROM tunnelkeys ti '
-        #     ' WHERE ti.tunnel_key = t.tunnel_key + 1) '
-        #     'AND t.tunnel_key >= :last_key '
-        #     'ORDER BY new_key LIMIT 1) '
-        #
-        #     'ORDER BY new_key LIMIT 1'
-        # ).params(last_key=last_key).one()
-        try:
-            new_key = session.query("new_key").from_statement(
-                # If last_key + 1 isn't used, it's the result
-                'SELECT new_key '
-                'FROM (SELECT :last_key + 1 AS new_key) q1 '
-                'WHERE NOT EXISTS '
-                '(SELECT 1 FROM tunnelkeys WHERE tunnel_key = :last_key + 1) '
-            ).params(last_key=last_key).one()
-        except exc.NoResultFound:
-            new_key = session.query("new_key").from_statement(
-                # if last_key + 1 used,
-                # find the least unused key from last_key + 1
-                '(SELECT t.tunnel_key + 1 AS new_key '
-                'FROM tunnelkeys t '
-                'WHERE NOT EXISTS '
-                '(SELECT 1 FROM tunnelkeys ti '
-                ' WHERE ti.tunnel_key = t.tunnel_key + 1) '
-                'AND t.tunnel_key >= :last_key '
-                'ORDER BY new_key LIMIT 1) '
-            ).params(last_key=last_key).one()
-
-        new_key = new_key[0]  # the result is tuple.
-        LOG.debug(_("last_key %(last_key)s new_key %(new_key)s"),
-                  {'last_key': last_key, 'new_key': new_key})
-        if new_key > self.key_max:
-            LOG.debug(_("No key found"))
-            raise exc.NoResultFound()
-        return new_key
-
-    def _allocate(self, session, port_id):
-        last_key = self._last_key(session)
-        try:
-            new_key = self._find_key(session, last_key.last_key)
-        except exc.NoResultFound:
-            new_key = self._find_key(session, self.key_min)
-
-        tunnel_key = TunnelKey(port_id=port_id,
-                               tunnel_key=new_key)
-        last_key.last_key = new_key
-        session.add(tunnel_key)
-        return new_key
+        return session.query(TunnelKeyLast).with_lockmode('update').one()
+
+    def _reserve_chunk(self):
+        """Reserve the next chunk and queue its keys which are not in use."""
+        session = db_api.get_session()
+        with session.begin():
+            last_key = self._last_key(session)
+            first = last_key.last_key + 1
+            if first < self.key_min or first > self.key_max:
+                first = self.key_min
+            last = min(first + self.chunk_size - 1, self.key_max)
+            last_key.last_key = last
+            used = set(key for key, in session.query(TunnelKey.tunnel_key).
+                       filter(TunnelKey.tunnel_key.between(first, last)))
+        LOG.debug(_("Reserved tunnel keys %(first)s-%(last)s, %(used)d in use"),
+                  {'first': first, 'last': last, 'used': len(used)})
+        self._free.extend(key for key in xrange(first, last + 1)
+                          if key not in used)
 
     _TRANSACTION_RETRY_MAX = 16
 
-    def allocate(self, session, port_id):
+    def _next_keys(self, number):
+        # going once around the whole key space without enough free keys
+        # means it is exhausted
+        chunks = ((self.key_max - self.key_min) // self.chunk_size) + 1
         count = 0
-        while True:
-            session.begin(subtransactions=True)
-            try:
-                new_key = self._allocate(session, port_id)
-                session.commit()
-                break
-            except sa_exc.SQLAlchemyError:
-                session.rollback()
-
-            count += 1
-            if count > self._TRANSACTION_RETRY_MAX:
-                # if this happens too often, increase _TRANSACTION_RETRY_MAX
-                LOG.warn(_("Transaction retry exhausted (%d). "
-                           "Abandoned tunnel key allocation."), count)
-                raise n_exc.ResourceExhausted()
-
-        return new_key
+        with self._lock:
+            while len(self._free) < number:
+                if chunks <= 0:
+                    raise n_exc.ResourceExhausted()
+                try:
+                    self._reserve_chunk()
+                    chunks -= 1
+                except sa_exc.SQLAlchemyError:
+                    # e.g. two processes creating TunnelKeyLast at once
+                    count += 1
+                    if count > self._TRANSACTION_RETRY_MAX:
+                        LOG.warn(_("Transaction retry exhausted (%d). "
+                                   "Abandoned tunnel key allocation."), count)
+                        raise n_exc.ResourceExhausted()
+            return [self._free.popleft() for i in xrange(number)]
+
+    def _release(self, keys):
+        with self._lock:
+            self._free.extend(keys)
+
+    def _drop_free_keys(self):
+        # their chunk is shared with another process, they come back
+        # when the reservation wraps around again
+        with self._lock:
+            self._free.clear()
+
+    def allocate(self, session, port_id):
+        return self.allocate_many(session, [port_id])[0]
+
+    def allocate_many(self, session, port_ids):
+        """Allocate a key to each port with a single INSERT.
+
+        :returns: the keys, in the order of port_ids.
+        """
+        if not port_ids:
+            return []
+        with session.begin(subtransactions=True):
+            for count in xrange(self._TRANSACTION_RETRY_MAX):
+                new_keys = self._next_keys(len(port_ids))
+                try:
+                    # a failed INSERT rolls back to the savepoint only and
+                    # leaves the transaction of the caller usable
+                    with session.begin_nested():
+                        session.execute(
+                            TunnelKey.__table__.insert(),
+                            [{'port_id': port_id, 'tunnel_key': new_key}
+                             for port_id, new_key in zip(port_ids,
+                                                         new_keys)])
+                    return new_keys
+                except sa_exc.IntegrityError:
+                    if session.query(TunnelKey).filter(
+                            TunnelKey.port_id.in_(port_ids)).first():
+                        # not a key taken by another process
+                        raise
+                    LOG.debug(_("Tunnel keys %s are in use by another "
+                                "process, reserving a new chunk"), new_keys)
+                    self._drop_free_keys()
+        LOG.warn(_("Transaction retry exhausted (%d). "
+                   "Abandoned tunnel key allocation."),
+                 self._TRANSACTION_RETRY_MAX)
+        raise n_exc.ResourceExhausted()
 
     def delete(self, session, port_id):
-        session.query(TunnelKey).filter_by(
-            port_id=port_id).delete()
-        session.flush()
+        self.release_many(session, [port_id])
+
+    def release_many(self, session, port_ids):
+        """Release the keys of ports with one SELECT and one DELETE.
+
+        :returns: {port id: released key}
+        """
+        if not port_ids:
+            return {}
+        with session.begin(subtransactions=True):
+            query = session.query(TunnelKey).filter(
+                TunnelKey.port_id.in_(port_ids))
+            keys = dict((key.port_id, key.tunnel_key) for key in query)
+            query.delete(synchronize_session=False)
+        self._release_on_commit(session, keys.values())
+        return keys
+
+    def _release_on_commit(self, session, keys):
+        """Reuse keys once the transaction deleting their rows commits.
+
+        Until then a rollback keeps the rows, and allocating the keys again
+        would fail on their unique constraint.
+        """
+        if session.transaction is None:
+            self._release(keys)
+            return
+        pending = getattr(session, '_released_tunnel_keys', None)
+        if pending is None:
+            pending = session._released_tunnel_keys = []
+
+            def after_commit(session):
+                if not session.transaction.nested:
+                    self._release(pending)
+                    del pending[:]
+
+            def after_rollback(session):
+                del pending[:]
+            event.listen(session, 'after_commit', after_commit)
+            event.listen(session, 'after_rollback', after_rollback)
+        pending.extend(keys)
 
     def get(self, session, port_id):
         return session.query(TunnelKey).filter_by(
@@ -253,6 +409,213 @@ class TunnelKeyDbMixin(object):
 class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
     """Mixin class to add ovs network extension to db_plugin_base_v2."""
 
+    def _get_host_revision(self, session, host):
+        return session.query(OVSNetworkHostRevision.revision).filter(
+            OVSNetworkHostRevision.host == host).scalar() or 0
+
+    def _lock_host_revision(self, session, host):
+        query = session.query(OVSNetworkHostRevision).filter(
+            OVSNetworkHostRevision.host == host)
+        # not with a locking read, which would lock the gap of a missing
+        # row and block the insert below until the caller commits
+        if not query.first():
+            self._add_host_revision(host)
+        return query.with_lockmode('update').one()
+
+    def _add_host_revision(self, host):
+        # in a session of its own, a failed insert would end the transaction
+        # of the caller
+        session = db_api.get_session()
+        try:
+            with session.begin():
+                session.add(OVSNetworkHostRevision(host=host, revision=0))
+        except sa_exc.IntegrityError:
+            # another writer added it first
+            pass
+
+    def record_ovs_network_change(self, context, host, method, resource):
+        """Append an event of host to its change log.
+
+        Called in the transaction of the change itself, so that the
+        event is logged if and only if the change commits. A dict resource
+        gets the revision of the event and the previous one of host, which
+        lets the agent spot a gap, and its ovs network, ovs link or vm link
+        row the revision.
+
+        :returns: {'revision': ..., 'prev_revision': ...}
+        """
+        session = context.session
+        now = timeutils.utcnow()
+        with session.begin(subtransactions=True):
+            # held until commit, a concurrent writer for host waits here and
+            # then gets a higher revision chained to this one
+            host_revision = self._lock_host_revision(session, host)
+            change = OVSNetworkChange(host=host, method=method, resource='',
+                                      created_at=now)
+            session.add(change)
+            session.flush()
+            revision = {'revision': change.id,
+                        'prev_revision': host_revision.revision}
+            host_revision.revision = change.id
+            if isinstance(resource, dict):
+                resource = dict(resource, **revision)
+                model = (OVSNetwork if method.startswith('ovs_network') else
+                         OVSLink if method.startswith('ovs_link') else VMLink)
+                session.query(model).filter(model.id == resource['id']).update(
+                    {'revision': change.id}, synchronize_session=False)
+            change.resource = jsonutils.dumps(resource)
+        return revision
+
+    def prune_ovs_network_changes(self, context):
+        """Delete the changes older than change_log_ttl.
+
+        Run every change_log_prune_interval by a server task.
+        """
+        cutoff = timeutils.utcnow() - datetime.timedelta(
+            seconds=cfg.CONF.OVSNETWORK.change_log_ttl)
+        session = context.session
+        with session.begin(subtransactions=True):
+            last = session.query(func.max(OVSNetworkChange.id)).scalar()
+            # the last change stays, it marks where the log starts
+            session.query(OVSNetworkChange).filter(
+                OVSNetworkChange.created_at < cutoff,
+                OVSNetworkChange.id < last).delete(synchronize_session=False)
+
+    def get_ovs_network_changes(self, context, host, since):
+        """The events of host after revision since, in order.
+
+        :returns: {'resync': True} if some were pruned from the log, else
+                  {'resync': False, 'revision': the last revision,
+                  'changes': [{'method': ..., 'resource': ...}, ...]}
+        """
+        session = context.session
+        with session.begin(subtransactions=True):
+            first = session.query(func.min(OVSNetworkChange.id)).scalar()
+            if first is not None and since < first - 1:
+                return {'resync': True}
+            query = session.query(OVSNetworkChange).filter(
+                OVSNetworkChange.host == host, OVSNetworkChange.id > since)
+            changes = query.order_by(OVSNetworkChange.id).all()
+        return {'resync': False,
+                'revision': changes[-1].id if changes else since,
+                'changes': [{'method': change.method,
+                             'resource': jsonutils.loads(change.resource)}
+                            for change in changes]}
+
+    def _make_link_stats_dict(self, stats):
+        if stats is None:
+            res = dict.fromkeys(LINK_COUNTERS, 0)
+            res.update(dict.fromkeys(LINK_RATES, 0.0))
+            return res
+        return dict((field, stats[field])
+                    for field in LINK_COUNTERS + LINK_RATES)
+
+    def update_ovs_network_stats(self, context, stats):
+        """Store the endpoint counters reported by an agent.
+
+        :param stats: a list of dicts with tunnel_id and LINK_COUNTERS.
+                      Tunnel ids without an endpoint port are ignored.
+        """
+        if not stats:
+            return
+        by_key = dict((int(entry['tunnel_id']), entry) for entry in stats)
+        now = timeutils.utcnow()
+        session = context.session
+        with session.begin(subtransactions=True):
+            keys = session.query(TunnelKey).filter(
+                TunnelKey.tunnel_key.in_(by_key.keys()))
+            counters = dict((key.port_id, by_key[key.tunnel_key])
+                            for key in keys)
+            if not counters:
+                return
+            rows = session.query(OVSNetworkPortStats).filter(
+                OVSNetworkPortStats.port_id.in_(counters.keys()))
+            rows = dict((row.port_id, row) for row in rows)
+            for port_id, entry in counters.items():
+                row = rows.get(port_id)
+                if row is None:
+                    row = OVSNetworkPortStats(port_id=port_id)
+                    session.add(row)
+                else:
+                    elapsed = timeutils.delta_seconds(row.updated_at, now)
+                    for counter, rate in zip(LINK_COUNTERS, LINK_RATES):
+                        value = int(entry.get(counter, 0))
+                        # the counters restart when the flows are replaced
+                        delta = value - row[counter]
+                        if delta < 0:
+                            delta = value
+                        setattr(row, rate,
+                                delta / elapsed if elapsed > 0 else 0.0)
+                for counter in LINK_COUNTERS:
+                    setattr(row, counter, int(entry.get(counter, 0)))
+                row.updated_at = now
+
+
+    def get_ovs_network_topology(self, context, host):
+        """The ovs networks and link endpoints an agent hosts.
+
+        Every link is fetched in one query joining the hosts of its ovs
+        networks and its tunnel keys.
+
+        :returns: the topology of OVSNetworkDriver.reconcile(). The links
+                  carry their tunnel ids and the hosts of their endpoints,
+                  'revision' is the last change of host it includes.
+        """
+        topology = {'ovs_networks': [], 'ovs_link_left_endpoints': [],
+                    'ovs_link_right_endpoints': [], 'ovs_links_direct': [],
+                    'vm_link_ovs_endpoints': [], 'vm_link_vm_endpoints': []}
+        session = context.session
+        with session.begin(subtransactions=True):
+            # what comes later reaches the agent as events
+            topology['revision'] = self._get_host_revision(session, host)
+            query = session.query(OVSNetwork).filter(OVSNetwork.host == host)
+            topology['ovs_networks'] = [self._make_ovs_network_dict(ovs_network)
+                                        for ovs_network in query]
+
+            left_ovs = orm.aliased(OVSNetwork)
+            right_ovs = orm.aliased(OVSNetwork)
+            left_key = orm.aliased(TunnelKey)
+            right_key = orm.aliased(TunnelKey)
+            query = session.query(OVSLink, left_ovs.host, right_ovs.host,
+                                  left_key.tunnel_key, right_key.tunnel_key)
+            query = query.join(left_ovs, left_ovs.id == OVSLink.left_ovs_id)
+            query = query.join(right_ovs, right_ovs.id == OVSLink.right_ovs_id)
+            query = query.outerjoin(left_key, left_key.port_id == OVSLink.left_port_id)
+            query = query.outerjoin(right_key, right_key.port_id == OVSLink.right_port_id)
+            query = query.filter(sa.or_(left_ovs.host == host, right_ovs.host == host))
+            for ovs_link, left_host, right_host, left_tunnel_id, right_tunnel_id in query:
+                ovs_link = self._make_ovs_link_dict(ovs_link)
+                ovs_link.update({'left_host': left_host,
+                                 'right_host': right_host,
+                                 'left_tunnel_id': left_tunnel_id,
+                                 'right_tunnel_id': right_tunnel_id})
+                if left_host == right_host:
+                    topology['ovs_links_direct'].append(ovs_link)
+                    continue
+                if left_host == host:
+                    topology['ovs_link_left_endpoints'].append(ovs_link)
+                if right_host == host:
+                    topology['ovs_link_right_endpoints'].append(ovs_link)
+
+            ovs_key = orm.aliased(TunnelKey)
+            vm_key = orm.aliased(TunnelKey)
+            query = session.query(VMLink, OVSNetwork.host,
+                                  ovs_key.tunnel_key, vm_key.tunnel_key)
+            query = query.join(OVSNetwork, OVSNetwork.id == VMLink.ovs_network_id)
+            query = query.outerjoin(ovs_key, ovs_key.port_id == VMLink.ovs_port_id)
+            query = query.outerjoin(vm_key, vm_key.port_id == VMLink.vm_port_id)
+            query = query.filter(sa.or_(OVSNetwork.host == host, VMLink.vm_host == host))
+            for vm_link, ovs_host, ovs_tunnel_id, vm_tunnel_id in query:
+                vm_link = self._make_vm_link_dict(vm_link)
+                vm_link.update({'ovs_host': ovs_host,
+                                'ovs_tunnel_id': ovs_tunnel_id,
+                                'vm_tunnel_id': vm_tunnel_id})
+                if ovs_host == host:
+                    topology['vm_link_ovs_endpoints'].append(vm_link)
+                # the vm endpoint is set up once the vm is bound
+                if vm_link['vm_host'] == host and vm_link['status'] == 'ACTIVE':
+                    topology['vm_link_vm_endpoints'].append(vm_link)
+        return topology
 
     def _make_ovs_network_dict(self, ovs_network, fields=None):
         res = {'id': ovs_network['id'],
@@ -261,6 +624,7 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                'host': ovs_network['host'],
                'controller_ipv4_address': ovs_network['controller_ipv4_address'],
                'controller_port_num': ovs_network.get('controller_port_num', None),
+               'revision': ovs_network['revision'],
                #'tunnel_key':ovsnetwork.get('tunnel_key',None)
               }       
         return self._fields(res, fields)        
@@ -308,7 +672,8 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                                         name = name,
                                         host = host,
                                         controller_ipv4_address = controller_ipv4_address,
-                                        controller_port_num = controller_port_num)
+                                        controller_port_num = controller_port_num,
+                                        topology_id = ovs_network.get('topology_id'))
             context.session.add(ovs_network_db)
         return self._make_ovs_network_dict(ovs_network_db)
     
@@ -343,7 +708,9 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                'ovs_port_id': vm_link['ovs_port_id'],
                'ovs_network_id': vm_link['ovs_network_id'],
                'status':vm_link['status'],
+               'revision': vm_link['revision'],
               }
+        res.update(self._make_link_stats_dict(vm_link['ovs_port_stats']))
         return self._fields(res, fields)        
 
     def _get_vm_link(self, context, id):
@@ -371,6 +738,22 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
             raise ext_ovsnetwork.OVSNetworkNotFound(id=id)
         return ovs_network['host']
 
+    def _get_ovs_network_hosts_by_ids(self, context, ids):
+        """Return {ovs network id: host} of the ovs networks in one query."""
+        query = self._model_query(context, OVSNetwork)
+        hosts = dict((ovs_network.id, ovs_network.host) for ovs_network in
+                     query.filter(OVSNetwork.id.in_(set(ids))))
+        for id in ids:
+            if id not in hosts:
+                raise ext_ovsnetwork.OVSNetworkNotFound(id=id)
+        return hosts
+
+    def _create_ovs_bulk(self, resource, context, request_items):
+        collection = "%ss" % resource
+        with context.session.begin(subtransactions=True):
+            return [getattr(self, 'create_%s' % resource)(context, item)
+                    for item in request_items[collection]]
+
     def get_vm_link(self, context, id, fields=None):
         with context.session.begin(subtransactions=True):
             vm_link = self._get_vm_link(context, id)
@@ -414,9 +797,13 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                                 vm_host = vm_host,
                                 ovs_port_id = ovs_port_id,
                                 ovs_network_id = ovs_network_id,
-                                status = status)
+                                status = status,
+                                topology_id = vm_link.get('topology_id'))
             context.session.add(vm_link_db)
         return self._make_vm_link_dict(vm_link_db)
+
+    def create_vm_link_bulk(self, context, vm_links):
+        return self._create_ovs_bulk('vm_link', context, vm_links)
     
     def update_vm_link(self, context, id, vm_link):
         vm_link = vm_link['vm_link']
@@ -442,8 +829,10 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                'left_port_id': ovs_link['left_port_id'],
                'left_ovs_id': ovs_link['left_ovs_id'],
                'right_port_id': ovs_link['right_port_id'],
-               'right_ovs_id': ovs_link['right_ovs_id']
+               'right_ovs_id': ovs_link['right_ovs_id'],
+               'revision': ovs_link['revision'],
               }       
+        res.update(self._make_link_stats_dict(ovs_link['left_port_stats']))
         return self._fields(res, fields)        
 
     def _get_ovs_link(self, context, id):
@@ -493,10 +882,14 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
                                   left_port_id = left_port_id,
                                   left_ovs_id = left_ovs_id,
                                   right_port_id = right_port_id,
-                                  right_ovs_id = right_ovs_id)
+                                  right_ovs_id = right_ovs_id,
+                                  topology_id = ovs_link.get('topology_id'))
             context.session.add(ovs_link_db)
         return self._make_ovs_link_dict(ovs_link_db)
 
+    def create_ovs_link_bulk(self, context, ovs_links):
+        return self._create_ovs_bulk('ovs_link', context, ovs_links)
+
     #def update_ovs_link(self, context, id, ovs_link):
     #    # should we support ovs link update? This should be considered in future! lijian
     #    self.delete_ovs_link(context, id)
@@ -508,3 +901,174 @@ class OVSNetworkDbMixin(ext_ovsnetwork.OVSNetworkPluginBase):
         with context.session.begin(subtransactions=True):
             context.session.delete(ovs_link)
         return self._make_ovs_link_dict(ovs_link)
+
+
+    #ovs_topology operation
+    def _make_ovs_topology_dict(self, ovs_topology, fields=None):
+        res = {'id': ovs_topology['id'],
+               'tenant_id': ovs_topology['tenant_id'],
+               'name': ovs_topology['name'],
+              }
+        for collection in OVS_TOPOLOGY_MEMBERS:
+            res[collection] = [{'id': member['id'], 'name': member['name']}
+                               for member in ovs_topology[collection]]
+        return self._fields(res, fields)
+
+    def _get_ovs_topology(self, context, id):
+        try:
+            query = self._model_query(context, OVSTopology)
+            ovs_topology = query.filter(OVSTopology.id == id).one()
+        except exc.NoResultFound:
+            raise ext_ovsnetwork.OVSTopologyNotFound(id=id)
+        return ovs_topology
+
+    def get_ovs_topology(self, context, id, fields=None):
+        with context.session.begin(subtransactions=True):
+            ovs_topology = self._get_ovs_topology(context, id)
+            return self._make_ovs_topology_dict(ovs_topology, fields)
+
+    def get_ovs_topologies(self, context, filters=None, fields=None,
+                           sorts=None, limit=None, marker=None,
+                           page_reverse=False):
+        marker_obj = self._get_marker_obj(context, 'ovs_topology',
+                                          limit, marker)
+        return self._get_collection(context,
+                                    OVSTopology,
+                                    self._make_ovs_topology_dict,
+                                    filters=filters, fields=fields,
+                                    sorts=sorts,
+                                    limit=limit, marker_obj=marker_obj,
+                                    page_reverse=page_reverse)
+
+    def _prepare_ovs_topology_members(self, collection, members, references):
+        """Validate the members of a collection and fill in their defaults.
+
+        The attributes of the members are those of the resources, except
+        that they refer to ovs networks by name. references maps each such
+        attribute to the names of the ovs networks of the topology.
+        """
+        attr_map = ext_ovsnetwork.RESOURCE_ATTRIBUTE_MAP[collection]
+        allowed = set(name for name, attr_vals in attr_map.items()
+                      if attr_vals['allow_post'] and not name.endswith('id'))
+        if not isinstance(members, list):
+            raise ext_ovsnetwork.InvalidOVSTopology(
+                reason=_("%s is not a list") % collection)
+        names = set()
+        prepared = []
+        for member in members:
+            if not isinstance(member, dict):
+                raise ext_ovsnetwork.InvalidOVSTopology(
+                    reason=_("%s is not a list of objects") % collection)
+            unknown = set(member) - allowed
+            if unknown:
+                raise ext_ovsnetwork.InvalidOVSTopology(
+                    reason=_("unknown attributes %(attrs)s in %(collection)s") %
+                    {'attrs': ', '.join(sorted(unknown)), 'collection': collection})
+            member = dict(member)
+            for name in allowed:
+                attr_vals = attr_map[name]
+                if name not in member:
+                    member[name] = attr_vals.get('default')
+                    continue
+                if 'convert_to' in attr_vals:
+                    member[name] = attr_vals['convert_to'](member[name])
+                for rule, data in attr_vals.get('validate', {}).items():
+                    msg = attr.validators[rule](member[name], data)
+                    if msg:
+                        raise ext_ovsnetwork.InvalidOVSTopology(reason=msg)
+            if not member['name'] or member['name'] in names:
+                raise ext_ovsnetwork.InvalidOVSTopology(
+                    reason=_("%(collection)s need unique names, %(name)r is "
+                             "not") % {'collection': collection,
+                                       'name': member['name']})
+            for name, ovs_network_names in references.items():
+                if member[name] not in ovs_network_names:
+                    raise ext_ovsnetwork.InvalidOVSTopology(
+                        reason=_("%(attr)s %(value)r of %(name)s is not an ovs "
+                                 "network of the topology") %
+                        {'attr': name, 'value': member[name],
+                         'name': member['name']})
+            names.add(member['name'])
+            prepared.append(member)
+        return prepared
+
+    def _prepare_ovs_topology(self, context, ovs_topology):
+        """Validate a whole ovs topology before any of it is created.
+
+        :returns: {collection: members with their defaults filled in}
+        """
+        members = {}
+        members['ovs_networks'] = self._prepare_ovs_topology_members(
+            'ovs_networks', ovs_topology['ovs_networks'], {})
+        ovs_network_names = set(ovs_network['name'] for ovs_network
+                                in members['ovs_networks'])
+        members['ovs_links'] = self._prepare_ovs_topology_members(
+            'ovs_links', ovs_topology['ovs_links'],
+            {'left_ovs_name': ovs_network_names,
+             'right_ovs_name': ovs_network_names})
+        members['vm_links'] = self._prepare_ovs_topology_members(
+            'vm_links', ovs_topology['vm_links'],
+            {'ovs_network_name': ovs_network_names})
+
+        # names are unique per tenant
+        tenant_id = self._get_tenant_id_for_create(context, ovs_topology)
+        names = [(OVSTopology, 'ovs_topologies', [ovs_topology['name']])]
+        names.extend((model, collection,
+                      [member['name'] for member in members[collection]])
+                     for model, collection in ((OVSNetwork, 'ovs_networks'),
+                                               (OVSLink, 'ovs_links'),
+                                               (VMLink, 'vm_links')))
+        for model, collection, collection_names in names:
+            if not collection_names:
+                continue
+            query = context.session.query(model.name).filter(
+                model.tenant_id == tenant_id, model.name.in_(collection_names))
+            for name, in query.limit(1):
+                raise ext_ovsnetwork.InvalidOVSTopology(
+                    reason=_("the name %(name)r of %(collection)s is in use") %
+                    {'name': name, 'collection': collection})
+        return members
+
+    def create_ovs_topology(self, context, ovs_topology):
+        ovs_topology = ovs_topology['ovs_topology']
+        tenant_id = self._get_tenant_id_for_create(context, ovs_topology)
+        with context.session.begin(subtransactions=True):
+            ovs_topology_db = OVSTopology(id = uuidutils.generate_uuid(),
+                                          tenant_id = tenant_id,
+                                          name = ovs_topology.get('name'))
+            context.session.add(ovs_topology_db)
+        return self._make_ovs_topology_dict(ovs_topology_db)
+
+    def delete_ovs_topology(self, context, id):
+        """Delete an ovs topology with its ovs networks and links.
+
+        :returns: {collection: dicts of the deleted members}
+        """
+        with context.session.begin(subtransactions=True):
+            ovs_topology = self._get_ovs_topology(context, id)
+            ids = [ovs_network['id'] for ovs_network in ovs_topology.ovs_networks]
+            if ids:
+                # links created on their own to the ovs networks of the topology
+                outside = sa.or_(VMLink.topology_id == None, VMLink.topology_id != id)
+                for vm_link in context.session.query(VMLink).filter(
+                        VMLink.ovs_network_id.in_(ids), outside).limit(1):
+                    raise ext_ovsnetwork.OVSNetworkHasLinks(id=vm_link.ovs_network_id)
+                outside = sa.or_(OVSLink.topology_id == None, OVSLink.topology_id != id)
+                for ovs_link in context.session.query(OVSLink).filter(
+                        sa.or_(OVSLink.left_ovs_id.in_(ids),
+                               OVSLink.right_ovs_id.in_(ids)), outside).limit(1):
+                    raise ext_ovsnetwork.OVSNetworkHasLinks(
+                        id=ovs_link.left_ovs_id if ovs_link.left_ovs_id in ids else ovs_link.right_ovs_id)
+
+            deleted = {
+                'ovs_networks': [self._make_ovs_network_dict(ovs_network)
+                                 for ovs_network in ovs_topology.ovs_networks],
+                'ovs_links': [self._make_ovs_link_dict(ovs_link)
+                              for ovs_link in ovs_topology.ovs_links],
+                'vm_links': [self._make_vm_link_dict(vm_link)
+                             for vm_link in ovs_topology.vm_links]}
+            for collection in ('vm_links', 'ovs_links', 'ovs_networks'):
+                for member in ovs_topology[collection]:
+                    context.session.delete(member)
+            context.session.delete(ovs_topology)
+        return deleted
@@ -18,9 +18,13 @@
 import netaddr
 from oslo.config import cfg
 from neutron.common import constants as q_const
+from neutron.common import exceptions as n_exc
 from neutron.common import utils
+from neutron import context as n_context
 from neutron.db import ovsnetwork_db
+from neutron import manager
 from neutron.openstack.common import log as logging
+from neutron.openstack.common import loopingcall
 from neutron.api.v2 import attributes
 
 LOG = logging.getLogger(__name__)
@@ -28,12 +32,21 @@ LOG = logging.getLogger(__name__)
 ovs_network_opts = [
     cfg.IntOpt(
         'tunnel_key_min',
-        default=1,
-        help=_('Min tunnek key for ovs network isolation stategy.')),
+        default=0xf00000,
+        help=_('Min tunnek key for ovs network isolation stategy. Links '
+               'between hosts use these keys on br-tun, so the range must '
+               'not overlap the tunnel_id_ranges and vni_ranges of tenant '
+               'networks. The default range is the top of the 24 bit VXLAN '
+               'VNI space.')),
     cfg.IntOpt(
         'tunnel_key_max',
-        default=0xffffffff,
+        default=0xffffff,
         help=_('Max tunnek key for ovs network isolation stategy.')),
+    cfg.IntOpt(
+        'tunnel_key_chunk_size',
+        default=1024,
+        help=_('Number of tunnel keys a server process reserves at once '
+               'and then allocates without a database round trip.')),
 ]
 cfg.CONF.register_opts(ovs_network_opts, 'OVSNETWORK')
 link_port={'port':{
@@ -45,17 +58,163 @@ link_port={'port':{
 }}
 
 
+# the ML2 options that hold the tunnel ids of tenant networks
+_TENANT_TUNNEL_RANGE_OPTS = [('ml2_type_gre', 'tunnel_id_ranges'),
+                             ('ml2_type_vxlan', 'vni_ranges')]
+
+
+def _get_tenant_tunnel_ranges():
+    """Return the (min, max) tunnel id ranges of the tenant networks.
+
+    The options of a type driver which is not loaded are skipped.
+    """
+    ranges = []
+    for group, name in _TENANT_TUNNEL_RANGE_OPTS:
+        try:
+            entries = getattr(getattr(cfg.CONF, group), name)
+        except cfg.NoSuchOptError:
+            continue
+        for entry in entries:
+            tun_min, tun_max = entry.strip().split(':')
+            ranges.append((int(tun_min), int(tun_max)))
+    return ranges
+
+
+def _make_link_port(name, network_id):
+    port = dict(link_port['port'], name=name, network_id=network_id)
+    return {'port': port}
+
+
 class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
     
     _tunnelkey = ovsnetwork_db.TunnelKeyDbMixin(
-        cfg.CONF.OVSNETWORK.tunnel_key_min, cfg.CONF.OVSNETWORK.tunnel_key_max)
+        cfg.CONF.OVSNETWORK.tunnel_key_min, cfg.CONF.OVSNETWORK.tunnel_key_max,
+        cfg.CONF.OVSNETWORK.tunnel_key_chunk_size)
 
     @property
     def tunnelkey(self):
         return self._tunnelkey
+
+    def _check_tunnel_key_range(self):
+        """Refuse to start if the link tunnel keys overlap tenant tunnels.
+
+        Both use br-tun, so a link key which is also the tunnel id of a
+        tenant network would mix their traffic.
+        """
+        key_min, key_max = self.tunnelkey.key_min, self.tunnelkey.key_max
+        for tun_min, tun_max in _get_tenant_tunnel_ranges():
+            if tun_min <= key_max and key_min <= tun_max:
+                LOG.error(_("Tunnel key range %(key_min)d:%(key_max)d "
+                            "overlaps tenant tunnel range "
+                            "%(tun_min)d:%(tun_max)d"),
+                          {'key_min': key_min, 'key_max': key_max,
+                           'tun_min': tun_min, 'tun_max': tun_max})
+                raise n_exc.InvalidConfigurationOption(
+                    opt_name='OVSNETWORK.tunnel_key_min/tunnel_key_max',
+                    opt_value='%d:%d' % (key_min, key_max))
+
+    def _get_tunnel_ip_by_host(self, context, host):
+        """Return the tunneling ip of the ovs agent on host, if any."""
+        if not host:
+            return
+        agents = self.get_agents(context,
+                                 filters={'agent_type': [q_const.AGENT_TYPE_OVS],
+                                          'host': [host]})
+        for agent in agents:
+            return agent['configurations'].get('tunneling_ip')
+
+    def _get_tunnel_ips(self, context):
+        """Return {host: tunneling ip} of all ovs agents."""
+        agents = self.get_agents(context,
+                                 filters={'agent_type': [q_const.AGENT_TYPE_OVS]})
+        return dict((agent['host'], agent['configurations'].get('tunneling_ip'))
+                    for agent in agents)
+
+    def _log_ovs_event(self, context, events, method, resource, host):
+        """Record an event in the change log of host, to send it later.
+
+        Called in the transaction of the change, so that both commit
+        together. The event, its resource carrying the revision, is
+        appended to events for _send_ovs_events() once committed.
+        """
+        revision = {}
+        if host:
+            revision = self.record_ovs_network_change(context, host, method, resource)
+        if method == 'ovs_network_deleted':
+            events.append((method, (resource, host), revision))
+        elif method.startswith('ovs_network'):
+            events.append((method, (dict(resource, **revision),), {}))
+        else:
+            events.append((method, (dict(resource, **revision), host), {}))
+
+    def _send_ovs_events(self, context, events):
+        """Send the events logged by _log_ovs_event(), in order."""
+        for method, args, kwargs in events:
+            getattr(self.notifier, method)(context, *args, **kwargs)
+
+    def start_ovs_network_change_pruning(self):
+        """Prune the change log every change_log_prune_interval seconds."""
+        interval = cfg.CONF.OVSNETWORK.change_log_prune_interval
+        if not interval:
+            return
+        self.ovs_network_change_pruning = loopingcall.FixedIntervalLoopingCall(
+            self._prune_ovs_network_changes)
+        self.ovs_network_change_pruning.start(interval=interval)
+
+    def _prune_ovs_network_changes(self):
+        try:
+            self.prune_ovs_network_changes(n_context.get_admin_context())
+        except Exception:
+            LOG.exception(_("Failed to prune the ovs network change log"))
+
+    def _add_ovs_link_peers(self, context, ovs_link, left_host, right_host,
+                            tunnel_ips=None):
+        # agents forward to an endpoint on another host through br-tun
+        if tunnel_ips is None:
+            get_tunnel_ip = lambda host: self._get_tunnel_ip_by_host(context, host)
+        else:
+            get_tunnel_ip = tunnel_ips.get
+        ovs_link.update({
+            'left_host': left_host,
+            'right_host': right_host,
+            'left_tunnel_ip': get_tunnel_ip(left_host),
+            'right_tunnel_ip': get_tunnel_ip(right_host)})
+
+    def _add_vm_link_peers(self, context, vm_link, ovs_host, tunnel_ips=None):
+        if tunnel_ips is None:
+            get_tunnel_ip = lambda host: self._get_tunnel_ip_by_host(context, host)
+        else:
+            get_tunnel_ip = tunnel_ips.get
+        vm_link.update({
+            'ovs_host': ovs_host,
+            'ovs_tunnel_ip': get_tunnel_ip(ovs_host),
+            'vm_tunnel_ip': get_tunnel_ip(vm_link.get('vm_host'))})
      
+    def get_ovs_network_topology(self, context, host):
+        topology = super(OVSNetworkServerRpcMixin, self).get_ovs_network_topology(context, host)
+        tunnel_ips = self._get_tunnel_ips(context)
+        for key in ('ovs_link_left_endpoints', 'ovs_link_right_endpoints'):
+            for ovs_link in topology[key]:
+                ovs_link['left_tunnel_ip'] = tunnel_ips.get(ovs_link['left_host'])
+                ovs_link['right_tunnel_ip'] = tunnel_ips.get(ovs_link['right_host'])
+        for key in ('vm_link_ovs_endpoints', 'vm_link_vm_endpoints'):
+            for vm_link in topology[key]:
+                vm_link['ovs_tunnel_ip'] = tunnel_ips.get(vm_link['ovs_host'])
+                vm_link['vm_tunnel_ip'] = tunnel_ips.get(vm_link['vm_host'])
+        return topology
+
     def create_ovs_network(self, context, ovs_network):
-        id = None
+        events = []
+        with context.session.begin(subtransactions=True):
+            ovs_network = self._create_ovs_network(context, ovs_network)
+            if not ovs_network.get('id'):
+                return
+            self._log_ovs_event(context, events, 'ovs_network_created', ovs_network, ovs_network['host'])
+        self._send_ovs_events(context, events)
+        return ovs_network
+
+    def _create_ovs_network(self, context, ovs_network):
+        """Create an ovs network on its shadow network and subnet."""
         with context.session.begin(subtransactions=True):
             network={}
             network['network']={
@@ -81,34 +240,35 @@ class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
             subnet = self.create_subnet(context, subnet)
             id = subnet.get('network_id')
             ovs_network['ovs_network'].update({'id': id})
-            ovs_network = super(OVSNetworkServerRpcMixin, self).create_ovs_network(context, ovs_network)
-
-        if not id:
-            return
-        self.notifier.ovs_network_created(context, ovs_network)
-        return ovs_network
+            return super(OVSNetworkServerRpcMixin, self).create_ovs_network(context, ovs_network)
 
     def update_ovs_network(self, context, id, ovs_network):
-        ovs_network = super(OVSNetworkServerRpcMixin, self).update_ovs_network(context, id, ovs_network)
-        if not ovs_network:
-            return
-        self.notifier.ovs_network_updated(context, ovs_network)
+        events = []
+        with context.session.begin(subtransactions=True):
+            ovs_network = super(OVSNetworkServerRpcMixin, self).update_ovs_network(context, id, ovs_network)
+            if not ovs_network:
+                return
+            self._log_ovs_event(context, events, 'ovs_network_updated', ovs_network, ovs_network['host'])
+        self._send_ovs_events(context, events)
         return ovs_network
 
     def delete_ovs_network(self, context, id):
-        host = None
+        events = []
         with context.session.begin(subtransactions=True):
             host = super(OVSNetworkServerRpcMixin, self).delete_ovs_network(context, id)
-            filters = {'network_id': [id]}
-            subnets = self.get_subnets(context, filters)
-            for subnet in subnets:
-                self.delete_subnet(context, subnet['id'])
-            self.delete_network(context, id)
-
-        if not host:
-            return
-        self.notifier.ovs_network_deleted(context, id, host)
+            self._delete_shadow_network(context, id)
+            if not host:
+                return
+            self._log_ovs_event(context, events, 'ovs_network_deleted', id, host)
+        self._send_ovs_events(context, events)
         return id
+
+    def _delete_shadow_network(self, context, id):
+        filters = {'network_id': [id]}
+        subnets = self.get_subnets(context, filters)
+        for subnet in subnets:
+            self.delete_subnet(context, subnet['id'])
+        self.delete_network(context, id)
     
     def create_ovs_link(self, context, ovs_link):
         with context.session.begin(subtransactions=True):
@@ -124,16 +284,67 @@ class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
                                          'right_port_id':right_port['id']})
             ovs_link = super(OVSNetworkServerRpcMixin, self).create_ovs_link(context, ovs_link)
 
-            ovs_link['left_tunnel_id'] = self.tunnelkey.allocate(context.session, ovs_link['left_port_id'])
-            ovs_link['right_tunnel_id'] = self.tunnelkey.allocate(context.session, ovs_link['right_port_id'])
+            ovs_link['left_tunnel_id'], ovs_link['right_tunnel_id'] = self.tunnelkey.allocate_many(
+                context.session, [ovs_link['left_port_id'], ovs_link['right_port_id']])
             left_host = self._get_ovs_network_host_by_id(context, ovs_link['left_ovs_id'])
             right_host = self._get_ovs_network_host_by_id(context, ovs_link['right_ovs_id'])
-        
-        if not ovs_link.get('id'):
-            return
-        self.notifier.ovs_link_left_endpoint_created(context, ovs_link, left_host)
-        self.notifier.ovs_link_right_endpoint_created(context, ovs_link, right_host)
+            self._add_ovs_link_peers(context, ovs_link, left_host, right_host)
+            if not ovs_link.get('id'):
+                return
+            events = []
+            self._log_ovs_link_created(context, events, ovs_link)
+        self._send_ovs_events(context, events)
         return ovs_link
+
+    def _log_ovs_link_created(self, context, events, ovs_link):
+        left_host, right_host = ovs_link['left_host'], ovs_link['right_host']
+        if left_host == right_host:
+            # both bridges are on one host, the agent connects them directly
+            self._log_ovs_event(context, events, 'ovs_link_direct_created', ovs_link, left_host)
+        else:
+            self._log_ovs_event(context, events, 'ovs_link_left_endpoint_created', ovs_link, left_host)
+            self._log_ovs_event(context, events, 'ovs_link_right_endpoint_created', ovs_link, right_host)
+
+    def create_ovs_link_bulk(self, context, ovs_links):
+        """Create ovs links with their ports and tunnel keys in one transaction.
+
+        The agent of each host gets the events of all the links in one
+        message.
+        """
+        events = []
+        with context.session.begin(subtransactions=True):
+            created = self._create_ovs_links(
+                context, [item['ovs_link'] for item in ovs_links['ovs_links']])
+            for ovs_link in created:
+                self._log_ovs_link_created(context, events, ovs_link)
+
+        with self.notifier.ovs_topology_batch():
+            self._send_ovs_events(context, events)
+        return created
+
+    def _create_ovs_links(self, context, items):
+        """Create ovs links, their ports and tunnel keys, in a transaction."""
+        if not items:
+            return []
+        hosts = self._get_ovs_network_hosts_by_ids(
+            context, [item[key] for item in items for key in ('left_ovs_id', 'right_ovs_id')])
+        tunnel_ips = self._get_tunnel_ips(context)
+        created = []
+        for item in items:
+            left_port = self.create_port(context, _make_link_port('left-ovs-port', item['left_ovs_id']))
+            right_port = self.create_port(context, _make_link_port('right-ovs-port', item['right_ovs_id']))
+            item.update({'left_port_id': left_port['id'],
+                         'right_port_id': right_port['id']})
+            created.append(super(OVSNetworkServerRpcMixin, self).create_ovs_link(context, {'ovs_link': item}))
+
+        keys = self.tunnelkey.allocate_many(
+            context.session, [port_id for ovs_link in created
+                              for port_id in (ovs_link['left_port_id'], ovs_link['right_port_id'])])
+        for ovs_link, left_key, right_key in zip(created, keys[::2], keys[1::2]):
+            ovs_link['left_tunnel_id'], ovs_link['right_tunnel_id'] = left_key, right_key
+            self._add_ovs_link_peers(context, ovs_link, hosts[ovs_link['left_ovs_id']],
+                                     hosts[ovs_link['right_ovs_id']], tunnel_ips)
+        return created
     
     def delete_ovs_link(self, context, id):
         ovs_link = None
@@ -142,18 +353,27 @@ class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
             self.delete_port(context, ovs_link['left_port_id'])
             self.delete_port(context, ovs_link['right_port_id'])
 
-            ovs_link['left_tunnel_id'] = self.tunnelkey.get(context.session, ovs_link['left_port_id'])
-            self.tunnelkey.delete(context.session, ovs_link['left_port_id'])
-            ovs_link['right_tunnel_id'] = self.tunnelkey.get(context.session, ovs_link['right_port_id'])
-            self.tunnelkey.delete(context.session, ovs_link['right_port_id'])
+            keys = self.tunnelkey.release_many(
+                context.session, [ovs_link['left_port_id'], ovs_link['right_port_id']])
+            ovs_link['left_tunnel_id'] = keys.get(ovs_link['left_port_id'])
+            ovs_link['right_tunnel_id'] = keys.get(ovs_link['right_port_id'])
 
             left_host = self._get_ovs_network_host_by_id(context, ovs_link['left_ovs_id'])
             right_host = self._get_ovs_network_host_by_id(context, ovs_link['right_ovs_id'])
+            self._add_ovs_link_peers(context, ovs_link, left_host, right_host)
+            if not ovs_link.get('id'):
+                return
+            events = []
+            self._log_ovs_link_deleted(context, events, ovs_link)
+        self._send_ovs_events(context, events)
 
-        if not ovs_link.get('id'):
-            return
-        self.notifier.ovs_link_left_endpoint_deleted(context, ovs_link, left_host)
-        self.notifier.ovs_link_right_endpoint_deleted(context, ovs_link, right_host)
+    def _log_ovs_link_deleted(self, context, events, ovs_link):
+        left_host, right_host = ovs_link['left_host'], ovs_link['right_host']
+        if left_host == right_host:
+            self._log_ovs_event(context, events, 'ovs_link_direct_deleted', ovs_link, left_host)
+        else:
+            self._log_ovs_event(context, events, 'ovs_link_left_endpoint_deleted', ovs_link, left_host)
+            self._log_ovs_event(context, events, 'ovs_link_right_endpoint_deleted', ovs_link, right_host)
     
     def create_vm_link(self, context, vm_link):
         with context.session.begin(subtransactions=True):
@@ -169,15 +389,57 @@ class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
                                        'ovs_port_id':ovs_port['id']})
             vm_link = super(OVSNetworkServerRpcMixin, self).create_vm_link(context, vm_link)
 
-            vm_link['vm_tunnel_id'] = self.tunnelkey.allocate(context.session, vm_link['vm_port_id'])
-            vm_link['ovs_tunnel_id'] = self.tunnelkey.allocate(context.session, vm_link['ovs_port_id'])
+            vm_link['vm_tunnel_id'], vm_link['ovs_tunnel_id'] = self.tunnelkey.allocate_many(
+                context.session, [vm_link['vm_port_id'], vm_link['ovs_port_id']])
             ovs_host = self._get_ovs_network_host_by_id(context, vm_link['ovs_network_id'])
-
-        if not vm_link.get('id'):
-            return
-        self.notifier.vm_link_ovs_endpoint_created(context, vm_link, ovs_host)
+            self._add_vm_link_peers(context, vm_link, ovs_host)
+            if not vm_link.get('id'):
+                return
+            events = []
+            self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_created', vm_link, ovs_host)
+        self._send_ovs_events(context, events)
         #self.notifier.vm_link_vm_endpoint_created(context, vm_link, vm_link['vm_host'])
         return vm_link
+
+    def create_vm_link_bulk(self, context, vm_links):
+        """Create vm links with their ports and tunnel keys in one transaction.
+
+        The agent of each host gets the events of all the links in one
+        message.
+        """
+        events = []
+        with context.session.begin(subtransactions=True):
+            created = self._create_vm_links(
+                context, [item['vm_link'] for item in vm_links['vm_links']])
+            for vm_link in created:
+                self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_created', vm_link, vm_link['ovs_host'])
+
+        with self.notifier.ovs_topology_batch():
+            self._send_ovs_events(context, events)
+        return created
+
+    def _create_vm_links(self, context, items):
+        """Create vm links, their ports and tunnel keys, in a transaction."""
+        if not items:
+            return []
+        hosts = self._get_ovs_network_hosts_by_ids(
+            context, [item.get('ovs_network_id') for item in items])
+        tunnel_ips = self._get_tunnel_ips(context)
+        created = []
+        for item in items:
+            vm_port = self.create_port(context, _make_link_port('vm_port', item['ovs_network_id']))
+            ovs_port = self.create_port(context, _make_link_port('ovs_port', item['ovs_network_id']))
+            item.update({'vm_port_id': vm_port['id'],
+                         'ovs_port_id': ovs_port['id']})
+            created.append(super(OVSNetworkServerRpcMixin, self).create_vm_link(context, {'vm_link': item}))
+
+        keys = self.tunnelkey.allocate_many(
+            context.session, [port_id for vm_link in created
+                              for port_id in (vm_link['vm_port_id'], vm_link['ovs_port_id'])])
+        for vm_link, vm_key, ovs_key in zip(created, keys[::2], keys[1::2]):
+            vm_link['vm_tunnel_id'], vm_link['ovs_tunnel_id'] = vm_key, ovs_key
+            self._add_vm_link_peers(context, vm_link, hosts[vm_link['ovs_network_id']], tunnel_ips)
+        return created
    
     def update_vm_link(self, context, id, vm_link):
         new_ovs_id = None
@@ -200,43 +462,168 @@ class OVSNetworkServerRpcMixin(ovsnetwork_db.OVSNetworkDbMixin):
                 old_host = self._get_ovs_network_host_by_id(context, old_vm_link['ovs_network_id'])
                 new_vm_link['ovs_tunnel_id'] = self.tunnelkey.allocate(context.session, new_vm_link['ovs_port_id'])
                 new_vm_link['vm_tunnel_id'] = self.tunnelkey.get(context.session, new_vm_link['vm_port_id'])
-                old_vm_link['ovs_tunnel_id'] = self.tunnelkey.get(context.session, old_vm_link['ovs_port_id'])
-                self.tunnelkey.delete(context.session, old_vm_link['ovs_port_id'])
+                old_vm_link['ovs_tunnel_id'] = self.tunnelkey.release_many(
+                    context.session, [old_vm_link['ovs_port_id']]).get(old_vm_link['ovs_port_id'])
+                old_vm_link['vm_tunnel_id'] = new_vm_link['vm_tunnel_id']
+                self._add_vm_link_peers(context, old_vm_link, old_host)
             else:
                 new_vm_link = super(OVSNetworkServerRpcMixin, self).update_vm_link(context, id, vm_link)
                 new_vm_link['ovs_tunnel_id'] = self.tunnelkey.get(context.session, new_vm_link['ovs_port_id'])
                 new_vm_link['vm_tunnel_id'] = self.tunnelkey.get(context.session, new_vm_link['vm_port_id'])
+                new_host = self._get_ovs_network_host_by_id(context, new_vm_link['ovs_network_id'])
+            self._add_vm_link_peers(context, new_vm_link, new_host)
 
-        if new_ovs_id  and new_ovs_id != old_ovs_id:
-            # Delete old ovs endpoint of this vm link, and create the new one, then update the vm endpoint's flow table.
-            self.notifier.vm_link_ovs_endpoint_created(context, new_vm_link, new_host)
-            self.notifier.vm_link_ovs_endpoint_deleted(context, old_vm_link, old_host)
-        if new_status == 'ACTIVE':
-            if old_status == 'PENDING':
-                self.notifier.vm_link_vm_endpoint_created(context, new_vm_link, new_vm_link['vm_host'])
-            elif old_status == 'ACTIVE':
-                new_vm_link['old_ovs_tunnel_id'] = old_vm_link['ovs_tunnel_id']
-                self.notifier.vm_link_vm_endpoint_updated(context, new_vm_link, new_vm_link['vm_host'])
+            events = []
+            if new_ovs_id  and new_ovs_id != old_ovs_id:
+                # Delete old ovs endpoint of this vm link, and create the new one, then update the vm endpoint's flow table.
+                self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_created', new_vm_link, new_host)
+                self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_deleted', old_vm_link, old_host)
+            elif new_status == 'ACTIVE':
+                # the ovs endpoint learns where the vm endpoint is bound
+                self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_updated', new_vm_link, new_host)
+            if new_status == 'ACTIVE':
+                if old_status == 'PENDING':
+                    self._log_ovs_event(context, events, 'vm_link_vm_endpoint_created', new_vm_link, new_vm_link['vm_host'])
+                elif old_status == 'ACTIVE':
+                    new_vm_link['old_ovs_tunnel_id'] = old_vm_link.get('ovs_tunnel_id', new_vm_link['ovs_tunnel_id'])
+                    new_vm_link['old_ovs_network_id'] = old_ovs_id
+                    self._log_ovs_event(context, events, 'vm_link_vm_endpoint_updated', new_vm_link, new_vm_link['vm_host'])
+        self._send_ovs_events(context, events)
         return new_vm_link
    
     def delete_vm_link(self, context, id):
-        vm_link = super(OVSNetworkServerRpcMixin, self).delete_vm_link(context, id)
-        self.delete_port(context, vm_link['vm_port_id'])
-        self.delete_port(context, vm_link['ovs_port_id'])
-        ovs_host = None
+        events = []
         with context.session.begin(subtransactions=True):
-            vm_link['ovs_tunnel_id'] = self.tunnelkey.get(context.session, vm_link['ovs_port_id'])
-            self.tunnelkey.delete(context.session, vm_link['ovs_port_id'])
-            vm_link['vm_tunnel_id'] = self.tunnelkey.get(context.session, vm_link['vm_port_id'])
-            self.tunnelkey.delete(context.session, vm_link['vm_port_id'])
+            vm_link = super(OVSNetworkServerRpcMixin, self).delete_vm_link(context, id)
+            self.delete_port(context, vm_link['vm_port_id'])
+            self.delete_port(context, vm_link['ovs_port_id'])
+            keys = self.tunnelkey.release_many(
+                context.session, [vm_link['ovs_port_id'], vm_link['vm_port_id']])
+            vm_link['ovs_tunnel_id'] = keys.get(vm_link['ovs_port_id'])
+            vm_link['vm_tunnel_id'] = keys.get(vm_link['vm_port_id'])
             ovs_host = self._get_ovs_network_host_by_id(context, vm_link['ovs_network_id'])
+            self._add_vm_link_peers(context, vm_link, ovs_host)
+            self._log_vm_link_deleted(context, events, vm_link)
+        self._send_ovs_events(context, events)
+
+    def _log_vm_link_deleted(self, context, events, vm_link):
+        ovs_host = vm_link['ovs_host']
         if ovs_host:
-            self.notifier.vm_link_ovs_endpoint_deleted(context, vm_link, ovs_host)
+            self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_deleted', vm_link, ovs_host)
         status=vm_link.get('status')
         if status == 'ACTIVE':
-            self.notifier.vm_link_vm_endpoint_deleted(context, vm_link, vm_link['vm_host'])
+            self._log_ovs_event(context, events, 'vm_link_vm_endpoint_deleted', vm_link, vm_link['vm_host'])
+
+    def create_ovs_topology(self, context, ovs_topology):
+        """Create a whole ovs topology in one transaction.
+
+        Its ovs networks, ovs links and vm links refer to each other by
+        name and are all validated before anything is created. The agent of
+        each host gets the events of the topology in one message.
+        """
+        members = self._prepare_ovs_topology(context, ovs_topology['ovs_topology'])
+        with context.session.begin(subtransactions=True):
+            topology = super(OVSNetworkServerRpcMixin, self).create_ovs_topology(context, ovs_topology)
+            owner = {'tenant_id': topology['tenant_id'], 'topology_id': topology['id']}
+            ovs_networks = []
+            for item in members['ovs_networks']:
+                item.update(owner)
+                ovs_networks.append(self._create_ovs_network(context, {'ovs_network': item}))
+            ids = dict((ovs_network['name'], ovs_network['id']) for ovs_network in ovs_networks)
+            for item in members['ovs_links']:
+                item.update(owner, left_ovs_id=ids[item.pop('left_ovs_name')],
+                            right_ovs_id=ids[item.pop('right_ovs_name')])
+            ovs_links = self._create_ovs_links(context, members['ovs_links'])
+            for item in members['vm_links']:
+                item.update(owner, ovs_network_id=ids[item.pop('ovs_network_name')])
+            vm_links = self._create_vm_links(context, members['vm_links'])
+
+            events = []
+            for ovs_network in ovs_networks:
+                self._log_ovs_event(context, events, 'ovs_network_created', ovs_network, ovs_network['host'])
+            for ovs_link in ovs_links:
+                self._log_ovs_link_created(context, events, ovs_link)
+            for vm_link in vm_links:
+                self._log_ovs_event(context, events, 'vm_link_ovs_endpoint_created', vm_link, vm_link['ovs_host'])
+
+        with self.notifier.ovs_topology_batch():
+            self._send_ovs_events(context, events)
+
+        for collection, created in (('ovs_networks', ovs_networks),
+                                    ('ovs_links', ovs_links),
+                                    ('vm_links', vm_links)):
+            topology[collection] = [{'id': member['id'], 'name': member['name']}
+                                    for member in created]
+        return topology
+
+    def delete_ovs_topology(self, context, id):
+        """Delete an ovs topology with its ovs networks and links.
+
+        The agent of each host gets the events of the topology in one
+        message.
+        """
+        with context.session.begin(subtransactions=True):
+            deleted = super(OVSNetworkServerRpcMixin, self).delete_ovs_topology(context, id)
+            hosts = dict((ovs_network['id'], ovs_network['host'])
+                         for ovs_network in deleted['ovs_networks'])
+            tunnel_ips = self._get_tunnel_ips(context)
+            port_ids = [port_id for ovs_link in deleted['ovs_links']
+                        for port_id in (ovs_link['left_port_id'], ovs_link['right_port_id'])]
+            port_ids.extend(port_id for vm_link in deleted['vm_links']
+                            for port_id in (vm_link['vm_port_id'], vm_link['ovs_port_id']))
+            keys = self.tunnelkey.release_many(context.session, port_ids)
+            for port_id in port_ids:
+                self.delete_port(context, port_id)
+
+            for ovs_link in deleted['ovs_links']:
+                ovs_link['left_tunnel_id'] = keys.get(ovs_link['left_port_id'])
+                ovs_link['right_tunnel_id'] = keys.get(ovs_link['right_port_id'])
+                self._add_ovs_link_peers(context, ovs_link, hosts[ovs_link['left_ovs_id']],
+                                         hosts[ovs_link['right_ovs_id']], tunnel_ips)
+            for vm_link in deleted['vm_links']:
+                vm_link['vm_tunnel_id'] = keys.get(vm_link['vm_port_id'])
+                vm_link['ovs_tunnel_id'] = keys.get(vm_link['ovs_port_id'])
+                self._add_vm_link_peers(context, vm_link, hosts[vm_link['ovs_network_id']], tunnel_ips)
+            for ovs_network in deleted['ovs_networks']:
+                self._delete_shadow_network(context, ovs_network['id'])
+
+            events = []
+            for ovs_link in deleted['ovs_links']:
+                self._log_ovs_link_deleted(context, events, ovs_link)
+            for vm_link in deleted['vm_links']:
+                self._log_vm_link_deleted(context, events, vm_link)
+            for ovs_network in deleted['ovs_networks']:
+                if ovs_network['host']:
+                    self._log_ovs_event(context, events, 'ovs_network_deleted', ovs_network['id'], ovs_network['host'])
+
+        with self.notifier.ovs_topology_batch():
+            self._send_ovs_events(context, events)
     
 
 class OVSNetworkServerRpcCallbackMixin(object):
     # we should add some function to sync states of ovs_network, vm_link and ovs_link in future
-    pass    
+
+    def update_ovs_network_stats(self, rpc_context, **kwargs):
+        """Agent reports the traffic counters of its link endpoints."""
+        host = kwargs.get('host')
+        stats = kwargs.get('stats', [])
+        LOG.debug(_("ovs network counters of %(count)d endpoints reported "
+                    "by %(host)s"), {'count': len(stats), 'host': host})
+        plugin = manager.NeutronManager.get_plugin()
+        plugin.update_ovs_network_stats(rpc_context, stats)
+
+    def get_ovs_network_topology(self, rpc_context, **kwargs):
+        """Agent requests the ovs networks and links it hosts."""
+        host = kwargs.get('host')
+        LOG.debug(_("ovs network topology requested by %s"), host)
+        plugin = manager.NeutronManager.get_plugin()
+        return plugin.get_ovs_network_topology(rpc_context, host)
+
+    def get_ovs_network_changes(self, rpc_context, **kwargs):
+        """Agent requests the events it missed since a revision."""
+        host = kwargs.get('host')
+        since = kwargs.get('since', 0)
+        LOG.debug(_("ovs network changes since %(since)s requested by "
+                    "%(host)s"), {'since': since, 'host': host})
+        plugin = manager.NeutronManager.get_plugin()
+        return plugin.get_ovs_network_changes(rpc_context, host, since)
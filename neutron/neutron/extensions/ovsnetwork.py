@@ -46,6 +46,12 @@ class HostNotSetInVMLink(qexception.NotFound):
 
 class OVSLinkNotFound(qexception.NotFound):
     message = _("OVS Link %(id)s could not be found")
+
+class OVSTopologyNotFound(qexception.NotFound):
+    message = _("OVS Topology %(id)s could not be found")
+
+class InvalidOVSTopology(qexception.InvalidInput):
+    message = _("Invalid OVS Topology: %(reason)s")
     
 def convert_to_validate_port_num(port):
     if port is None:
@@ -68,6 +74,13 @@ def convert_to_int_or_none(val):
     except (ValueError, TypeError):
         return None
     return val
+
+# traffic counters of ovs links and vm links, reported by the agents
+LINK_STATS_ATTRIBUTES = dict(
+    (field, {'allow_post': False, 'allow_put': False, 'is_visible': True})
+    for field in ('rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes',
+                  'rx_packet_rate', 'rx_byte_rate', 'tx_packet_rate',
+                  'tx_byte_rate'))
         
 RESOURCE_ATTRIBUTE_MAP = {
     'ovs_networks' : {
@@ -169,6 +182,44 @@ RESOURCE_ATTRIBUTE_MAP = {
                           'is_visible': True},
     }
 }
+RESOURCE_ATTRIBUTE_MAP['vm_links'].update(LINK_STATS_ATTRIBUTES)
+RESOURCE_ATTRIBUTE_MAP['ovs_links'].update(LINK_STATS_ATTRIBUTES)
+# revision of the last change of a resource sent to the agents
+for resource_attributes in RESOURCE_ATTRIBUTE_MAP.values():
+    resource_attributes['revision'] = {'allow_post': False,
+                                       'allow_put': False,
+                                       'is_visible': True}
+
+# A whole graph of ovs networks, ovs links and vm links, posted at once.
+# The members take the attributes of their resources, but refer to the ovs
+# networks of the topology by name: ovs_network_name, left_ovs_name and
+# right_ovs_name. A topology is shown with the ids and names of its members.
+RESOURCE_ATTRIBUTE_MAP['ovs_topologies'] = {
+    'id': {'allow_post': False, 'allow_put': False,
+           'validate': {'type:uuid': None},
+           'is_visible': True,
+           'primary_key': True},
+    'tenant_id': {'allow_post': True, 'allow_put': False,
+                  'validate': {'type:string': None},
+                  'is_visible': True},
+    'name': {'allow_post': True, 'allow_put': False,
+             'validate': {'type:string': None},
+             'is_visible': True,
+             'default': ''},
+}
+for collection in ('ovs_networks', 'ovs_links', 'vm_links'):
+    RESOURCE_ATTRIBUTE_MAP['ovs_topologies'][collection] = {
+        'allow_post': True, 'allow_put': False,
+        'convert_to': attr.convert_none_to_empty_list,
+        'is_visible': True,
+        'default': []}
+
+RESOURCE_NAMES = {
+    'ovs_networks': 'ovs_network',
+    'ovs_links': 'ovs_link',
+    'vm_links': 'vm_link',
+    'ovs_topologies': 'ovs_topology',
+}
 
 #we need extend port resource and add connect_to_ovs action to it
 
@@ -199,17 +250,18 @@ class Ovsnetwork(extensions.ExtensionDescriptor):
     @classmethod    
     def get_resources(cls):
         """Returns Ext Resources."""
-        my_plurals = [(key, key[:-1]) for key in RESOURCE_ATTRIBUTE_MAP.keys()]
-        attr.PLURALS.update(dict(my_plurals))
+        attr.PLURALS.update(RESOURCE_NAMES)
         exts = []
         plugin = manager.NeutronManager.get_plugin()
-        for resource_name in ['ovs_network', 'ovs_link', 'vm_link']:
-            collection_name = resource_name.replace('_', '-') + "s"
-            params = RESOURCE_ATTRIBUTE_MAP.get(resource_name + "s", dict())
+        for collection, resource_name in RESOURCE_NAMES.items():
+            collection_name = collection.replace('_', '-')
+            params = RESOURCE_ATTRIBUTE_MAP.get(collection, dict())
             #quota.QUOTAS.register_resource_by_name(resource_name)
+            # a topology is already a batch
+            allow_bulk = resource_name != 'ovs_topology'
             controller = base.create_resource(collection_name,
                                               resource_name,
-                                              plugin, params, allow_bulk=True,
+                                              plugin, params, allow_bulk=allow_bulk,
                                               allow_pagination=True,
                                               allow_sorting=True)
         
@@ -296,4 +348,22 @@ class OVSNetworkPluginBase(object):
 
     @abstractmethod
     def delete_ovs_link(self, context, id):
+        pass
+
+    @abstractmethod
+    def get_ovs_topologies(self, context, filters=None, fields=None,
+                           sorts=None, limit=None, marker=None,
+                           page_reverse=False):
+        pass
+
+    @abstractmethod
+    def get_ovs_topology(self, context, id, fields=None):
+        pass
+
+    @abstractmethod
+    def create_ovs_topology(self, context, ovs_topology):
+        pass
+
+    @abstractmethod
+    def delete_ovs_topology(self, context, id):
         pass    
@@ -109,6 +109,7 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         super(Ml2Plugin, self).__init__()
         self.type_manager.initialize()
         self.mechanism_manager.initialize()
+        self._check_tunnel_key_range()
         # bulk support depends on the underlying drivers
         self.__native_bulk_support = self.mechanism_manager.native_bulk_support
 
@@ -134,6 +135,7 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         self.dispatcher = self.callbacks.create_rpc_dispatcher()
         self.conn.create_consumer(self.topic, self.dispatcher,
                                   fanout=False)
+        self.start_ovs_network_change_pruning()
         return self.conn.consume_in_thread()
 
     def _process_provider_segment(self, segment):
@@ -110,7 +110,8 @@ class Port(object):
 
 
 class OVSPluginApi(agent_rpc.PluginApi,
-                   sg_rpc.SecurityGroupServerRpcApiMixin):
+                   sg_rpc.SecurityGroupServerRpcApiMixin,
+                   ovsnetwork_rpc_agent.OVSNetworkServerRpcApiMixin):
     pass
 
 
@@ -126,8 +127,9 @@ class OVSNetworkAgent(ovsnetwork_rpc_agent.OVSNetworkAgentRpcMixin):
     def __init__(self, context, plugin_rpc, root_helper):
         super(OVSNetworkAgent, self).__init__()
         self.context = context
-        self.plgin_rpc =plugin_rpc
+        self.plugin_rpc = plugin_rpc
         self.root_helper =root_helper
+        self.start_ovs_network_stats_report()
 
 
 class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
@@ -246,6 +248,8 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         self.ovs_network_agent = OVSNetworkAgent(self.context,
                                                  self.plugin_rpc,
                                                  root_helper)
+        if self.enable_tunneling:
+            self.setup_ovs_network_tunneling()
         # Initialize iteration counter
         self.iter_num = 0
         self.run_daemon_loop = True
@@ -263,6 +267,15 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         self.agent_state.get('configurations')['devices'] = (
             self.int_br_device_count)
         try:
+            # the heartbeat starts in setup_rpc(), before the ovs network
+            # agent is created
+            if self.ovs_network_agent:
+                self.agent_state.get('configurations')['ovs_network_queue'] = (
+                    self.ovs_network_agent.get_ovs_network_queue_stats())
+                # the full metrics are on ovs_network_metrics_socket, the
+                # configurations column holds 4095 characters
+                self.agent_state.get('configurations')['ovs_network_operations'] = (
+                    self.ovs_network_agent.get_ovs_network_metrics_summary())
             self.state_rpc.report_state(self.context,
                                         self.agent_state)
             self.agent_state.pop('start_flag', None)
@@ -292,7 +305,8 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
                      ['ovs_link', topics.DELETE, cfg.CONF.host],
                      ['vm_link', topics.CREATE, cfg.CONF.host],
                      ['vm_link', topics.UPDATE, cfg.CONF.host],
-                     ['vm_link', topics.DELETE, cfg.CONF.host]]
+                     ['vm_link', topics.DELETE, cfg.CONF.host],
+                     ['ovs_topology', topics.UPDATE, cfg.CONF.host]]
                      
         if self.l2_pop:
             consumers.append([topics.L2POPULATION,
@@ -1236,6 +1250,28 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         # If one of the above opertaions fails => resync with plugin
         return (resync_a | resync_b)
 
+    def setup_ovs_network_tunneling(self):
+        # ovs links are carried by the first tunnel type configured
+        self.ovs_network_agent.setup_ovs_network_tunneling(
+            self.tun_br, self.patch_int_ofport, self.patch_tun_ofport,
+            constants.TUN_TABLE[self.tunnel_types[0]],
+            self.get_ovs_network_tunnel_ofport, self.available_local_vlans)
+
+    def get_ovs_network_tunnel_ofport(self, remote_ip):
+        """Return the ofport of the tunnel to remote_ip, set it up if needed.
+
+        With l2 population the agent may not have a tunnel to every host.
+        """
+        tunnel_type = self.tunnel_types[0]
+        ofport = self.tun_br_ofports[tunnel_type].get(remote_ip)
+        if ofport:
+            return ofport
+        remote_ip_hex = self.get_ip_in_hex(remote_ip)
+        if not remote_ip_hex:
+            return 0
+        port_name = '%s-%s' % (tunnel_type, remote_ip_hex)
+        return self.setup_tunnel_port(port_name, remote_ip, tunnel_type)
+
     def get_ip_in_hex(self, ip_address):
         try:
             return '%08x' % netaddr.IPAddress(ip_address, version=4)
@@ -1298,6 +1334,7 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
         updated_ports_copy = set()
         ancillary_ports = set()
         tunnel_sync = True
+        ovs_network_sync = True
         ovs_restarted = False
         while self.run_daemon_loop:
             start = time.time()
@@ -1314,13 +1351,17 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
                 ancillary_ports.clear()
                 sync = False
                 polling_manager.force_polling()
+                ovs_network_sync = True
             ovs_restarted = self.check_ovs_restart()
             if ovs_restarted:
                 self.setup_integration_br()
                 self.setup_physical_bridges(self.bridge_mappings)
                 if self.enable_tunneling:
                     self.setup_tunnel_br()
+                    self.setup_ovs_network_tunneling()
                     tunnel_sync = True
+                # br-int flows were reset, restore the ovs network ones
+                ovs_network_sync = True
             # Notify the plugin of tunnel IP
             if self.enable_tunneling and tunnel_sync:
                 LOG.info(_("Agent tunnel out of sync with plugin!"))
@@ -1329,6 +1370,9 @@ class OVSNeutronAgent(sg_rpc.SecurityGroupAgentRpcCallbackMixin,
                 except Exception:
                     LOG.exception(_("Error while synchronizing tunnels"))
                     tunnel_sync = True
+            # after the tunnels, which reach the remote link endpoints
+            if ovs_network_sync or self.ovs_network_agent.ovs_network_sync_needed:
+                ovs_network_sync = not self.ovs_network_agent.sync_ovs_networks()
             if self._agent_has_updates(polling_manager) or ovs_restarted:
                 try:
                     LOG.debug(_("Agent rpc_loop - iteration:%(iter_num)d - "
@@ -0,0 +1,336 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# A pure python stand-in for ovsdb-server, so the native OVSDB backend of
+# the ovs network driver can be tested without Open vSwitch installed:
+#
+#     server = FakeOVSDBServer('/tmp/db.sock')
+#     server.start()
+#     backend = NativeOVSDBBackend('unix:/tmp/db.sock')
+
+import copy
+import os
+import socket
+import uuid as uuidlib
+
+import eventlet
+
+from neutron.agent.linux import ovsnetwork_ovsdb as ovsdb
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class FakeOVSDBServer(object):
+    """A minimal ovsdb-server serving the Open_vSwitch database.
+
+    It answers 'echo', 'monitor' and 'transact' with the insert, update,
+    mutate, delete, select and comment operations. Like the real server,
+    rows of non-root tables that are no longer referenced are garbage
+    collected and names are unique. Like ovs-vswitchd, new interfaces
+    get an ofport right after the transaction adding them is committed.
+    """
+
+    # strong references, which drive garbage collection
+    REFERENCES = {
+        'Open_vSwitch': {'bridges': 'Bridge'},
+        'Bridge': {'ports': 'Port', 'controller': 'Controller'},
+        'Port': {'interfaces': 'Interface'},
+        'Interface': {},
+        'Controller': {},
+    }
+    ROOT_TABLES = ('Open_vSwitch',)
+    INDEXED_TABLES = ('Bridge', 'Port', 'Interface')
+    DEFAULTS = {
+        'Interface': {'ofport': [], 'external_ids': {}, 'type': ''},
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = dict((table, {}) for table in self.REFERENCES)
+        self.tables['Open_vSwitch'][str(uuidlib.uuid4())] = {'bridges': []}
+        self.monitors = {}
+        self.next_ofport = 1
+        self.listener = None
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = eventlet.listen(self.path, family=socket.AF_UNIX)
+        self.server = eventlet.spawn(self._serve)
+
+    def stop(self):
+        if self.server:
+            self.server.kill()
+        if self.listener:
+            self.listener.close()
+        for client in self.monitors.keys():
+            client.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _serve(self):
+        while True:
+            client, _addr = self.listener.accept()
+            eventlet.spawn_n(self._handle, client)
+
+    def _handle(self, client):
+        parser = ovsdb.JsonStreamParser()
+        while True:
+            try:
+                data = client.recv(65536)
+            except socket.error:
+                data = ''
+            if not data:
+                break
+            for msg in parser.feed(data):
+                self._dispatch(client, msg)
+        self.monitors.pop(client, None)
+
+    def _send(self, client, msg):
+        try:
+            client.sendall(jsonutils.dumps(msg))
+        except socket.error:
+            self.monitors.pop(client, None)
+
+    def _dispatch(self, client, msg):
+        method, params = msg.get('method'), msg.get('params')
+        if method is None:
+            # reply to one of our own requests, we never send any
+            return
+        if method == 'echo':
+            result = params
+        elif method == 'monitor':
+            result = self.monitor(client, params[1], params[2])
+        elif method == 'transact':
+            result = self.transact(params[1:])
+        else:
+            self._send(client, {'id': msg['id'], 'result': None,
+                                'error': 'unknown method %s' % method})
+            return
+        self._send(client, {'id': msg['id'], 'result': result,
+                            'error': None})
+        if method == 'transact':
+            self._assign_ofports()
+
+    # datum conversion
+
+    def _to_json(self, table, column, value):
+        if column in self.REFERENCES[table]:
+            return ovsdb.uuid_set(value)
+        if isinstance(value, dict):
+            return ovsdb.ovs_map(value)
+        if isinstance(value, list):
+            return ['set', value]
+        return value
+
+    def _row_to_json(self, table, row, columns=None):
+        return dict((column, self._to_json(table, column, value))
+                    for column, value in row.items()
+                    if columns is None or column in columns)
+
+    def _from_json(self, table, column, value, named):
+        value = self._resolve(value, named)
+        value = ovsdb.from_json(value)
+        if column in self.REFERENCES[table] or value == []:
+            return ovsdb.as_list(value)
+        return value
+
+    def _resolve(self, value, named):
+        if isinstance(value, list):
+            if len(value) == 2 and value[0] == 'named-uuid':
+                return ['uuid', named[value[1]]]
+            return [self._resolve(v, named) for v in value]
+        return value
+
+    # monitor
+
+    def monitor(self, client, monitor_id, requests):
+        columns = dict((table, request.get('columns'))
+                       for table, request in requests.items())
+        self.monitors[client] = (monitor_id, columns)
+        return self._table_updates(columns, {}, self.tables)
+
+    def _table_updates(self, columns, old_tables, new_tables):
+        updates = {}
+        for table, table_columns in columns.items():
+            old_rows = old_tables.get(table, {})
+            new_rows = new_tables.get(table, {})
+            rows = {}
+            for uuid in set(old_rows) | set(new_rows):
+                old, new = old_rows.get(uuid), new_rows.get(uuid)
+                if old == new:
+                    continue
+                change = {}
+                if old is not None:
+                    change['old'] = self._row_to_json(table, old,
+                                                      table_columns)
+                if new is not None:
+                    change['new'] = self._row_to_json(table, new,
+                                                      table_columns)
+                rows[uuid] = change
+            if rows:
+                updates[table] = rows
+        return updates
+
+    def _commit(self, tables):
+        old_tables, self.tables = self.tables, tables
+        for client, (monitor_id, columns) in self.monitors.items():
+            updates = self._table_updates(columns, old_tables, tables)
+            if updates:
+                self._send(client, {'id': None, 'method': 'update',
+                                    'params': [monitor_id, updates]})
+
+    def _assign_ofports(self):
+        tables = copy.deepcopy(self.tables)
+        assigned = False
+        for row in tables['Interface'].values():
+            if row.get('ofport') == []:
+                row['ofport'] = self.next_ofport
+                self.next_ofport += 1
+                assigned = True
+        if assigned:
+            self._commit(tables)
+
+    # transact
+
+    def transact(self, ops):
+        tables = copy.deepcopy(self.tables)
+        named = {}
+        results = []
+        for op in ops:
+            try:
+                results.append(getattr(self, '_op_%s' % op['op'])(
+                    tables, op, named))
+            except (AttributeError, KeyError, ValueError) as e:
+                results.append({'error': 'syntax error',
+                                'details': '%s: %s' % (op.get('op'), e)})
+                return results
+        error = self._check_integrity(tables)
+        if error:
+            results.append(error)
+            return results
+        self._collect_garbage(tables)
+        self._commit(tables)
+        return results
+
+    def _match(self, tables, table, where):
+        matched = []
+        for uuid, row in tables[table].items():
+            for column, function, value in where:
+                actual = uuid if column == '_uuid' else row.get(column)
+                expected = ovsdb.from_json(value)
+                if (actual == expected) != (function == '=='):
+                    break
+            else:
+                matched.append((uuid, row))
+        return matched
+
+    def _op_insert(self, tables, op, named):
+        table = op['table']
+        uuid = str(uuidlib.uuid4())
+        if 'uuid-name' in op:
+            named[op['uuid-name']] = uuid
+        row = dict((column, []) for column in self.REFERENCES[table])
+        row.update(copy.deepcopy(self.DEFAULTS.get(table, {})))
+        for column, value in op.get('row', {}).items():
+            row[column] = self._from_json(table, column, value, named)
+        tables[table][uuid] = row
+        return {'uuid': ['uuid', uuid]}
+
+    def _op_update(self, tables, op, named):
+        table = op['table']
+        matched = self._match(tables, table, op.get('where', []))
+        for _uuid, row in matched:
+            for column, value in op['row'].items():
+                row[column] = self._from_json(table, column, value, named)
+        return {'count': len(matched)}
+
+    def _op_mutate(self, tables, op, named):
+        table = op['table']
+        matched = self._match(tables, table, op.get('where', []))
+        for _uuid, row in matched:
+            for column, mutator, value in op['mutations']:
+                value = self._from_json(table, column, value, named)
+                current = row.get(column, [])
+                if isinstance(current, dict):
+                    if mutator == 'insert':
+                        for k, v in value.items():
+                            current.setdefault(k, v)
+                    elif mutator == 'delete':
+                        for k in ovsdb.as_list(value):
+                            current.pop(k, None)
+                elif mutator == 'insert':
+                    row[column] = current + [v for v in ovsdb.as_list(value)
+                                             if v not in current]
+                elif mutator == 'delete':
+                    row[column] = [v for v in current
+                                   if v not in ovsdb.as_list(value)]
+                else:
+                    raise ValueError('unsupported mutator %s' % mutator)
+        return {'count': len(matched)}
+
+    def _op_delete(self, tables, op, named):
+        matched = self._match(tables, op['table'], op.get('where', []))
+        for uuid, _row in matched:
+            del tables[op['table']][uuid]
+        return {'count': len(matched)}
+
+    def _op_select(self, tables, op, named):
+        table = op['table']
+        rows = []
+        for uuid, row in self._match(tables, table, op.get('where', [])):
+            row = self._row_to_json(table, row, op.get('columns'))
+            row['_uuid'] = ['uuid', uuid]
+            rows.append(row)
+        return {'rows': rows}
+
+    def _op_comment(self, tables, op, named):
+        return {}
+
+    def _check_integrity(self, tables):
+        for table in self.INDEXED_TABLES:
+            names = [row.get('name') for row in tables[table].values()]
+            duplicates = set(name for name in names if names.count(name) > 1)
+            if duplicates:
+                return {'error': 'constraint violation',
+                        'details': '%s name %s is not unique' %
+                        (table, ', '.join(sorted(duplicates)))}
+        for table, references in self.REFERENCES.items():
+            for row in tables[table].values():
+                for column, target in references.items():
+                    for uuid in row.get(column, []):
+                        if uuid not in tables[target]:
+                            return {'error': 'referential integrity violation',
+                                    'details': '%s.%s refers to missing %s' %
+                                    (table, column, uuid)}
+
+    def _collect_garbage(self, tables):
+        reachable = set()
+        pending = [(table, uuid) for table in self.ROOT_TABLES
+                   for uuid in tables[table]]
+        while pending:
+            table, uuid = pending.pop()
+            if (table, uuid) in reachable:
+                continue
+            reachable.add((table, uuid))
+            row = tables[table][uuid]
+            for column, target in self.REFERENCES[table].items():
+                pending.extend((target, ref) for ref in row.get(column, []))
+        for table in tables:
+            for uuid in list(tables[table]):
+                if (table, uuid) not in reachable:
+                    del tables[table][uuid]
@@ -0,0 +1,282 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+import sqlalchemy as sa
+
+from neutron import context
+from neutron.db import api as db_api
+from neutron.db import db_base_plugin_v2
+from neutron.db import ovsnetwork_db
+from neutron.extensions import ovsnetwork as ext_ovsnetwork
+from neutron.tests import base
+
+
+class OVSNetworkDbPlugin(db_base_plugin_v2.NeutronDbPluginV2,
+                         ovsnetwork_db.OVSNetworkDbMixin):
+    pass
+
+
+class OVSNetworkDbTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(OVSNetworkDbTestCase, self).setUp()
+        db_api.configure_db()
+        self.addCleanup(db_api.clear_db)
+        self.context = context.get_admin_context()
+        self.plugin = OVSNetworkDbPlugin()
+
+
+class TestOVSNetworkChangeLog(OVSNetworkDbTestCase):
+
+    def _record(self, host):
+        return self.plugin.record_ovs_network_change(
+            self.context, host, 'ovs_network_deleted', 'fake-id')
+
+    def test_revisions_chain_per_host(self):
+        h1_first = self._record('h1')
+        h2_first = self._record('h2')
+        h1_second = self._record('h1')
+        h2_second = self._record('h2')
+        self.assertEqual(0, h1_first['prev_revision'])
+        self.assertEqual(0, h2_first['prev_revision'])
+        self.assertEqual(h1_first['revision'], h1_second['prev_revision'])
+        self.assertEqual(h2_first['revision'], h2_second['prev_revision'])
+        self.assertTrue(h1_second['revision'] > h2_first['revision'])
+
+    def test_changes_since_revision(self):
+        first = self._record('h1')
+        self._record('h2')
+        second = self._record('h1')
+        changes = self.plugin.get_ovs_network_changes(
+            self.context, 'h1', first['revision'])
+        self.assertFalse(changes['resync'])
+        self.assertEqual(second['revision'], changes['revision'])
+        self.assertEqual(1, len(changes['changes']))
+
+    def test_change_is_rolled_back_with_its_transaction(self):
+        first = self._record('h1')
+
+        def failed_change():
+            with self.context.session.begin(subtransactions=True):
+                self._record('h1')
+                raise ValueError()
+        self.assertRaises(ValueError, failed_change)
+        self.assertEqual(
+            {'resync': False, 'revision': first['revision'], 'changes': []},
+            self.plugin.get_ovs_network_changes(self.context, 'h1',
+                                                first['revision']))
+        self.assertEqual(first['revision'],
+                         self._record('h1')['prev_revision'])
+
+    def test_prune_keeps_recent_changes_and_the_last(self):
+        self.config(change_log_ttl=60, group='OVSNETWORK')
+        now = datetime.datetime(2014, 1, 1, 12, 0, 0)
+        utcnow = mock.patch.object(ovsnetwork_db.timeutils, 'utcnow',
+                                   return_value=now).start()
+        old = self._record('h1')
+        self._record('h2')
+        utcnow.return_value = now + datetime.timedelta(seconds=120)
+        recent = self._record('h1')
+        self.plugin.prune_ovs_network_changes(self.context)
+        self.assertTrue(self.plugin.get_ovs_network_changes(
+            self.context, 'h1', 0)['resync'])
+        changes = self.plugin.get_ovs_network_changes(
+            self.context, 'h1', old['revision'] + 1)
+        self.assertEqual(recent['revision'], changes['revision'])
+
+    def test_record_does_not_prune(self):
+        self.config(change_log_ttl=0, group='OVSNETWORK')
+        self._record('h1')
+        self._record('h1')
+        self.assertEqual(2, len(self.plugin.get_ovs_network_changes(
+            self.context, 'h1', 0)['changes']))
+
+
+class TestTunnelKeyDbMixin(OVSNetworkDbTestCase):
+
+    def setUp(self):
+        super(TestTunnelKeyDbMixin, self).setUp()
+        self.tunnel_key = ovsnetwork_db.TunnelKeyDbMixin(
+            key_min=1, key_max=16, chunk_size=4)
+        self.session = self.context.session
+
+    def test_released_key_is_reused_after_commit(self):
+        key = self.tunnel_key.allocate(self.session, 'port1')
+        with self.session.begin():
+            self.tunnel_key.release_many(self.session, ['port1'])
+            self.assertNotIn(key, self.tunnel_key._free)
+        # after the other keys of its chunk
+        keys = self.tunnel_key.allocate_many(self.session,
+                                             ['port2', 'port3', 'port4'])
+        self.assertNotIn(key, keys)
+        self.assertEqual(key, self.tunnel_key.allocate(self.session, 'port5'))
+
+    def test_released_key_is_not_reused_after_rollback(self):
+        key = self.tunnel_key.allocate(self.session, 'port1')
+        try:
+            with self.session.begin():
+                self.tunnel_key.release_many(self.session, ['port1'])
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(key, self.tunnel_key.get(self.session, 'port1'))
+        self.assertNotEqual(key,
+                            self.tunnel_key.allocate(self.session, 'port2'))
+        with self.session.begin():
+            self.tunnel_key.release_many(self.session, ['port1'])
+        self.tunnel_key.allocate_many(self.session, ['port3', 'port4'])
+        self.assertEqual(key, self.tunnel_key.allocate(self.session, 'port5'))
+
+    def _take_key_in_another_process(self, port_id, key):
+        session = db_api.get_session()
+        with session.begin():
+            session.add(ovsnetwork_db.TunnelKey(port_id=port_id,
+                                                tunnel_key=key))
+
+    def test_key_taken_by_another_process_is_skipped(self):
+        self.tunnel_key.allocate(self.session, 'port1')
+        # the same chunk reserved by another process after a wrap around
+        self._take_key_in_another_process('other-port', 2)
+        with self.session.begin():
+            key = self.tunnel_key.allocate(self.session, 'port2')
+        self.assertEqual(5, key)
+        self.assertEqual(key, self.tunnel_key.get(self.session, 'port2'))
+        self.assertEqual(2, self.tunnel_key.get(self.session, 'other-port'))
+
+    def test_failed_insert_keeps_the_transaction_of_the_caller(self):
+        self.tunnel_key.allocate(self.session, 'port1')
+        self._take_key_in_another_process('other-port', 2)
+        with self.session.begin():
+            self.tunnel_key.allocate(self.session, 'port2')
+            self.tunnel_key.allocate(self.session, 'port3')
+        self.assertEqual([5, 6], [self.tunnel_key.get(self.session, port_id)
+                                  for port_id in ('port2', 'port3')])
+
+    def test_port_with_a_key_is_not_retried(self):
+        self.tunnel_key.allocate(self.session, 'port1')
+        self.assertRaises(sa.exc.IntegrityError,
+                          self.tunnel_key.allocate, self.session, 'port1')
+        self.assertEqual([3, 4], list(self.tunnel_key._free))
+
+
+class TestOVSNetworkIndexes(OVSNetworkDbTestCase):
+
+    def _plan(self, query):
+        statement = query.statement.compile(
+            dialect=self.context.session.bind.dialect,
+            compile_kwargs={'literal_binds': True})
+        rows = self.context.session.execute(
+            sa.text('EXPLAIN QUERY PLAN %s' % statement)).fetchall()
+        return ' '.join(row['detail'] for row in rows)
+
+    def _assert_uses_indexes(self, query, *indexes):
+        plan = self._plan(query)
+        for index in indexes:
+            self.assertIn('INDEX %s ' % index, plan)
+
+    def test_vm_port_id_lookup(self):
+        query = self.context.session.query(ovsnetwork_db.VMLink).filter(
+            ovsnetwork_db.VMLink.vm_port_id == 'port1')
+        self._assert_uses_indexes(query, 'ix_vmlinks_vm_port_id')
+
+    def test_ovs_network_id_lookup(self):
+        query = self.context.session.query(ovsnetwork_db.VMLink).filter(
+            ovsnetwork_db.VMLink.ovs_network_id == 'net1')
+        self._assert_uses_indexes(query, 'ix_vmlinks_ovs_network_id')
+
+    def test_ovs_link_endpoints_lookup(self):
+        OVSLink = ovsnetwork_db.OVSLink
+        query = self.context.session.query(OVSLink).filter(
+            sa.or_(OVSLink.left_ovs_id == 'net1',
+                   OVSLink.right_ovs_id == 'net1'))
+        self._assert_uses_indexes(query, 'ix_ovslinks_left_ovs_id',
+                                  'ix_ovslinks_right_ovs_id')
+
+    def test_tunnel_key_port_id_lookup(self):
+        TunnelKey = ovsnetwork_db.TunnelKey
+        query = self.context.session.query(TunnelKey).filter(
+            TunnelKey.port_id.in_(['port1', 'port2']))
+        self._assert_uses_indexes(query, 'ix_tunnelkeys_port_id')
+
+
+class TestPrepareOVSTopology(OVSNetworkDbTestCase):
+
+    def _prepare(self, ovs_networks=None, ovs_links=None, vm_links=None):
+        return self.plugin._prepare_ovs_topology(
+            self.context, {'name': 'topology1', 'tenant_id': 'tenant1',
+                           'ovs_networks': ovs_networks or [],
+                           'ovs_links': ovs_links or [],
+                           'vm_links': vm_links or []})
+
+    def _assert_invalid(self, **members):
+        self.assertRaises(ext_ovsnetwork.InvalidOVSTopology,
+                          self._prepare, **members)
+
+    def test_defaults_are_filled_in(self):
+        members = self._prepare(
+            ovs_networks=[{'name': 'net1', 'controller_port_num': '6633'},
+                          {'name': 'net2'}],
+            ovs_links=[{'name': 'link1', 'left_ovs_name': 'net1',
+                        'right_ovs_name': 'net2'}],
+            vm_links=[{'name': 'vm1', 'ovs_network_name': 'net2'}])
+        net1, net2 = members['ovs_networks']
+        self.assertEqual(6633, net1['controller_port_num'])
+        self.assertEqual(('', None, None),
+                         (net2['host'], net2['controller_ipv4_address'],
+                          net2['controller_port_num']))
+        self.assertEqual('net1', members['ovs_links'][0]['left_ovs_name'])
+        vm_link, = members['vm_links']
+        self.assertEqual(('', 65534, 'PENDING'),
+                         (vm_link['vm_host'], vm_link['vm_ofport'],
+                          vm_link['status']))
+
+    def test_members_must_be_a_list_of_objects(self):
+        self._assert_invalid(ovs_networks={'name': 'net1'})
+        self._assert_invalid(ovs_networks=['net1'])
+
+    def test_unknown_attributes(self):
+        self._assert_invalid(ovs_networks=[{'name': 'net1', 'bogus': 1}])
+        # members refer to each other by name, not by id
+        self._assert_invalid(ovs_networks=[{'name': 'net1'}],
+                             vm_links=[{'name': 'vm1',
+                                        'ovs_network_id': 'net1'}])
+
+    def test_invalid_values(self):
+        self._assert_invalid(ovs_networks=[{
+            'name': 'net1', 'controller_ipv4_address': 'not-an-ip'}])
+        self._assert_invalid(ovs_networks=[{'name': 7}])
+
+    def test_names_are_required_and_unique(self):
+        self._assert_invalid(ovs_networks=[{'host': 'host1'}])
+        self._assert_invalid(ovs_networks=[{'name': 'net1'},
+                                           {'name': 'net1'}])
+
+    def test_links_refer_to_networks_of_the_topology(self):
+        self._assert_invalid(
+            ovs_networks=[{'name': 'net1'}],
+            ovs_links=[{'name': 'link1', 'left_ovs_name': 'net1',
+                        'right_ovs_name': 'net2'}])
+        self._assert_invalid(
+            ovs_networks=[{'name': 'net1'}],
+            vm_links=[{'name': 'vm1'}])
+
+    def test_names_in_use(self):
+        with self.context.session.begin():
+            self.context.session.add(ovsnetwork_db.OVSNetwork(
+                id='net-id', tenant_id='tenant1', name='net1'))
+        self._assert_invalid(ovs_networks=[{'name': 'net1'}])
+        self._prepare(ovs_networks=[{'name': 'net2'}])
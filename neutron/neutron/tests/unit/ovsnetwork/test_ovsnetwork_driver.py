@@ -0,0 +1,418 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from oslo.config import cfg
+
+from neutron.agent.common import config
+from neutron.agent.linux import ovsnetwork
+from neutron.agent.linux import ovsnetwork_netlink
+from neutron.agent.linux import ovsnetwork_reconcile
+from neutron.agent.linux import ovsnetwork_rootwrap
+from neutron.tests import base
+
+
+class FakeVethExecutor(object):
+    """Run 'ip link' commands against a set of veth pairs."""
+
+    def __init__(self, pairs):
+        self.peers = {}
+        for name, peer in pairs:
+            self.peers[name] = peer
+            self.peers[peer] = name
+        self.commands = []
+
+    def link_exists(self, name):
+        return name in self.peers
+
+    def execute_many(self, commands, check_exit_code=True):
+        outputs = []
+        for cmd, _process_input in commands:
+            self.commands.append(cmd)
+            action, name = cmd[2], cmd[3]
+            if action == 'delete':
+                if name not in self.peers:
+                    if check_exit_code:
+                        raise RuntimeError('Cannot find device "%s"' % name)
+                    outputs.append('')
+                    continue
+                del self.peers[self.peers.pop(name)]
+            outputs.append('')
+        return outputs
+
+
+class TestIPVethManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestIPVethManager, self).setUp()
+        self.executor = FakeVethExecutor([('tva', 'ova'), ('tvb', 'ovb')])
+        mock.patch.object(ovsnetwork_netlink, 'link_exists',
+                          side_effect=self.executor.link_exists).start()
+        self.veth = ovsnetwork.IPVethManager(self.executor)
+
+    def test_delete_links_both_ends_of_pairs(self):
+        self.veth.delete_links(['tva', 'ova', 'tvb', 'ovb'])
+        self.assertEqual({}, self.executor.peers)
+
+    def test_delete_links_raises_for_links_left(self):
+        self.executor.execute_many = mock.Mock()
+        self.assertRaises(RuntimeError, self.veth.delete_links, ['tva'])
+
+
+class TestVethPool(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestVethPool, self).setUp()
+        mock.patch.object(ovsnetwork.eventlet, 'spawn_n').start()
+        self.veth = mock.Mock()
+        self.pool = ovsnetwork.VethPool(self.veth, 1)
+        self.pool.free.append(('ovpa1', 'ovpb1'))
+
+    def test_take_renames_a_spare_pair(self):
+        self.assertTrue(self.pool.take('tva', 'ova'))
+        self.veth.rename_links.assert_called_once_with(
+            [('ovpa1', 'tva'), ('ovpb1', 'ova')])
+
+    def test_failed_rename_deletes_the_spare_pair(self):
+        self.veth.rename_links.side_effect = RuntimeError()
+        self.assertFalse(self.pool.take('tva', 'ova'))
+        self.veth.delete_links.assert_called_once_with(['ovpa1'])
+
+    def test_failed_cleanup_still_falls_back(self):
+        self.veth.rename_links.side_effect = RuntimeError()
+        self.veth.delete_links.side_effect = RuntimeError()
+        self.assertFalse(self.pool.take('tva', 'ova'))
+
+
+class OVSNetworkDriverTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(OVSNetworkDriverTestCase, self).setUp()
+        config.register_root_helper(cfg.CONF)
+        self.executor = mock.patch.object(
+            ovsnetwork_rootwrap, 'CommandExecutor').start().return_value
+        self.ovsdb = mock.patch.object(
+            ovsnetwork, 'VsctlOVSDBBackend').start().return_value
+        self.driver = ovsnetwork.OVSNetworkDriver()
+
+    def _flows(self, action):
+        """The flows of every ovs-ofctl <action>-flows call, by bridge."""
+        flows = {}
+        for call in self.executor.execute.call_args_list:
+            args = call[0][0]
+            if args[:2] == ['ovs-ofctl', '%s-flows' % action]:
+                flows.setdefault(args[2], []).extend(
+                    call[1]['process_input'].split())
+        return flows
+
+
+class TestOVSNetworkDeleted(OVSNetworkDriverTestCase):
+
+    def test_deletes_flows_of_its_endpoints_only(self):
+        name = self.driver.get_ovs_network_name_from_id('net1')
+        other = self.driver.get_ovs_network_name_from_id('net2')
+        self.driver.desired.set_bridge(name)
+        self.driver.desired.set_bridge(other)
+        self.driver.desired.add_endpoint('olb1', name, 'olo1', 11, 12)
+        self.driver.desired.add_vm_endpoint(5, name, 13, 14)
+        self.driver.desired.add_endpoint('olb2', other, 'olo2', 21, 22)
+        with mock.patch.object(ovsnetwork_reconcile, 'network_cookie',
+                               return_value=ovsnetwork_reconcile.COOKIE_TAG):
+            # even if the hashes of the two bridges collide
+            self.driver.ovs_network_deleted(None, 'net1')
+        self.assertEqual(
+            sorted('cookie=%s' % ovsnetwork_reconcile.cookie_match(cookie)
+                   for cookie in (ovsnetwork_reconcile.COOKIE_TAG | 11,
+                                  ovsnetwork_reconcile.COOKIE_TAG | 13)),
+            sorted(self._flows('del')['br-int']))
+        self.ovsdb.del_bridge.assert_called_once_with(name)
+        self.assertEqual({}, self.driver.desired.vm_endpoints)
+        self.assertEqual(['olb2'], self.driver.desired.endpoints.keys())
+
+
+class TestSharedBridgePlacement(OVSNetworkDriverTestCase):
+
+    def setUp(self):
+        super(TestSharedBridgePlacement, self).setUp()
+        self.config(bridge_mode='shared', group='OVSNETWORK')
+        self.ovsdb.bridge_exists.return_value = False
+        self.ovsdb.snapshot.return_value = {'bridges': {}, 'interfaces': {
+            'olo1': {'external_ids': {
+                ovsnetwork.SLICE_EXTERNAL_ID: 'ovsa1:2'}},
+            'olo2': {'external_ids': {}}}}
+        self.driver = ovsnetwork.OVSNetworkDriver()
+
+    def test_tags_are_recovered_from_ovsdb(self):
+        self.assertEqual({'ovsa1': 2}, self.driver.network_tags)
+        self.assertEqual(('br-ovsnet', 2),
+                         self.driver.get_ovs_network_placement('ovsa1'))
+
+    def test_new_networks_get_free_tags(self):
+        self.assertEqual(('br-ovsnet', 1),
+                         self.driver.get_ovs_network_placement('ovsb1'))
+        self.assertEqual(('br-ovsnet', 3),
+                         self.driver.get_ovs_network_placement('ovsb2'))
+        self.assertEqual(('br-ovsnet', 1),
+                         self.driver.get_ovs_network_placement('ovsb1'))
+
+    def test_no_tag_without_allocate(self):
+        self.assertEqual(('ovsb1', None), self.driver.get_ovs_network_placement(
+            'ovsb1', allocate=False))
+        self.assertNotIn('ovsb1', self.driver.network_tags)
+
+    def test_networks_with_a_controller_are_dedicated(self):
+        self.driver.desired.set_bridge('ovsb1', 'tcp:1.2.3.4:6633')
+        self.assertEqual(('ovsb1', None),
+                         self.driver.get_ovs_network_placement('ovsb1'))
+
+    def test_existing_dedicated_bridges_are_kept(self):
+        self.ovsdb.bridge_exists.return_value = True
+        self.assertEqual(('ovsb1', None),
+                         self.driver.get_ovs_network_placement('ovsb1'))
+
+    def test_br_int_is_not_shared(self):
+        self.assertEqual(('br-int', None),
+                         self.driver.get_ovs_network_placement('br-int'))
+
+    def test_tag_is_freed_with_the_shared_ports(self):
+        self.driver.delete_shared_ports('ovsa1')
+        self.assertEqual([('br-ovsnet', 'olo1')],
+                         self.ovsdb.del_ports.call_args[0][0])
+        self.assertEqual(('br-ovsnet', 1),
+                         self.driver.get_ovs_network_placement('ovsb1'))
+        self.assertEqual(('br-ovsnet', 2),
+                         self.driver.get_ovs_network_placement('ovsb2'))
+
+    def test_shared_bridge_full(self):
+        self.driver.network_tags = dict(('net%d' % tag, tag)
+                                        for tag in range(1, 4095))
+        self.assertRaises(ovsnetwork.SharedBridgeFullError,
+                          self.driver.get_ovs_network_placement, 'ovsb1')
+
+    def test_port_pair_specs_carry_the_slice(self):
+        self.assertEqual(
+            [('br-ovsnet', 'olo3', {'ovs-network': 'ovsa1',
+                                    ovsnetwork.SLICE_EXTERNAL_ID: 'ovsa1:2'},
+              None, 2),
+             ('br-int', 'olb3', {'ovs-network': 'ovsa1'}, None, None)],
+            self.driver.get_port_pair_specs('ovsa1', 'olo3', 'br-int', 'olb3'))
+
+
+class TestMoveToDedicatedBridge(OVSNetworkDriverTestCase):
+
+    OVS_NETWORK = {'id': 'a1', 'controller_ipv4_address': '1.2.3.4',
+                   'controller_port_num': 6633}
+
+    def setUp(self):
+        super(TestMoveToDedicatedBridge, self).setUp()
+        self.config(bridge_mode='shared', group='OVSNETWORK')
+        self.links = set(['olo1', 'olb1'])
+        mock.patch.object(ovsnetwork_netlink, 'link_exists',
+                          side_effect=lambda name: name in self.links).start()
+        self.executor.execute.return_value = ''
+        self.snapshot = {
+            'bridges': {'br-ovsnet': {'controller': [], 'ports': set(['olo1'])},
+                        'br-int': {'controller': [], 'ports': set(['olb1'])}},
+            'interfaces': {
+                'olo1': {'type': '', 'ofport': 1, 'external_ids': {
+                    'ovs-network': 'ovsa1',
+                    ovsnetwork.SLICE_EXTERNAL_ID: 'ovsa1:2'}},
+                'olb1': {'type': '', 'ofport': 5, 'external_ids': {
+                    'ovs-network': 'ovsa1'}}}}
+        self.ovsdb.snapshot.side_effect = lambda: self.snapshot
+        self.ovsdb.del_ports.side_effect = self._del_ports
+        self.driver = ovsnetwork.OVSNetworkDriver()
+        self.driver.veth = mock.Mock()
+        self.driver.veth.delete_links.side_effect = self.links.difference_update
+        self.driver.desired.set_bridge('ovsa1')
+        self.driver.desired.add_endpoint('olb1', 'ovsa1', 'olo1', 11, 12)
+
+    def _del_ports(self, ports):
+        for bridge, port in ports:
+            self.snapshot['bridges'][bridge]['ports'].discard(port)
+            self.snapshot['interfaces'].pop(port, None)
+
+    def test_shared_network_with_a_controller_gets_its_own_bridge(self):
+        self.assertEqual(('br-ovsnet', 2),
+                         self.driver.get_ovs_network_placement('ovsa1'))
+        self.driver.ovs_network_updated(None, self.OVS_NETWORK)
+        self.assertEqual([('br-ovsnet', 'olo1')],
+                         self.ovsdb.del_ports.call_args_list[0][0][0])
+        self.ovsdb.add_bridge.assert_called_once_with(
+            'ovsa1', ['tcp:1.2.3.4:6633'])
+        self.assertEqual(
+            [('ovsa1', 'olo1', {'ovs-network': 'ovsa1'}, None, None)],
+            [spec for spec in self.ovsdb.add_ports.call_args[0][0]
+             if spec[1] == 'olo1'])
+        self.assertEqual({}, self.driver.network_tags)
+        self.assertEqual(('ovsa1', None),
+                         self.driver.get_ovs_network_placement('ovsa1'))
+
+    def test_dedicated_network_gets_the_controller_set(self):
+        self.driver.network_tags.clear()
+        self.snapshot['bridges']['ovsa1'] = {'controller': [],
+                                             'ports': set()}
+        self.ovsdb.bridge_exists.return_value = True
+        self.ovsdb.get_controller.return_value = []
+        self.driver.ovs_network_updated(None, self.OVS_NETWORK)
+        self.ovsdb.set_controller.assert_called_once_with(
+            'ovsa1', ['tcp:1.2.3.4:6633'])
+        self.assertFalse(self.ovsdb.add_bridge.called)
+        self.assertFalse(self.ovsdb.del_ports.called)
+
+
+class TestReplaceEndpointFlows(OVSNetworkDriverTestCase):
+
+    def _calls(self):
+        """(action, bridge, flows) of the ovs-ofctl calls, in order."""
+        calls = []
+        for call in self.executor.execute.call_args_list:
+            args = call[0][0]
+            if args[0] == 'ovs-ofctl':
+                calls.append((args[1].split('-')[0], args[2],
+                              [set(flow.split(',')) for flow in
+                               call[1]['process_input'].split()]))
+        return calls
+
+    def _cookie(self, bridge, tunnel_id):
+        return ovsnetwork_reconcile.cookie_match(
+            ovsnetwork_reconcile.endpoint_cookie(bridge, tunnel_id))
+
+    def test_local_peer_change(self):
+        self.driver.replace_endpoint_flows(5, 'ovsa1', 12, 'ovsb2', 11, 13,
+                                           None, None)
+        (add, int_br, added), (delete, _br, deleted) = self._calls()
+        self.assertEqual(('add', 'br-int'), (add, int_br))
+        cookie = '0x%x' % ovsnetwork_reconcile.endpoint_cookie('ovsb2', 11)
+        self.assertEqual(2, len(added))
+        for flow in added:
+            self.assertIn('cookie=%s' % cookie, flow)
+        self.assertEqual(['in_port=5', 'tun_id=13'],
+                         sorted(field for flow in added for field in flow
+                                if field in ('in_port=5', 'tun_id=13')))
+        # the table 0 flow keeps its match and is replaced in place
+        self.assertEqual('del', delete)
+        self.assertEqual([set(['cookie=%s' % self._cookie('ovsa1', 11),
+                               'table=1', 'tun_id=12'])], deleted)
+
+    def test_unchanged_flows_are_not_deleted(self):
+        self.driver.replace_endpoint_flows(5, 'ovsa1', 12, 'ovsa1', 11, 12,
+                                           None, None)
+        self.assertEqual(['add'], [call[0] for call in self._calls()])
+
+    def test_remote_peer_change(self):
+        local_vlans = set([100, 101, 102])
+        self.driver.setup_tunneling(mock.Mock(br_name='br-tun'), 1, 2, 3,
+                                    lambda ip: 9, local_vlans)
+        tunnel = self.driver.tunnel
+        tunnel.vlans.update({11: 100, 12: 101})
+        local_vlans.difference_update([100, 101])
+        self.driver.replace_endpoint_flows(None, 'ovsa1', 12, 'ovsa1', 11,
+                                           13, 'host2', '10.0.0.2')
+        self.assertEqual({11: 100, 13: 102}, tunnel.vlans)
+        self.assertEqual(set([101]), local_vlans)
+        deletes = [(bridge, flows) for action, bridge, flows in self._calls()
+                   if action == 'del']
+        cookie = 'cookie=%s' % self._cookie('ovsa1', 11)
+        self.assertEqual(
+            [('br-int', [set([cookie, 'table=0', 'in_port=2',
+                              'dl_vlan=101'])]),
+             ('br-tun', [set([cookie, 'table=3', 'tun_id=12'])])],
+            sorted(deletes))
+        adds = [(bridge, len(flows)) for action, bridge, flows in
+                self._calls() if action == 'add']
+        self.assertEqual([('br-int', 2), ('br-tun', 2)], sorted(adds))
+        # every add goes before the deletes of its bridge
+        actions = [(call[1], call[0]) for call in self._calls()]
+        for bridge in ('br-int', 'br-tun'):
+            self.assertLess(actions.index((bridge, 'add')),
+                            actions.index((bridge, 'del')))
+
+
+class TestTunnelVlans(OVSNetworkDriverTestCase):
+
+    def _setup_tunneling(self, local_vlans, max_vlans):
+        self.config(max_tunnel_vlans=max_vlans, group='OVSNETWORK')
+        self.driver.setup_tunneling(mock.Mock(br_name='br-tun'), 1, 2, 3,
+                                    lambda ip: 9, local_vlans)
+        return self.driver.tunnel
+
+    def test_empty_pool_is_reported(self):
+        local_vlans = set([100])
+        tunnel = self._setup_tunneling(local_vlans, 10)
+        self.assertEqual(100, tunnel.get_vlan(11))
+        self.assertRaises(ovsnetwork.TunnelVlanExhaustedError,
+                          tunnel.get_vlan, 12)
+        self.assertEqual({11: 100}, tunnel.vlans)
+
+    def test_links_take_at_most_max_tunnel_vlans(self):
+        local_vlans = set([100, 101, 102])
+        tunnel = self._setup_tunneling(local_vlans, 2)
+        tunnel.get_vlan(11)
+        tunnel.get_vlan(12)
+        self.assertRaises(ovsnetwork.TunnelVlanExhaustedError,
+                          tunnel.get_vlan, 13)
+        self.assertEqual(1, len(local_vlans))
+        tunnel.release(12)
+        tunnel.get_vlan(13)
+
+    def test_forwarding_without_vlan_applies_nothing(self):
+        local_vlans = set([100])
+        tunnel = self._setup_tunneling(local_vlans, 10)
+        def block():
+            with self.driver.flow_batch() as flows:
+                flows.add_flow(table='0', priority=10, in_port=5,
+                               actions='resubmit(,1)')
+                self.driver.add_peer_forwarding('ovsa1', 11, 12, 'host2',
+                                                '10.0.0.2', link_id='link1')
+        with mock.patch.object(ovsnetwork.LOG, 'error') as log_error:
+            self.assertRaises(ovsnetwork.TunnelForwardingError, block)
+        self.assertIn('link1', log_error.call_args[0][1].values())
+        # the VLAN taken for the first tunnel id is given back
+        self.assertEqual({}, tunnel.vlans)
+        self.assertEqual(set([100]), local_vlans)
+        self.assertEqual({}, self._flows('add'))
+
+
+class TestFlowBatch(OVSNetworkDriverTestCase):
+
+    def test_flows_are_applied_on_exit(self):
+        with self.driver.flow_batch() as flows:
+            flows.add_flow(table='0', priority=10, actions='drop')
+            with self.driver.flow_batch() as inner:
+                inner.delete_flows(table='1')
+            self.assertFalse(self.executor.execute.called)
+        self.assertEqual(['table=1'], self._flows('del')['br-int'])
+        self.assertEqual(1, len(self._flows('add')['br-int']))
+
+    def test_flows_are_dropped_when_the_block_raises(self):
+        def failing_block():
+            with self.driver.flow_batch() as flows:
+                flows.add_flow(table='0', priority=10, actions='drop')
+                raise ValueError()
+        self.assertRaises(ValueError, failing_block)
+        self.assertFalse(self.executor.execute.called)
+        # the next batch starts afresh
+        with self.driver.flow_batch() as flows:
+            flows.delete_flows(table='1')
+        self.assertEqual({'br-int': ['table=1']}, self._flows('del'))
+        self.assertEqual({}, self._flows('add'))
+
+    def test_failed_apply_raises(self):
+        self.executor.execute.side_effect = RuntimeError()
+
+        def block():
+            with self.driver.flow_batch() as flows:
+                flows.delete_flows(table='1')
+        self.assertRaises(ovsnetwork.FlowBatchError, block)
@@ -0,0 +1,123 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from eventlet.green import socket
+import mock
+
+from neutron.agent.linux import ovsnetwork_ovsdb as ovsdb
+from neutron.tests import base
+from neutron.tests.unit.ovsnetwork import fake_ovsdb
+
+
+class RacingOVSDBServer(fake_ovsdb.FakeOVSDBServer):
+    """Deletes the bridges right after answering a monitor request."""
+
+    def _dispatch(self, client, msg):
+        super(RacingOVSDBServer, self)._dispatch(client, msg)
+        if msg.get('method') == 'monitor':
+            self.transact([
+                {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+                 'mutations': [['bridges', 'delete',
+                                ovsdb.uuid_set(self.tables['Bridge'])]]}])
+
+
+class NativeOVSDBBackendTestCase(base.BaseTestCase):
+
+    server_class = fake_ovsdb.FakeOVSDBServer
+
+    def setUp(self):
+        super(NativeOVSDBBackendTestCase, self).setUp()
+        mock.patch.object(ovsdb, 'socket', socket).start()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'db.sock')
+        self.server = self.server_class(path)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.backend = ovsdb.NativeOVSDBBackend('unix:' + path, timeout=5)
+        self.addCleanup(self.backend.stop)
+
+
+class TestNativeOVSDBBackend(NativeOVSDBBackendTestCase):
+
+    def test_add_and_del_bridge(self):
+        self.backend.add_bridge('br1', ['tcp:1.2.3.4:6633'])
+        self.assertTrue(self.backend.bridge_exists('br1'))
+        self.assertEqual(['tcp:1.2.3.4:6633'],
+                         self.backend.get_controller('br1'))
+        self.backend.del_bridge('br1')
+        self.assertFalse(self.backend.bridge_exists('br1'))
+        self.assertEqual({}, self.server.tables['Controller'])
+
+    def test_set_and_del_controller(self):
+        self.backend.add_bridge('br1')
+        self.backend.set_controller('br1', ['tcp:1.2.3.4:6633'])
+        self.assertEqual(['tcp:1.2.3.4:6633'],
+                         self.backend.get_controller('br1'))
+        self.backend.del_controller('br1')
+        self.assertEqual([], self.backend.get_controller('br1'))
+
+    def test_add_ports_and_get_ofport(self):
+        self.backend.add_bridge('br1')
+        self.backend.add_ports([('br1', 'p1', {'ovs-network': 'br1'},
+                                 None, None),
+                                ('br1', 'p2', None, None, None)])
+        self.assertTrue(self.backend.get_ofport('p1') > 0)
+        self.assertIsNone(self.backend.get_ofport('p3'))
+        snapshot = self.backend.snapshot()
+        self.assertEqual(set(['br1', 'p1', 'p2']),
+                         snapshot['bridges']['br1']['ports'])
+        self.assertEqual({'ovs-network': 'br1'},
+                         snapshot['interfaces']['p1']['external_ids'])
+
+    def test_del_ports(self):
+        self.backend.add_bridge('br1')
+        self.backend.add_ports([('br1', 'p1', None, None, None)])
+        self.backend.del_ports([('br1', 'p1'), ('br1', 'p2')])
+        self.assertEqual(set(['br1']),
+                         self.backend.snapshot()['bridges']['br1']['ports'])
+
+    def test_failed_transaction_raises(self):
+        self.backend.add_bridge('br1')
+        self.assertRaises(ovsdb.OVSDBError, self.backend.transact,
+                          [{'op': 'insert', 'table': 'Bridge',
+                            'row': {'name': 'br1'}}])
+
+    def test_reconnects_with_a_fresh_replica(self):
+        self.backend.add_bridge('br1')
+        self.backend.stop()
+        self.server.transact([
+            {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+             'mutations': [['bridges', 'delete',
+                            ovsdb.uuid_set(self.server.tables['Bridge'])]]}])
+        self.assertFalse(self.backend.bridge_exists('br1'))
+
+
+class TestNativeOVSDBBackendMonitor(NativeOVSDBBackendTestCase):
+
+    server_class = RacingOVSDBServer
+
+    def test_updates_after_the_monitor_reply_are_kept(self):
+        self.server.transact([
+            {'op': 'insert', 'table': 'Bridge', 'uuid-name': 'bridge',
+             'row': {'name': 'br1'}},
+            {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+             'mutations': [['bridges', 'insert',
+                            ovsdb.uuid_set(['bridge'], named=True)]]}])
+        self.backend.start()
+        self.assertFalse(self.backend.bridge_exists('br1'))
@@ -0,0 +1,109 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.agent.linux import ovsnetwork_netlink
+from neutron.agent.linux import ovsnetwork_reconcile
+from neutron.tests import base
+from neutron.tests.unit.ovsnetwork import test_ovsnetwork_driver
+
+
+class TestDesiredState(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestDesiredState, self).setUp()
+        self.desired = ovsnetwork_reconcile.DesiredState()
+        self.desired.set_bridge('br1')
+        self.desired.set_bridge('br2')
+        self.desired.add_endpoint('olb1', 'br1', 'olo1', 1, 2)
+        self.desired.add_direct_link('olo3', 'br1', 'olo4', 'br2')
+
+    def test_port_pairs(self):
+        self.assertEqual([('br1', 'olo1', None, 'olb1'),
+                          ('br1', 'olo3', 'br2', 'olo4')],
+                         sorted(self.desired.port_pairs()))
+
+    def test_remove_direct_link(self):
+        self.desired.remove_direct_link('olo3')
+        self.assertEqual([('br1', 'olo1', None, 'olb1')],
+                         self.desired.port_pairs())
+
+    def test_remove_bridge_drops_the_direct_links_to_it(self):
+        self.desired.remove_bridge('br2')
+        self.assertEqual([('br1', 'olo1', None, 'olb1')],
+                         self.desired.port_pairs())
+        self.desired.remove_bridge('br1')
+        self.assertEqual([], self.desired.port_pairs())
+
+
+class TestReconcileDirectLinks(test_ovsnetwork_driver.OVSNetworkDriverTestCase):
+
+    OVS_LINK = {'id': 'l1', 'left_port_id': 'p1', 'right_port_id': 'p2',
+                'left_ovs_id': 'a1', 'right_ovs_id': 'b2'}
+
+    def setUp(self):
+        super(TestReconcileDirectLinks, self).setUp()
+        self.links = set()
+        mock.patch.object(ovsnetwork_netlink, 'link_exists',
+                          side_effect=lambda name: name in self.links).start()
+        self.driver.veth = mock.Mock()
+        self.executor.execute.return_value = ''
+        self.ovsdb.snapshot.return_value = {
+            'bridges': {'ovsa1': {'controller': [], 'ports': set()},
+                        'ovsb2': {'controller': [], 'ports': set()}},
+            'interfaces': {}}
+
+    def _reconcile(self, ovs_links):
+        ovs_networks = [{'id': id, 'controller_ipv4_address': None,
+                         'controller_port_num': None}
+                        for id in ('a1', 'b2')]
+        return self.driver.reconcile({'ovs_networks': ovs_networks,
+                                      'ovs_links_direct': ovs_links})
+
+    def _add_port(self, bridge, port):
+        snapshot = self.ovsdb.snapshot.return_value
+        snapshot['bridges'][bridge]['ports'].add(port)
+        snapshot['interfaces'][port] = {
+            'type': '', 'ofport': 1,
+            'external_ids': {ovsnetwork_reconcile.ENDPOINT_EXTERNAL_ID:
+                             'ovsa1'}}
+        self.links.add(port)
+
+    def test_missing_direct_link_is_created(self):
+        changes = self._reconcile([self.OVS_LINK])
+        self.driver.veth.add_veth_pairs.assert_called_once_with(
+            [('olop1', 'olop2')])
+        self.ovsdb.add_ports.assert_called_once_with(
+            [('ovsa1', 'olop1', {'ovs-network': 'ovsa1'}, None, None),
+             ('ovsb2', 'olop2', {'ovs-network': 'ovsa1'}, None, None)])
+        self.assertEqual(1, changes['veth_pairs_added'])
+
+    def test_direct_link_in_place_is_kept(self):
+        self._add_port('ovsa1', 'olop1')
+        self._add_port('ovsb2', 'olop2')
+        changes = self._reconcile([self.OVS_LINK])
+        self.assertFalse(self.driver.veth.add_veth_pairs.called)
+        self.assertFalse(self.ovsdb.add_ports.called)
+        self.assertFalse(self.ovsdb.del_ports.called)
+        self.assertEqual({}, changes)
+
+    def test_stale_direct_link_is_deleted(self):
+        self._add_port('ovsa1', 'olop1')
+        self._add_port('ovsb2', 'olop2')
+        self._reconcile([])
+        self.assertEqual([('ovsa1', 'olop1'), ('ovsb2', 'olop2')],
+                         sorted(self.ovsdb.del_ports.call_args[0][0]))
+        self.assertEqual(['olop1', 'olop2'],
+                         sorted(self.driver.veth.delete_links.call_args[0][0]))
@@ -0,0 +1,200 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+
+from neutron.agent import ovsnetwork_rpc_agent
+from neutron.tests import base
+
+
+class FakeOVSNetworkAgent(ovsnetwork_rpc_agent.OVSNetworkAgentRpcMixin):
+
+    def __init__(self):
+        super(FakeOVSNetworkAgent, self).__init__()
+        self.ovs_network_driver = mock.MagicMock()
+        self.ovs_network_queue = mock.Mock()
+
+
+class TestOVSNetworkEventBatch(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestOVSNetworkEventBatch, self).setUp()
+        self.config(ovs_network_driver='', group='OVSNETWORK')
+        self.agent = FakeOVSNetworkAgent()
+        self.context = mock.Mock()
+
+    def _submitted(self):
+        return [(call[0][0], call[0][3])
+                for call in self.agent.ovs_network_queue.submit.call_args_list]
+
+    def test_batch_is_split_per_key(self):
+        link = {'id': 'l1', 'left_ovs_id': 'n1', 'right_ovs_id': 'n2'}
+        with self.agent.ovs_network_event_batch(self.context):
+            self.agent.ovs_network_created(self.context, {'id': 'n1'})
+            self.agent.ovs_network_created(self.context, {'id': 'n2'})
+            self.agent.ovs_link_left_endpoint_created(self.context, link)
+            self.agent.ovs_link_right_endpoint_created(self.context, link)
+        self.assertEqual(
+            [('n1', [('ovs_network_created', {'id': 'n1'}),
+                     ('ovs_link_left_endpoint_created', link)]),
+             ('n2', [('ovs_network_created', {'id': 'n2'}),
+                     ('ovs_link_right_endpoint_created', link)])],
+            self._submitted())
+
+    def test_events_are_keyed_by_their_bridges(self):
+        self.agent.ovs_network_created(self.context, {'id': 'n2'})
+        self.agent.ovs_link_direct_created(
+            self.context, {'id': 'l1', 'left_ovs_id': 'n2',
+                           'right_ovs_id': 'n1'})
+        self.agent.vm_link_vm_endpoint_created(
+            self.context, {'id': 'v1', 'ovs_network_id': 'n1'})
+        self.agent.vm_link_vm_endpoint_updated(
+            self.context, {'id': 'v1', 'ovs_network_id': 'n3',
+                           'old_ovs_network_id': 'n1'})
+        self.assertEqual(['n2', ('n2', 'n1'), 'n1', ('n1', 'n3')],
+                         [call[0][0] for call in
+                          self.agent.ovs_network_queue.submit.call_args_list])
+
+    def test_batch_merges_events_sharing_a_bridge(self):
+        link = {'id': 'l1', 'left_ovs_id': 'n2', 'right_ovs_id': 'n1'}
+        with self.agent.ovs_network_event_batch(self.context):
+            self.agent.ovs_network_created(self.context, {'id': 'n1'})
+            self.agent.ovs_network_created(self.context, {'id': 'n3'})
+            self.agent.ovs_network_created(self.context, {'id': 'n2'})
+            self.agent.ovs_link_direct_created(self.context, link)
+        self.assertEqual(
+            [(('n1', 'n2'), [('ovs_network_created', {'id': 'n1'}),
+                             ('ovs_network_created', {'id': 'n2'}),
+                             ('ovs_link_direct_created', link)]),
+             ('n3', [('ovs_network_created', {'id': 'n3'})])],
+            self._submitted())
+
+    def test_batch_and_single_events_share_keys(self):
+        with self.agent.ovs_network_event_batch(self.context):
+            self.agent.ovs_network_created(self.context, {'id': 'n1'})
+        self.agent.ovs_network_deleted(self.context, 'n1')
+        self.assertEqual(['n1', 'n1'], [key for key, events in self._submitted()])
+
+    def test_batch_without_queue_is_applied_in_order(self):
+        self.agent.ovs_network_queue = None
+        with self.agent.ovs_network_event_batch(self.context):
+            self.agent.ovs_network_created(self.context, {'id': 'n1'})
+            self.agent.ovs_network_deleted(self.context, 'n2')
+        driver = self.agent.ovs_network_driver
+        driver.ovs_network_created.assert_called_once_with(self.context, {'id': 'n1'})
+        driver.ovs_network_deleted.assert_called_once_with(self.context, 'n2')
+
+
+class TestOVSNetworkWorkQueue(base.BaseTestCase):
+
+    def test_item_with_two_keys_is_ordered_with_both(self):
+        queue = ovsnetwork_rpc_agent.OVSNetworkWorkQueue(2)
+        applied = []
+
+        def work(name, delay=0):
+            eventlet.sleep(delay)
+            applied.append(name)
+        queue.submit('n1', work, 'n1 first', 0.01)
+        queue.submit(('n2', 'n1'), work, 'direct link')
+        queue.submit('n2', work, 'n2 after')
+        queue.submit('n3', work, 'n3')
+        queue.wait_idle(0)
+        self.assertEqual(['n1 first', 'direct link', 'n2 after'],
+                         [name for name in applied if name != 'n3'])
+        self.assertEqual(4, queue.processed)
+        self.assertEqual({}, queue.queues)
+
+    def test_depth_counts_items_once(self):
+        queue = ovsnetwork_rpc_agent.OVSNetworkWorkQueue(0)
+        queue.submit(('n1', 'n2'), mock.Mock())
+        queue.submit('n1', mock.Mock())
+        self.assertEqual(2, queue.depth())
+        self.assertEqual(2, queue.get_stats()['busy_keys'])
+
+
+class FakeOVSNetworkNotifier(ovsnetwork_rpc_agent.OVSNetworkAgentRpcApiMixin):
+
+    topic = 'q-agent-notifier'
+
+    def __init__(self):
+        self.cast = mock.Mock()
+
+    def make_msg(self, method, **kwargs):
+        return {'method': method, 'args': kwargs}
+
+
+class TestOVSTopologyBatch(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestOVSTopologyBatch, self).setUp()
+        self.config(ovs_topology_notify_window=0, group='OVSNETWORK')
+        self.notifier = FakeOVSNetworkNotifier()
+        self.context = mock.Mock()
+        self.spawn_after = mock.patch.object(
+            ovsnetwork_rpc_agent.eventlet, 'spawn_after').start()
+
+    def _sent(self):
+        return [(call[1]['topic'], [event['args']['ovs_network']['id']
+                                    for event in call[0][1]['args']['events']])
+                for call in self.notifier.cast.call_args_list]
+
+    def test_batch_sends_one_message_per_host(self):
+        with self.notifier.ovs_topology_batch():
+            with self.notifier.ovs_topology_batch():
+                for id, host in (('n1', 'h1'), ('n2', 'h2'), ('n3', 'h1')):
+                    self.notifier.ovs_network_created(
+                        self.context, {'id': id, 'host': host})
+            self.assertFalse(self.notifier.cast.called)
+        self.assertEqual(
+            [('q-agent-notifier-ovs_topology-update.h1', ['n1', 'n3']),
+             ('q-agent-notifier-ovs_topology-update.h2', ['n2'])],
+            self._sent())
+
+    def test_batch_does_not_hold_other_greenthreads(self):
+        with self.notifier.ovs_topology_batch():
+            eventlet.spawn(self.notifier.ovs_network_created, self.context,
+                           {'id': 'n2', 'host': 'h1'}).wait()
+            self.assertEqual(1, self.notifier.cast.call_count)
+            self.notifier.ovs_network_created(self.context,
+                                              {'id': 'n1', 'host': 'h1'})
+        self.assertEqual(2, self.notifier.cast.call_count)
+        self.assertEqual('ovs_network_created',
+                         self.notifier.cast.call_args_list[0][0][1]['method'])
+
+    def test_failed_message_asks_host_to_resync(self):
+        self.notifier.cast.side_effect = [Exception(), Exception(), None]
+        with self.notifier.ovs_topology_batch():
+            self.notifier.ovs_network_created(self.context,
+                                              {'id': 'n1', 'host': 'h1'})
+        send_resync = self.notifier._send_ovs_topology_resync
+        self.spawn_after.assert_called_once_with(
+            ovsnetwork_rpc_agent.OVS_TOPOLOGY_RESYNC_INTERVAL, send_resync,
+            self.context, 'h1')
+        # the first attempt fails too and is retried
+        send_resync(self.context, 'h1')
+        self.assertEqual(2, self.spawn_after.call_count)
+        self.assertEqual(set(['h1']), self.notifier._ovs_topology_resync)
+        send_resync(self.context, 'h1')
+        self.assertEqual({'method': 'ovs_topology_resync', 'args': {}},
+                         self.notifier.cast.call_args[0][1])
+        self.assertEqual('q-agent-notifier-ovs_topology-update.h1',
+                         self.notifier.cast.call_args[1]['topic'])
+        self.assertEqual(set(), self.notifier._ovs_topology_resync)
+
+    def test_resync_sets_sync_needed(self):
+        callbacks = ovsnetwork_rpc_agent.OVSNetworkAgentRpcCallbackMixin()
+        callbacks.ovs_network_agent = mock.Mock(ovs_network_sync_needed=False)
+        callbacks.ovs_topology_resync(self.context)
+        self.assertTrue(callbacks.ovs_network_agent.ovs_network_sync_needed)
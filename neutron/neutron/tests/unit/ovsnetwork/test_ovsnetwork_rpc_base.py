@@ -0,0 +1,203 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import itertools
+
+import mock
+from oslo.config import cfg
+
+from neutron.common import exceptions as n_exc
+from neutron.db import ovsnetwork_db
+from neutron.db import ovsnetwork_rpc_base
+from neutron.tests import base
+
+
+class FakeOVSNetworkPlugin(ovsnetwork_rpc_base.OVSNetworkServerRpcMixin):
+
+    def __init__(self):
+        self._port_ids = itertools.count(1)
+        self._link_ids = itertools.count(1)
+
+    def create_port(self, context, port):
+        return {'id': 'port%d' % next(self._port_ids),
+                'network_id': port['port']['network_id']}
+
+    def _create_link(self, context, link):
+        resource, = link.values()
+        return dict(resource, id='link%d' % next(self._link_ids))
+
+
+class OVSNetworkServerRpcTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(OVSNetworkServerRpcTestCase, self).setUp()
+        self.plugin = FakeOVSNetworkPlugin()
+        self.context = mock.Mock()
+        for method in ('create_vm_link', 'create_ovs_link'):
+            mock.patch.object(ovsnetwork_db.OVSNetworkDbMixin, method,
+                              side_effect=self.plugin._create_link).start()
+        self.tunnelkey = mock.Mock()
+        self.tunnelkey.allocate_many.side_effect = (
+            lambda session, port_ids: [100 + i for i in
+                                       range(1, len(port_ids) + 1)])
+        mock.patch.object(FakeOVSNetworkPlugin, '_tunnelkey',
+                          self.tunnelkey).start()
+        mock.patch.object(self.plugin, '_get_ovs_network_hosts_by_ids',
+                          return_value={'net1': 'host1',
+                                        'net2': 'host2'}).start()
+        mock.patch.object(self.plugin, '_get_tunnel_ips',
+                          return_value={'host1': '10.0.0.1',
+                                        'host2': '10.0.0.2'}).start()
+
+
+class TestCreateLinks(OVSNetworkServerRpcTestCase):
+
+    def test_create_vm_links(self):
+        created = self.plugin._create_vm_links(
+            self.context, [{'ovs_network_id': 'net1', 'vm_host': 'host2'},
+                           {'ovs_network_id': 'net2', 'vm_host': None}])
+        self.tunnelkey.allocate_many.assert_called_once_with(
+            self.context.session, ['port1', 'port2', 'port3', 'port4'])
+        self.assertEqual(
+            [('port1', 101, 'port2', 102, 'host1', '10.0.0.1', '10.0.0.2'),
+             ('port3', 103, 'port4', 104, 'host2', '10.0.0.2', None)],
+            [(vm_link['vm_port_id'], vm_link['vm_tunnel_id'],
+              vm_link['ovs_port_id'], vm_link['ovs_tunnel_id'],
+              vm_link['ovs_host'], vm_link['ovs_tunnel_ip'],
+              vm_link['vm_tunnel_ip']) for vm_link in created])
+
+    def test_create_ovs_links(self):
+        created = self.plugin._create_ovs_links(
+            self.context, [{'left_ovs_id': 'net1', 'right_ovs_id': 'net2'},
+                           {'left_ovs_id': 'net2', 'right_ovs_id': 'net2'}])
+        self.tunnelkey.allocate_many.assert_called_once_with(
+            self.context.session, ['port1', 'port2', 'port3', 'port4'])
+        self.assertEqual(
+            [('port1', 101, 'host1', '10.0.0.1',
+              'port2', 102, 'host2', '10.0.0.2'),
+             ('port3', 103, 'host2', '10.0.0.2',
+              'port4', 104, 'host2', '10.0.0.2')],
+            [(ovs_link['left_port_id'], ovs_link['left_tunnel_id'],
+              ovs_link['left_host'], ovs_link['left_tunnel_ip'],
+              ovs_link['right_port_id'], ovs_link['right_tunnel_id'],
+              ovs_link['right_host'], ovs_link['right_tunnel_ip'])
+             for ovs_link in created])
+
+    def test_create_no_links(self):
+        self.assertEqual([], self.plugin._create_vm_links(self.context, []))
+        self.assertEqual([], self.plugin._create_ovs_links(self.context, []))
+        self.assertFalse(self.tunnelkey.allocate_many.called)
+
+
+class TestOVSEventLog(OVSNetworkServerRpcTestCase):
+
+    def setUp(self):
+        super(TestOVSEventLog, self).setUp()
+        self.in_transaction = False
+
+        @contextlib.contextmanager
+        def begin(subtransactions=False):
+            self.in_transaction = True
+            try:
+                yield
+            finally:
+                self.in_transaction = False
+        self.context.session.begin = begin
+        self.logged = []
+        mock.patch.object(self.plugin, 'record_ovs_network_change',
+                          side_effect=self._record).start()
+        self.plugin.notifier = mock.MagicMock()
+        self.notified = []
+        for method in ('vm_link_ovs_endpoint_created', 'ovs_network_deleted'):
+            getattr(self.plugin.notifier, method).side_effect = (
+                lambda *args, **kwargs:
+                self.notified.append(self.in_transaction))
+
+    def _record(self, context, host, method, resource):
+        self.logged.append((method, host, self.in_transaction))
+        return {'revision': len(self.logged),
+                'prev_revision': len(self.logged) - 1}
+
+    def test_events_are_logged_in_the_transaction_and_sent_after(self):
+        created = self.plugin.create_vm_link_bulk(
+            self.context,
+            {'vm_links': [{'vm_link': {'ovs_network_id': 'net1',
+                                       'vm_host': 'host2'}},
+                          {'vm_link': {'ovs_network_id': 'net2',
+                                       'vm_host': None}}]})
+        self.assertEqual(
+            [('vm_link_ovs_endpoint_created', 'host1', True),
+             ('vm_link_ovs_endpoint_created', 'host2', True)], self.logged)
+        self.assertEqual([False, False], self.notified)
+        notify = self.plugin.notifier.vm_link_ovs_endpoint_created
+        self.assertEqual(
+            [(created[0]['id'], 1, 0, 'host1'),
+             (created[1]['id'], 2, 1, 'host2')],
+            [(call[0][1]['id'], call[0][1]['revision'],
+              call[0][1]['prev_revision'], call[0][2])
+             for call in notify.call_args_list])
+
+    def test_deleted_ovs_network_is_sent_with_its_revision(self):
+        events = []
+        self.plugin._log_ovs_event(self.context, events,
+                                   'ovs_network_deleted', 'net1', 'host1')
+        self.plugin._send_ovs_events(self.context, events)
+        self.plugin.notifier.ovs_network_deleted.assert_called_once_with(
+            self.context, 'net1', 'host1', revision=1, prev_revision=0)
+
+    def test_change_log_is_pruned_periodically(self):
+        looping_call = mock.patch.object(
+            ovsnetwork_rpc_base.loopingcall,
+            'FixedIntervalLoopingCall').start()
+        self.plugin.start_ovs_network_change_pruning()
+        looping_call.return_value.start.assert_called_once_with(interval=60)
+        with mock.patch.object(self.plugin, 'prune_ovs_network_changes',
+                               side_effect=Exception()) as prune:
+            # a failure must not end the looping call
+            looping_call.call_args[0][0]()
+        self.assertTrue(prune.called)
+
+
+class TestCheckTunnelKeyRange(OVSNetworkServerRpcTestCase):
+
+    def setUp(self):
+        super(TestCheckTunnelKeyRange, self).setUp()
+        # the ML2 type drivers register these options
+        for group, name in ovsnetwork_rpc_base._TENANT_TUNNEL_RANGE_OPTS:
+            try:
+                cfg.CONF.register_opt(cfg.ListOpt(name, default=[]), group)
+            except cfg.DuplicateOptError:
+                pass
+        self.tunnelkey.key_min = cfg.CONF.OVSNETWORK.tunnel_key_min
+        self.tunnelkey.key_max = cfg.CONF.OVSNETWORK.tunnel_key_max
+
+    def test_default_range_is_outside_tenant_ranges(self):
+        self.config(tunnel_id_ranges=['1:1000'], group='ml2_type_gre')
+        self.config(vni_ranges=['1:1000', '2000:100000'],
+                    group='ml2_type_vxlan')
+        self.plugin._check_tunnel_key_range()
+        self.assertTrue(self.tunnelkey.key_max <= 0xffffff)
+
+    def test_overlapping_gre_range_is_rejected(self):
+        self.config(tunnel_id_ranges=['1:1000', '16777200:4294967295'],
+                    group='ml2_type_gre')
+        self.assertRaises(n_exc.InvalidConfigurationOption,
+                          self.plugin._check_tunnel_key_range)
+
+    def test_overlapping_vxlan_range_is_rejected(self):
+        self.config(vni_ranges=['1:%d' % self.tunnelkey.key_min],
+                    group='ml2_type_vxlan')
+        self.assertRaises(n_exc.InvalidConfigurationOption,
+                          self.plugin._check_tunnel_key_range)
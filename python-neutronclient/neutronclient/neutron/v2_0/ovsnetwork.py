@@ -15,6 +15,7 @@
 #
 
 import argparse
+import json
 import logging
 
 from neutronclient.common import exceptions
@@ -284,3 +285,62 @@ class UpdateVMLink(neutronV20.UpdateCommand):
             body['vm_link'].update(
                 {'vm_host': parsed_args.vm_host})
         return body
+
+
+class ListOVSTopology(neutronV20.ListCommand):
+    """List ovs-topologies that belong to a given tenant."""
+
+    resource = 'ovs_topology'
+    list_columns = ['id', 'name']
+    pagination_support = True
+    sorting_support = True
+
+
+class ShowOVSTopology(neutronV20.ShowCommand):
+    """Show the ovs networks and links of a given ovs topology."""
+
+    resource = 'ovs_topology'
+    allow_names = True
+
+
+class CreateOVSTopology(neutronV20.CreateCommand):
+    """Create ovs networks, ovs links and vm links from a topology file.
+
+    The file is a JSON object with lists of ovs_networks, ovs_links and
+    vm_links. Links refer to the ovs networks of the file by name, through
+    left_ovs_name and right_ovs_name, or ovs_network_name.
+    """
+
+    resource = 'ovs_topology'
+
+    def add_known_arguments(self, parser):
+        parser.add_argument(
+            '--name', metavar='NAME',
+            help=_('Name of ovs topology.'))
+        parser.add_argument(
+            'topology_file', metavar='TOPOLOGY_FILE',
+            help=_('JSON file describing the ovs topology.'))
+
+    def args2body(self, parsed_args):
+        try:
+            with open(parsed_args.topology_file) as f:
+                topology = json.load(f)
+        except (IOError, ValueError) as e:
+            raise exceptions.CommandError(
+                _('Cannot read ovs topology %(file)s: %(error)s') %
+                {'file': parsed_args.topology_file, 'error': e})
+        body = {'ovs_topology': {}}
+        for collection in ('ovs_networks', 'ovs_links', 'vm_links'):
+            if collection in topology:
+                body['ovs_topology'][collection] = topology[collection]
+        if parsed_args.name:
+            body['ovs_topology'].update(
+                {'name': parsed_args.name})
+        return body
+
+
+class DeleteOVSTopology(neutronV20.DeleteCommand):
+    """Delete a given ovs topology with its ovs networks and links."""
+
+    resource = 'ovs_topology'
+    allow_names = True
@@ -310,7 +310,11 @@ COMMAND_V2 = {
     'vm-link-show': ovsnetwork.ShowVMLink,
     'vm-link-create': ovsnetwork.CreateVMLink,
     'vm-link-update': ovsnetwork.UpdateVMLink,
-    'vm-link-delete': ovsnetwork.DeleteVMLink
+    'vm-link-delete': ovsnetwork.DeleteVMLink,
+    'ovs-topology-list': ovsnetwork.ListOVSTopology,
+    'ovs-topology-show': ovsnetwork.ShowOVSTopology,
+    'ovs-topology-create': ovsnetwork.CreateOVSTopology,
+    'ovs-topology-delete': ovsnetwork.DeleteOVSTopology,
 }
 
 COMMANDS = {'2.0': COMMAND_V2}
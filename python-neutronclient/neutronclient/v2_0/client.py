@@ -232,6 +232,8 @@ class Client(object):
     ovs_link_path = "/ovs-links/%s"
     vm_links_path = "/vm-links"
     vm_link_path = "/vm-links/%s"
+    ovs_topologies_path = "/ovs-topologies"
+    ovs_topology_path = "/ovs-topologies/%s"
 
     # API has no way to report plurals, so we have to hard code them
     EXTED_PLURALS = {'routers': 'router',
@@ -260,6 +262,7 @@ class Client(object):
                      'ovs_networks': 'ovs_network',
                      'ovs_links': 'ovs_link',
                      'vm_links': 'vm_link',
+                     'ovs_topologies': 'ovs_topology',
                      }
     # 8192 Is the default max URI len for eventlet.wsgi.server
     MAX_URI_LEN = 8192
@@ -1284,6 +1287,28 @@ class Client(object):
         """Deletes the specified vm link."""
         return self.delete(self.vm_link_path % (vm_link))
 
+    @APIParamsCall
+    def create_ovs_topology(self, body=None):
+        """Creates ovs networks, ovs links and vm links all at once."""
+        return self.post(self.ovs_topologies_path, body=body)
+
+    @APIParamsCall
+    def list_ovs_topologies(self, retrieve_all=True, **_params):
+        """Fetches a list of all ovs topologies for a tenant."""
+        return self.list('ovs_topologies', self.ovs_topologies_path,
+                         retrieve_all, **_params)
+
+    @APIParamsCall
+    def show_ovs_topology(self, ovs_topology, **_params):
+        """Fetches information of a certain ovs topology."""
+        return self.get(self.ovs_topology_path % (ovs_topology),
+                        params=_params)
+
+    @APIParamsCall
+    def delete_ovs_topology(self, ovs_topology):
+        """Deletes the specified ovs topology with all its members."""
+        return self.delete(self.ovs_topology_path % (ovs_topology))
+
     def __init__(self, **kwargs):
         """Initialize a new client for the Neutron v2.0 API."""
         super(Client, self).__init__()